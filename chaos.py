@@ -1,8 +1,11 @@
 import os
 import sys
 
-from lib import api, arguments
+import lib
 from random import randint
+
+arguments = lib.setup()
+api = lib.api
 width = ...
 height = ...
 
@@ -28,5 +31,5 @@ while True:
     h = hex(col)[2:]
     if len(h) < 6:
         h += "0"*(6-len(h))
-    print(f"[CURSOR] Setting ({x}, {y}) to #{h}")
+    lib.log.info("CURSOR", "Setting %s to #%s", (x, y), h, x=x, y=y, colour=h)
     api.set_pixel(x, y, h)
@@ -1,22 +1,105 @@
+import atexit
+import importlib
+import logging
+import signal
+import sys
 from sys import version_info
+from types import ModuleType
 
-from . import concurrency  # just the concurrency check. No actual imports
-from .api import Api, get_pixels, set_pixel, handle_sane_ratelimit, Pixel
+from . import cli, concurrency, log, metrics
 from .cli import arguments
 from .kool import Fore
-from .image_process import render
+from .log import Progress
 from .errors import *
 
-api = Api(
-    arguments.base,
-    auth=arguments.auth
-)
+# Everything else is only imported once it's first used (see __getattr__), since between them they pull in aiohttp,
+# numpy, PIL and requests, which scripts that only want the command line or a quick status shouldn't wait for.
+_LAZY = {
+    "Api": "api", "AsyncApi": "api", "get_pixels": "api", "set_pixel": "api", "handle_sane_ratelimit": "api",
+    "Pixel": "api",
+    "RateLimiter": "ratelimit",
+    "CircuitBreaker": "retry", "RetryPolicy": "retry",
+    "render": "image_process", "diff_pixels": "image_process",
+    "load_palette": "palette", "quantize": "palette",
+    "Canvas": "canvas", "Template": "canvas",
+    "CanvasCache": "cache",
+    "Checkpoint": "checkpoint",
+    "Journal": "journal", "Recorder": "journal",
+    "WorkerPool": "pool",
+    "Pipeline": "pipeline",
+    "AdaptivePoller": "polling",
+    "Controller": "control",
+    "Protector": "protect",
+    "Workspace": "workspace", "WorkspaceEntry": "workspace",
+    "Scheduler": "scheduler", "get_scheduler": "scheduler",
+}
 
 
-if arguments.download:
-    api.get_pixels((1920, 1080)).save("./canvas.png")
-    print("Canvas downloaded to ./canvas.png!")
-    # Don't exit
+def _lazy(name: str):
+    module = importlib.import_module("." + _LAZY[name], __name__)
+    if isinstance(globals().get("api"), ModuleType):
+        # lib.api is the client built from the command line (see _default_api), not the submodule, which importing
+        # it (or anything that needs it) has just put there.
+        del globals()["api"]
+    value = globals()[name] = getattr(module, name)
+    return value
+
+
+def _default_api():
+    # Only built when something first asks for it, since importing lib shouldn't touch the network.
+    global api
+    Api = _lazy("Api")
+    if "api" not in globals():
+        if arguments.auth is None:
+            raise RuntimeError("lib.setup() has to be called before lib.api can be used.")
+        api = Api(arguments.base, auth=arguments.auth)
+    return api
+
+
+def __getattr__(name):
+    if name == "api":
+        return _default_api()
+    if name in _LAZY:
+        return _lazy(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def setup(argv=None):
+    """
+    Parses the command line and runs the concurrency check. Scripts call this once before doing anything else;
+    importing lib on its own never reads sys.argv or sends a request.
+
+    :param argv: The arguments to parse. Defaults to sys.argv.
+    :return: Namespace - the parsed arguments (also available as lib.arguments)
+    """
+    cli.parse(argv)
+    log.setup(
+        logging.DEBUG if arguments.verbose else logging.WARNING if arguments.quiet else logging.INFO,
+        arguments.log_format,
+    )
+    # Exits normally on SIGTERM too, so the atexit cleanups (ratelimits, checkpoints, locks) still get to run.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    concurrency.check(arguments)
+
+    if arguments.metrics_port is not None:
+        metrics.serve(arguments.metrics_port)
+    if arguments.metrics_json is not None:
+        output = sys.stdout if arguments.metrics_json == "-" else open(arguments.metrics_json, "a")
+        reporter = metrics.JsonReporter(output, arguments.metrics_interval)
+        reporter.start()
+        atexit.register(reporter.report)  # so even short runs leave a line behind
+
+    if arguments.journal is not None:
+        cache = _lazy("CanvasCache")(_default_api(), arguments.cache_ttl)
+        _lazy("Recorder")(_lazy("Journal")(arguments.journal), cache, arguments.journal_interval).start()
+
+    if arguments.download:
+        from PIL import Image
+        canvas = _lazy("CanvasCache")(_default_api(), arguments.cache_ttl).get()
+        canvas.to_image().resize((1920, 1080), Image.NEAREST).save("./canvas.png")
+        log.info("CANVAS", "Canvas downloaded to ./canvas.png!")
+        # Don't exit
+    return arguments
 
 
 def query_params():
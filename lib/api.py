@@ -1,22 +1,30 @@
+import asyncio
 import json
-import sys
+import logging
 import time
+from operator import itemgetter
 from typing import List, Tuple, Optional
-from datetime import datetime, timedelta
 
+import numpy
 import requests
-from requests.structures import CaseInsensitiveDict
 from PIL import Image
-from aiohttp import ClientSession
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
 
-from .kool import Fore, _print as print
-from .errors import APIException, AxisOutOfRange, APIOffline
-from .cli import arguments as args
+from . import log, metrics
+from .errors import APIException, AxisOutOfRange, APIOffline, Forbidden, Ratelimited, Unauthorized
+from .ratelimit import RateLimiter, endpoint_of
+from .retry import NETWORK_ERRORS, CircuitBreaker, RetryPolicy
+from .canvas import Canvas, TRANSPARENCY_THRESHOLD, close_enough
 
+# How long to wait for the server to accept a connection, and then for each read of its answer, in seconds. Without
+# these, a server that stops answering hangs whoever's waiting on it (and holds their ratelimit slot) forever.
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 30.0
 
-class Pixel(list):
+
+class Pixel(tuple):
     """
-    Describes a pixel
+    Describes a pixel. Unpacks as (x, y, rgb).
 
     Attributes:
         x: int - the X (horizontal) co-ordinate
@@ -25,12 +33,15 @@ class Pixel(list):
         hex: str - the hexadecimal value
     """
 
-    def __init__(self, x: int, y: int, rgb: str):
-        self.x = x
-        self.y = y
-        self.rgb = rgb
-        self.hex = rgb
-        super().__init__((x, y, rgb))
+    __slots__ = ()
+
+    def __new__(cls, x: int, y: int, rgb: str):
+        return super().__new__(cls, (x, y, rgb))
+
+    x = property(itemgetter(0))
+    y = property(itemgetter(1))
+    rgb = property(itemgetter(2))
+    hex = rgb
 
 
 class Api:
@@ -38,18 +49,41 @@ class Api:
     OOP API Container
     """
 
-    def __init__(self, base: str = "https://pixels.pythondiscord.com", *, auth: str):
+    def __init__(
+            self,
+            base: str = "https://pixels.pythondiscord.com",
+            *,
+            auth: str,
+            ratelimiter: RateLimiter = None,
+            retry: RetryPolicy = None
+    ):
         self.session = requests.session()
         self.base = base
         self.auth = auth
+        self.ratelimiter = ratelimiter or RateLimiter.for_token(base, auth)
+        self.retry = retry or RetryPolicy(breaker=CircuitBreaker.for_base(base))
         # self.session = session
 
-        self.max_width, self.max_height = self.get_size()
-        # sync all ratelimits
-        self.sync_ratelimit("get_pixel")
-        self.sync_ratelimit("get_pixels")
-        self.sync_ratelimit("set_pixel")
+        # Nothing is sent until it's needed: the canvas size is fetched on first use, and each endpoint's ratelimit
+        # is learned from the headers of its first real request (the limiter only lets one through until then), unless
+        # an earlier run with this token already learned it (see RateLimiter.for_token).
+        self._size: Optional[Tuple[int, int]] = None
         self._src = None
+        self._buffer: Optional[bytearray] = None
+        self.etag: Optional[str] = None  # of the last canvas snapshot, if the server sent one
+        self.round_trip = 0.1  # a moving average of how long requests take to answer, in seconds
+
+    @property
+    def max_width(self) -> int:
+        if self._size is None:
+            self._size = self.get_size()
+        return self._size[0]
+
+    @property
+    def max_height(self) -> int:
+        if self._size is None:
+            self._size = self.get_size()
+        return self._size[1]
 
     @property
     def image(self):
@@ -57,56 +91,58 @@ class Api:
 
     @image.setter
     def image(self, value):
-        from .image_process import map_pixels
-        self._src = map_pixels(get_pixels(value), rgba=True)
+        from .image_process import map_pixels, to_array
+        self._src = map_pixels(to_array(value), rgba=True)
 
     def __del__(self):
         self.session.close()
 
     def _adjust_height(self, x, y):
         if self.max_width >= x >= 0 or self.max_height >= y >= 0:  # canvas size has probably changed.
-            # self.max_width, self.max_height = self.get_size()
+            # self._size = self.get_size()
             pass
             # While writing this, I realised if the canvas re-expands there's no way to detect this without
             # sending yet another request.
 
     def _request(self, uri: str, method: str = "GET", **kwargs):
+        # Failures that might go away (5xx, 429s, connection errors) are retried by self.retry, a bounded number of
+        # times, and not at all while the server looks to be down.
+        return self.retry.call(endpoint_of(uri), self._send, uri, method, **kwargs)
+
+    def _send(self, uri: str, method: str = "GET", **kwargs):
         method = method.upper()
         kwargs.setdefault("headers", {})
         kwargs["headers"].setdefault(
             "Authorization",
             "Bearer " + self.auth
         )
+        kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
         return_content = kwargs.pop("return_content", "json")
-        if args.verbose:
-            print(f"{Fore.RED}[DEBUG] {Fore.LIGHTBLACK_EX}{method}-ing {uri}...")
-        response = self.session.request(method, self.base+uri, **kwargs)
-        if args.verbose:
-            print(f"{Fore.RED}[DEBUG] {Fore.LIGHTBLACK_EX}sent {method} to {uri}.")
-
-        # Error handling
-        if response.status_code == 422:
-            raise AxisOutOfRange(response.status_code, response.text, message="Malformed request.")
-        if response.status_code in range(500, 600):  # server error:
-            raise APIOffline(response.status_code, f"Pixels server appears to be down.")
-
-        # Lets not 429
-        self.wait_out_ratelimit(response.headers)
-        # NOTE: This PAUSES the ENTIRE program for ONE endpoint's cooldown.
-        # A better alternative would be checking against datetimes in some container bucket thing.
-        # For now, it's not so much of an issue.
-        # However, in terms of protection scripts, this can make or break the program's success.
-
-        if response.status_code != 200:
-            if args.verbose:
-                print(f"{Fore.RED}[DEBUG] {Fore.LIGHTBLACK_EX}non-200 {response.status_code} on {uri}. retrying.")
-            return self._request(uri, method, **kwargs)
+        endpoint = endpoint_of(uri)
+        # Lets not 429. This only waits out this endpoint's bucket, the others are unaffected.
+        self.ratelimiter.acquire(endpoint)
+        log.debug("DEBUG", "%s-ing %s...", method, uri)
+        sent = time.monotonic()
+        try:
+            response = self.session.request(method, self.base+uri, **kwargs)
+        except requests.RequestException:
+            self.ratelimiter.release(endpoint)
+            raise
+        elapsed = time.monotonic() - sent
+        self.round_trip += (elapsed - self.round_trip) * 0.2
+        metrics.observe_response(endpoint, response.status_code, elapsed)
+        log.debug("DEBUG", "sent %s to %s.", method, uri)
+        body = response.text if response.status_code not in (200, 304) else ""  # streamed bodies are read later
+        _check(endpoint, self.ratelimiter, response.status_code, response.headers, body)
 
         # We need a special case for HEAD requests with no body
         if method == "HEAD":
             return response.status_code, {}
         if return_content is None:
             return response.status_code
+        if callable(return_content):  # it wants to read the response itself (e.g. streaming)
+            with response:
+                return response.status_code, return_content(response)
         attr = getattr(response, return_content)
         if callable(attr):
             data = attr()
@@ -133,7 +169,6 @@ class Api:
         :return: Pixel - The Found pixel.
         :raises: ValueError - the co-ordinates were out of range
         """
-        self.sync_ratelimit("get_pixel")
         status, data = self._request("/get_pixel", "GET", params={"x": x, "y": y})
         return Pixel(*data.values())
 
@@ -147,7 +182,6 @@ class Api:
         :param colour: The hexadecimal colour
         :return:
         """
-        self.sync_ratelimit("set_pixel")
         status, data = self._request(
             "/set_pixel",
             "POST",
@@ -157,26 +191,113 @@ class Api:
             raise APIException(status, "Unknown error.", message=json.dumps(data, indent=2))
         return True
 
-    def set_pixel(self, x: int, y: int, colour: str) -> Optional[bool]:
+    def set_pixel(self, x: int, y: int, colour: str, tolerance: float = 0.0) -> Optional[bool]:
         """
         Sets a pixel on the canvas.
 
         :param x: Guess
         :param y: Guess more
         :param colour: #hex000
+        :param tolerance: How different (see lib.canvas.colour_distance) it can look and not need painting
         :return:
         """
-        if len(colour) == 8 and int(colour[6:], 16) <= 0x55:
-            print("[DEBUG]", (x, y, colour), "is transparent!")
+        if len(colour) == 8 and int(colour[6:], 16) <= TRANSPARENCY_THRESHOLD:
+            log.debug("DEBUG", "%s is transparent!", (x, y, colour))
             return  # transparent
         else:
             colour = colour[:6]
         pixel = self.get_pixel(x, y)
-        if pixel.hex == colour:
-            print("[DEBUG]", (x, y, colour), "is already painted.")
+        if close_enough(pixel.hex, colour, tolerance):
+            log.debug("DEBUG", "%s is already painted.", (x, y, colour))
             return
         return self.blind_set_pixel(x, y, colour)
 
+    def _canvas_buffer(self, length: Optional[int], into: Optional[Canvas]) -> memoryview:
+        """
+        Works out where the next canvas download should go, re-checking the canvas size if the download isn't the
+        size we expect.
+
+        :param length: The Content-Length of the download, if known
+        :param into: The canvas to download into, if any
+        :return: memoryview - writable, and exactly the size of the canvas
+        """
+        if self._size is None or (length is not None and length != self.max_width * self.max_height * 3):
+            # We haven't asked yet, or the canvas has probably changed size since we last did.
+            self._size = self.get_size()
+        size = self.max_width * self.max_height * 3
+        if into is not None and into.array.nbytes == size and into.array.flags.c_contiguous:
+            return memoryview(into.array).cast("B")
+        if self._buffer is None or len(self._buffer) != size:
+            self._buffer = bytearray(size)
+        return memoryview(self._buffer)
+
+    def snapshot(self, into: Canvas = None, etag: str = None) -> Optional[Canvas]:
+        """
+        Downloads the entire canvas, streaming it straight into a buffer that's reused between calls.
+
+        Nothing is copied or allocated per call, so the returned Canvas is a view into that buffer: it's only valid
+        until the next snapshot. Use Canvas.copy(), or pass your own canvas as into, if you need to keep it.
+        The canvas' ETag (if the server sends one) is kept in self.etag.
+
+        :param into: A full-size canvas to download into, instead of the shared buffer.
+        :param etag: The ETag of a copy of the canvas we already have. If it's still current, nothing is downloaded.
+        :return: Canvas, or None if etag was still current
+        """
+        def read(response: requests.Response) -> Optional[Canvas]:
+            if response.status_code == 304:
+                return None
+            self.etag = response.headers.get("ETag")
+            length = response.headers.get("Content-Length")
+            view = self._canvas_buffer(int(length) if length is not None else None, into)
+            _read_into(response, view)
+            return Canvas.from_bytes(view, (self.max_width, self.max_height))
+
+        headers = {"If-None-Match": etag} if etag else {}
+        status, canvas = self._request("/get_pixels", return_content=read, stream=True, headers=headers)
+        return canvas
+
+    def get_region(self, x0: int, y0: int, x1: int, y1: int) -> Canvas:
+        """
+        Fetches a rectangle of the canvas, whichever way is quicker under the current ratelimits: a get_pixel for each
+        pixel in it, or one /get_pixels, of which only the rows it covers are kept.
+
+        :param x0: The left edge
+        :param y0: The top edge
+        :param x1: The right edge (exclusive)
+        :param y1: The bottom edge (exclusive)
+        :return: Canvas - the rectangle, clipped to the canvas, in full-canvas co-ordinates
+        """
+        x0, x1 = (min(max(v, 0), self.max_width) for v in (x0, x1))
+        y0, y1 = (min(max(v, 0), self.max_height) for v in (y0, y1))
+        count = max(x1 - x0, 0) * max(y1 - y0, 0)
+        by_pixel = self.ratelimiter.delay("get_pixel", count) + count * self.round_trip
+        by_canvas = self.ratelimiter.delay("get_pixels") + self.round_trip
+        if by_pixel < by_canvas:
+            array = numpy.empty((max(y1 - y0, 0), max(x1 - x0, 0), 3), numpy.uint8)
+            for y in range(y0, y1):
+                for x in range(x0, x1):
+                    array[y - y0, x - x0] = tuple(bytes.fromhex(self.get_pixel(x, y).rgb))
+            return Canvas(array, x0, y0)
+
+        def read(response: requests.Response) -> Canvas:
+            length = response.headers.get("Content-Length")
+            if length is not None and int(length) != self.max_width * self.max_height * 3:
+                self._size = self.get_size()  # The canvas has probably changed size since we last asked.
+            stride = self.max_width * 3
+            top, bottom = min(y0, self.max_height), min(y1, self.max_height)
+            # Skip everything above the rectangle, and stop reading as soon as we're past it.
+            scratch = memoryview(bytearray(min(top * stride, 1 << 16)))
+            skipped = 0
+            while skipped < top * stride:
+                skipped += _read_into(response, scratch[:top * stride - skipped])
+            rows = bytearray((bottom - top) * stride)
+            _read_into(response, memoryview(rows))
+            array = numpy.frombuffer(rows, numpy.uint8).reshape(bottom - top, self.max_width, 3)
+            return Canvas(array, 0, top).crop(x0, top, x1, bottom)
+
+        status, canvas = self._request("/get_pixels", return_content=read, stream=True)
+        return canvas
+
     def get_pixels(self, resize_to: Tuple[int, int] = None) -> Image:
         """
         Downloads the entire canvas
@@ -184,72 +305,300 @@ class Api:
         :param resize_to: The width, height pair to resize to. If not provided, will not resize.
         :return: PIL.Image
         """
-        self.sync_ratelimit("get_pixels")
-        status, image_data = self._request(
-            "/get_pixels",
-            return_content="content"
-        )
-        size = self.get_size()
-
-        image = Image.frombytes(
-            "RGB",
-            size,
-            image_data
-        )
+        image = self.snapshot().to_image()
         if resize_to:
-            image.resize(resize_to, Image.NEAREST)
+            image = image.resize(resize_to, Image.NEAREST)
         return image
 
-    @staticmethod
-    def wait_out_ratelimit(headers: CaseInsensitiveDict):
-        remaining = int(headers.get("requests-remaining", 0))
-        soft_cooldown = headers.get("requests-reset", ...)
-        hard_cooldown = headers.get("cooldown-reset", ...)
-        if hard_cooldown is ...:
-            if soft_cooldown is ...:
-                return  # no cooldown
-            soft_cooldown = float(soft_cooldown)
-            if remaining == 0:  # Soft cooldown
-                expire = datetime.now() + timedelta(seconds=soft_cooldown)
-                print(
-                    f"{Fore.CYAN}[RATELIMITER] {Fore.LIGHTYELLOW_EX}On {Fore.LIGHTGREEN_EX}soft cooldown"
-                    f"{Fore.LIGHTYELLOW_EX} for {Fore.LIGHTCYAN_EX}{soft_cooldown} seconds{Fore.LIGHTYELLOW_EX} "
-                    f"(until {Fore.LIGHTCYAN_EX}{expire.strftime('%X')}{Fore.LIGHTYELLOW_EX})."
-                )
-                time.sleep(soft_cooldown)
-        else:
-            hard_cooldown = float(hard_cooldown)
-            expire = datetime.now() + timedelta(seconds=hard_cooldown)
-            print(
-                f"{Fore.CYAN}[RATELIMITER] {Fore.LIGHTYELLOW_EX}On {Fore.RED}hard cooldown"
-                f"{Fore.LIGHTYELLOW_EX} for {Fore.LIGHTCYAN_EX}{hard_cooldown} seconds{Fore.LIGHTYELLOW_EX} "
-                f"(until {Fore.LIGHTCYAN_EX}{expire.strftime('%X')}{Fore.LIGHTYELLOW_EX})."
-            )
-            time.sleep(hard_cooldown)
-
     def sync_ratelimit(self, endpoint: str = "set_pixel"):
         """
-        Simply sends a HEAD request and waits for the timeout.
+        Sends a HEAD request to learn an endpoint's ratelimit state, without spending a real request on it.
 
+        :param endpoint: The endpoint to sync
         :return:
         """
-        print(Fore.RED+"[DEBUG]"+Fore.LIGHTBLACK_EX+" Syncing ratelimit for", endpoint, verbose=True)
+        log.debug("RATELIMITER", "Syncing ratelimit for %s.", endpoint, endpoint=endpoint)
         self._request("/"+endpoint.lower(), "HEAD")
-        print(Fore.RED + "[DEBUG]" + Fore.LIGHTBLACK_EX + " Synced ratelimit for", endpoint, verbose=True)
+        log.debug("RATELIMITER", "Synced ratelimit for %s.", endpoint, endpoint=endpoint)
+
+
+class AsyncApi:
+    """
+    asyncio flavour of Api, built on aiohttp.
+
+    Requests share one pooled keep-alive session, and cooldowns are waited out with asyncio.sleep, so any number of
+    watchers can run on one thread without blocking each other (or the event loop).
+    Use it as an async context manager, or await close() once you're done with it.
+    """
+
+    def __init__(
+            self,
+            base: str = "https://pixels.pythondiscord.com",
+            *,
+            auth: str,
+            ratelimiter: RateLimiter = None,
+            retry: RetryPolicy = None,
+            connections: int = 8
+    ):
+        self.base = base
+        self.auth = auth
+        self.ratelimiter = ratelimiter or RateLimiter.for_token(base, auth)
+        self.retry = retry or RetryPolicy(breaker=CircuitBreaker.for_base(base))
+        self.connections = connections
+        self.max_width: Optional[int] = None
+        self.max_height: Optional[int] = None
+        self._session: Optional[ClientSession] = None
+        self._buffer: Optional[bytearray] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    @property
+    def session(self) -> ClientSession:
+        # Created lazily, since aiohttp wants a running event loop.
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(limit=self.connections, keepalive_timeout=60),
+                timeout=ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT),
+                headers={"Authorization": "Bearer " + self.auth}
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def _request(self, uri: str, method: str = "GET", **kwargs):
+        return await self.retry.call_async(endpoint_of(uri), self._send, uri, method, **kwargs)
+
+    async def _send(self, uri: str, method: str = "GET", **kwargs):
+        method = method.upper()
+        return_content = kwargs.pop("return_content", "json")
+        endpoint = endpoint_of(uri)
+        await self.ratelimiter.acquire_async(endpoint)
+        log.debug("DEBUG", "%s-ing %s...", method, uri)
+        sent = time.monotonic()
+        try:
+            response = await self.session.request(method, self.base+uri, **kwargs)
+        except (ClientError, asyncio.TimeoutError):
+            self.ratelimiter.release(endpoint)
+            raise
+        metrics.observe_response(endpoint, response.status, time.monotonic() - sent)
+        async with response:
+            log.debug("DEBUG", "sent %s to %s.", method, uri)
+            body = await response.text() if response.status not in (200, 304) else ""
+            _check(endpoint, self.ratelimiter, response.status, response.headers, body)
+
+            if method == "HEAD":
+                return response.status, {}
+            if return_content is None:
+                return response.status
+            if callable(return_content):  # it wants to read the response itself (e.g. streaming)
+                return response.status, await return_content(response)
+            if return_content == "json":
+                return response.status, await response.json(content_type=None)
+            if return_content == "text":
+                return response.status, await response.text()
+            return response.status, await response.read()
+
+    async def get_size(self) -> Tuple[int, int]:
+        """
+        Fetches the size of the canvas.
+
+        :return: width, height
+        """
+        status, data = await self._request("/get_size")
+        return data["width"], data["height"]
+
+    async def get_pixel(self, x: int, y: int) -> Pixel:
+        """
+        Fetches a pixel from the remote canvas.
+
+        :param x: The X (horizontal) co-ordinate of the target pixel
+        :param y: X but Y
+        :return: Pixel - The Found pixel.
+        :raises: AxisOutOfRange - the co-ordinates were out of range
+        """
+        status, data = await self._request("/get_pixel", "GET", params={"x": x, "y": y})
+        return Pixel(*data.values())
+
+    async def blind_set_pixel(self, x: int, y: int, colour: str) -> bool:
+        """
+        Sets a pixel on the canvas, without checking it first.
+
+        :param x: The X (horizontal) co-ordinate of the target pixel
+        :param y: The Y (vertical) co-ordinate of the target pixel
+        :param colour: The hexadecimal colour
+        :return:
+        """
+        status, data = await self._request(
+            "/set_pixel",
+            "POST",
+            json={"x": x, "y": y, "rgb": colour}
+        )
+        if status != 200:
+            raise APIException(status, "Unknown error.", message=json.dumps(data, indent=2))
+        return True
+
+    async def set_pixel(self, x: int, y: int, colour: str, tolerance: float = 0.0) -> Optional[bool]:
+        """
+        Sets a pixel on the canvas, if it isn't already that colour.
+
+        :param x: The X (horizontal) co-ordinate of the target pixel
+        :param y: The Y (vertical) co-ordinate of the target pixel
+        :param colour: #hex000, optionally with an alpha channel
+        :param tolerance: How different (see lib.canvas.colour_distance) it can look and not need painting
+        :return:
+        """
+        if len(colour) == 8 and int(colour[6:], 16) <= TRANSPARENCY_THRESHOLD:
+            log.debug("DEBUG", "%s is transparent!", (x, y, colour))
+            return  # transparent
+        else:
+            colour = colour[:6]
+        pixel = await self.get_pixel(x, y)
+        if close_enough(pixel.hex, colour, tolerance):
+            log.debug("DEBUG", "%s is already painted.", (x, y, colour))
+            return
+        return await self.blind_set_pixel(x, y, colour)
+
+    async def _canvas_buffer(self, length: Optional[int], into: Optional[Canvas]) -> memoryview:
+        """
+        Works out where the next canvas download should go. See Api._canvas_buffer.
+
+        :param length: The Content-Length of the download, if known
+        :param into: The canvas to download into, if any
+        :return: memoryview - writable, and exactly the size of the canvas
+        """
+        if self.max_width is None or (length is not None and length != self.max_width * self.max_height * 3):
+            self.max_width, self.max_height = await self.get_size()
+        size = self.max_width * self.max_height * 3
+        if into is not None and into.array.nbytes == size and into.array.flags.c_contiguous:
+            return memoryview(into.array).cast("B")
+        if self._buffer is None or len(self._buffer) != size:
+            self._buffer = bytearray(size)
+        return memoryview(self._buffer)
+
+    async def snapshot(self, into: Canvas = None) -> Canvas:
+        """
+        Downloads the entire canvas into a buffer that's reused between calls. See Api.snapshot.
+
+        :param into: A full-size canvas to download into, instead of the shared buffer.
+        :return: Canvas - only valid until the next snapshot
+        """
+        async def read(response) -> Canvas:
+            view = await self._canvas_buffer(response.content_length, into)
+            filled = 0
+            async for chunk in response.content.iter_chunked(1 << 16):
+                end = min(filled + len(chunk), len(view))
+                view[filled:end] = memoryview(chunk)[:end - filled]
+                filled = end
+                if filled == len(view):
+                    break
+            if filled < len(view):
+                raise APIException(
+                    response.status, "Canvas download ended early.", message=f"{filled}/{len(view)} bytes"
+                )
+            return Canvas.from_bytes(view, (self.max_width, self.max_height))
+
+        status, canvas = await self._request("/get_pixels", return_content=read)
+        return canvas
+
+    async def get_pixels(self, resize_to: Tuple[int, int] = None) -> Image:
+        """
+        Downloads the entire canvas
+
+        :param resize_to: The width, height pair to resize to. If not provided, will not resize.
+        :return: PIL.Image
+        """
+        image = (await self.snapshot()).to_image()
+        if resize_to:
+            image = image.resize(resize_to, Image.NEAREST)
+        return image
+
+    async def sync_ratelimit(self, endpoint: str = "set_pixel"):
+        """
+        Sends a HEAD request to learn an endpoint's ratelimit state, without spending a real request on it.
+
+        :param endpoint: The endpoint to sync
+        :return:
+        """
+        log.debug("RATELIMITER", "Syncing ratelimit for %s.", endpoint, endpoint=endpoint)
+        await self._request("/"+endpoint.lower(), "HEAD")
+        log.debug("RATELIMITER", "Synced ratelimit for %s.", endpoint, endpoint=endpoint)
+
+
+def _check(endpoint: str, ratelimiter: RateLimiter, status: int, headers, body: str):
+    """
+    Learns the ratelimit state from a response, and raises if it isn't a success.
+
+    :param endpoint: The endpoint it answers, e.g. set_pixel
+    :param ratelimiter: The ratelimiter the request was sent under
+    :param status: The response's status code
+    :param headers: The response's headers
+    :param body: The response's body, for error messages. Only needed if it isn't a success.
+    :raises: APIException - or the subclass for that status code
+    """
+    if status in range(500, 600) and headers.get("requests-remaining") is None:
+        # Answered by something in front of the server (e.g. a proxy), so it never counted against our ratelimit.
+        ratelimiter.release(endpoint, refund=True)
+    else:
+        ratelimiter.update(endpoint, headers)
+
+    # Error handling
+    if status == 422:
+        raise AxisOutOfRange(status, body, message="Malformed request.")
+    if status in range(500, 600):  # server error:
+        raise APIOffline(status, f"Pixels server appears to be down.")
+    if status == 429:
+        raise Ratelimited(status, "Ratelimited.", message=body or None, cooldown=ratelimiter.delay(endpoint))
+    if status == 401:
+        raise Unauthorized(status, "Invalid token.", message=body or None)
+    if status == 403:
+        raise Forbidden(status, "Forbidden.", message=body or None)
+    if status not in (200, 304):  # 304 only ever answers a conditional request
+        raise APIException(status, "Unexpected response.", message=body or None)
+
+
+def _read_into(response: requests.Response, view: memoryview) -> int:
+    """
+    Fills a buffer from a streamed response's body.
+
+    :param response: The response, from a request made with stream=True
+    :param view: Where to put the body. It's filled completely.
+    :return: int - how many bytes were read
+    :raises: APIException - the body ended before the buffer was full
+    """
+    response.raw.decode_content = True
+    filled = 0
+    while filled < len(view):
+        read_bytes = response.raw.readinto(view[filled:])
+        if not read_bytes:
+            raise APIException(
+                response.status_code, "Canvas download ended early.", message=f"{filled}/{len(view)} bytes"
+            )
+        filled += read_bytes
+    return filled
 
 
 def get_pixels(img) -> List[Tuple[int, int, Tuple[int, int, int, int]]]:
     """
     Fetches an array of [x, y, (r, g, b, a)] in the image, with x, y being the x,y co-ords and rgb being the rgb values.
+    If you don't need the tuples, lib.image_process.to_array is much cheaper.
 
     :param img: the PIL.Image
     :return: List[Tuple[int, int, Tuple[int, int, int, int]]]
     """
-    pixels = []
-    for y in range(img.height):
-        for x in range(img.width):
-            pixels.append((x, y, img.getpixel((x, y))))
-    return pixels
+    array = numpy.asarray(img)
+    ys, xs = numpy.indices(array.shape[:2])
+    colours = array.reshape(img.width * img.height, -1).tolist()
+    if array.ndim == 2:  # single-band images give plain values, same as getpixel
+        colours = [c[0] for c in colours]
+    else:
+        colours = map(tuple, colours)
+    return list(zip(xs.ravel().tolist(), ys.ravel().tolist(), colours))
 
 
 def set_pixel(*at: int, colour: str, token: str, base: str = "https://pixels.pythondiscord.com"):
@@ -262,43 +611,55 @@ def set_pixel(*at: int, colour: str, token: str, base: str = "https://pixels.pyt
     :param base: The base API URL. You should change this in main.py if needs be, not here.
     :return: None
     """
-    if "dev" in sys.argv:
-        print(f"{Fore.RED}[DEBUG] {Fore.LIGHTBLACK_EX}Args for setting pixel: at={at} colour={colour} token={{no}}")
-    try:
+    log.debug("API", "Args for setting pixel: at=%s colour=%s token={no}", at, colour)
+
+    def attempt():
         preflight_response = requests.get(
-            base + "/get_pixel", params={"x": at[0], "y": at[1]}, headers={"Authorization": "Bearer " + token}
+            base + "/get_pixel", params={"x": at[0], "y": at[1]}, headers={"Authorization": "Bearer " + token},
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
         )
         handle_sane_ratelimit(preflight_response)
+        _raise_retryable(preflight_response)
         if preflight_response.json()["rgb"] == colour:
-            print(f"{Fore.CYAN}[API] {at} was already set. ignoring.")
-            return 300
+            log.debug("API", "%s was already set. Ignoring.", at)
+            return None
         response = requests.post(
             base + "/set_pixel",
             json={"x": at[0], "y": at[1], "rgb": colour},
             headers={"Authorization": "Bearer " + token},
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
         )
-    except (requests.HTTPError, requests.HTTPError, requests.RequestException):
-        print(f"{Fore.YELLOW}[WARNING] {Fore.WHITE}Exception while setting a pixel. Retrying in 5 seconds.")
-        time.sleep(5)
-        return set_pixel(*at, colour=colour, token=token)
-    handle_sane_ratelimit(response)
-    if response.status_code == 429:
-        # try again
-        print(f"{Fore.CYAN}[API] {Fore.LIGHTRED_EX}set_pixel call previously failed due to ratelimit. Retrying {at}.")
-        return set_pixel(*at, colour=colour, token=token)
+        handle_sane_ratelimit(response)
+        _raise_retryable(response)
+        return response
+
+    try:
+        response = RetryPolicy(breaker=CircuitBreaker.for_base(base)).call("set_pixel", attempt)
+    except (APIOffline, Ratelimited, *NETWORK_ERRORS):
+        log.log(logging.ERROR, "ERROR", "Giving up on setting %s, the server isn't answering.", at)
+        return -1
+    if response is None:
+        return 300
     if response.status_code != 200:
         if response.headers.get("content-type", "null") == "application/json":
-            print(
-                f"{Fore.RED}[ERROR] {Fore.LIGHTWHITE_EX}Non-200 pixel set code. "
-                f"Data:\n{json.dumps(response.json(), indent=2)}"
-            )
-            return -1
+            data = json.dumps(response.json(), indent=2)
         else:
-            print(f"{Fore.RED}[ERROR] {Fore.LIGHTWHITE_EX}Non-200 pixel set code. Data:\n{response.text}")
-            return -1
+            data = response.text
+        log.log(
+            logging.ERROR, "ERROR", "Non-200 pixel set code. Data:\n%s", data, status=response.status_code
+        )
+        return -1
     return 200
 
 
+def _raise_retryable(res: requests.Response):
+    """Turns the responses worth retrying (429s and 5xx) into exceptions, for RetryPolicy."""
+    if res.status_code == 429:  # handle_sane_ratelimit has already waited out the cooldown
+        raise Ratelimited(res.status_code, "Ratelimited.", cooldown=float(res.headers.get("cooldown-reset", 0)))
+    if res.status_code in range(500, 600):
+        raise APIOffline(res.status_code, "Pixels server appears to be down.")
+
+
 def handle_sane_ratelimit(res):
     """
     Handles ratelimits in a way that prevents getting 429s, but also handles actual 429s.
@@ -311,34 +672,34 @@ def handle_sane_ratelimit(res):
     """
     remaining = int(res.headers.get("requests-remaining", 0))
     if res.status_code == 429:
+        if res.headers.get("cooldown-reset") is None:
+            # Nothing to wait out, so it's left to the caller's RetryPolicy to back off (see _raise_retryable).
+            log.warning("RATELIMITER", "Ratelimited, without being told for how long.", cooldown="hard cooldown")
+            return
         reset = float(res.headers["cooldown-reset"])
-        print(
-            f"{Fore.CYAN}[RATELIMITER] {Fore.LIGHTRED_EX}On hard cooldown for",
-            reset,
-            "seconds.\nThis only really tends to happen if you're running multiple instances.\n"
-            "If you're unsure why you've got a 429, check:\n"
+        log.warning(
+            "RATELIMITER",
+            "On hard cooldown for %s seconds.\nThis only really tends to happen if the same token is used in multiple "
+            "places.\nIf you're unsure why you've got a 429, check:\n"
             "1. You haven't restarted the program while it was on a cooldown (it'll reset the handler)\n"
-            "2. You aren't running the program elsewhere\n"
+            "2. You aren't running the program elsewhere with the same token (use --auth more than once instead)\n"
             "3. Your token hasn't been leaked. If you believe it has, reset it ASAP.",
-            file=sys.stderr,
+            reset, cooldown="hard cooldown", wait=reset,
         )
         time.sleep(reset)
+        metrics.RATELIMIT_SLEEP_SECONDS.inc(reset, endpoint=endpoint_of(res.request.path_url))
     else:
         if remaining == 0:
             try:
                 reset = float(res.headers["requests-reset"])
             except KeyError:
-                headers_joined = "\n".join(f"{k}: {v}" for k, v in res.headers.items())
-                print(
-                    f"{Fore.RED}[DEBUG][RATELIMITER] {Fore.LIGHTBLACK_EX} A lack of ratelimit headers were sent:\n"
-                    + headers_joined
-                    + "\nGoing to ignore ratelimit handling for this request, and pray we haven't"
-                    " stumbled upon a hard limit."
+                log.debug(
+                    "RATELIMITER",
+                    "A lack of ratelimit headers were sent:\n%s\nGoing to ignore ratelimit handling for this request, "
+                    "and pray we haven't stumbled upon a hard limit.",
+                    "\n".join(f"{k}: {v}" for k, v in res.headers.items()),
                 )
                 return
-            print(
-                f"{Fore.CYAN}[RATELIMITER] {Fore.LIGHTYELLOW_EX}On soft cooldown for",
-                reset,
-                "seconds.",
-            )
+            log.debug("RATELIMITER", "On soft cooldown for %s seconds.", reset, cooldown="soft cooldown", wait=reset)
             time.sleep(reset)
+            metrics.RATELIMIT_SLEEP_SECONDS.inc(reset, endpoint=endpoint_of(res.request.path_url))
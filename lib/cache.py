@@ -0,0 +1,256 @@
+import fcntl
+import json
+import mmap
+import os
+import threading
+import time
+from contextlib import contextmanager
+from hashlib import sha256
+from pathlib import Path
+from tempfile import gettempdir
+from typing import Iterator, Optional, Tuple
+
+import numpy
+import requests
+
+from .api import CONNECT_TIMEOUT, READ_TIMEOUT, Api
+from .canvas import Canvas, Template, TRANSPARENCY_THRESHOLD
+from . import log
+
+# Shared between every painter on this machine. Each API base gets a raw RGB copy of its canvas (<key>.rgb), and
+# its metadata (<key>.json). Both are only ever replaced whole, so readers never see a half-written canvas.
+CACHE_DIR = Path(gettempdir()) / "pixels-cache"
+# Compiled templates, downloaded template images and what we know about their URLs.
+TEMPLATE_DIR = CACHE_DIR / "templates"
+
+
+def _replace(path: Path, data) -> None:
+    """
+    Writes a file so that nothing ever sees it half-written, even after a power cut: the data is synced to disk
+    before the rename, and the rename is synced before returning.
+    """
+    temp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(temp, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, path)
+    directory = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class CanvasCache:
+    """
+    A copy of the canvas on disk, shared between every process on this machine that paints on the same one.
+
+    The copy is only downloaded again once it's older than ttl, so any number of workers watching the same canvas
+    cost one /get_pixels per ttl between them. If the server sends an ETag, unchanged canvases aren't even downloaded.
+    Painters report their paints (see painted), so that none of them, restarted or not, trusts a copy from before them.
+    Canvases come back memory-mapped and read-only: use Canvas.copy() to get one that can be changed.
+
+    Attributes:
+        api: Api - what to download the canvas with
+        ttl: float - how old (in seconds) the copy can get before it's revalidated
+        path: Path - where the raw RGB copy lives. Its metadata is next to it, with a .json suffix.
+        fetched: float - when (time.time()) the canvas get last returned was fetched from the server
+    """
+
+    def __init__(self, api: Api, ttl: float = 5.0, directory: Path = CACHE_DIR):
+        self.api = api
+        self.ttl = ttl
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory / (sha256(api.base.encode()).hexdigest()[:16] + ".rgb")
+        self._meta_path = self.path.with_suffix(".json")
+        self._lock_path = self.path.with_suffix(".lock")
+        self._mapped: Optional[Canvas] = None
+        self._mapped_file = None  # (inode, mtime) of what's mapped
+        self.fetched = 0.0
+
+    def _read_meta(self) -> Optional[dict]:
+        try:
+            meta = json.loads(self._meta_path.read_text())
+        except (OSError, ValueError):
+            return None
+        try:
+            if self.path.stat().st_size != meta["width"] * meta["height"] * 3:
+                return None  # the canvas was replaced, but not its metadata yet
+        except (OSError, KeyError, TypeError):
+            return None
+        return meta
+
+    def _fresh(self, meta: Optional[dict], max_age: float, since: float) -> bool:
+        if meta is None or meta["fetched"] < max(since, meta.get("painted", 0.0)):
+            return False
+        return 0 <= time.time() - meta["fetched"] < max_age
+
+    def painted(self):
+        """
+        Records that a pixel has just been painted, so every painter sharing the copy downloads it again rather than
+        diffing against what was there before. Only written the first time for each copy, so it costs next to nothing.
+        """
+        meta = self._read_meta()
+        if meta is None or meta.get("painted", 0.0) >= meta["fetched"]:
+            return  # no copy, or it's already known to be out of date
+        with self._locked():
+            meta = self._read_meta()
+            if meta is None or meta.get("painted", 0.0) >= meta["fetched"]:
+                return
+            meta["painted"] = time.time()
+            _replace(self._meta_path, json.dumps(meta).encode())
+
+    def _map(self, meta: dict) -> Canvas:
+        self.fetched = meta["fetched"]
+        with open(self.path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            if self._mapped is not None and self._mapped_file == (stat.st_ino, stat.st_mtime_ns):
+                return self._mapped  # the same file we've already got mapped
+            # The mapping outlives the file descriptor, and the file it maps survives being replaced.
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped = Canvas.from_bytes(data, (meta["width"], meta["height"]))
+        self._mapped_file = (stat.st_ino, stat.st_mtime_ns)
+        return self._mapped
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(self._lock_path, "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def peek(self) -> Optional[Canvas]:
+        """
+        :return: Canvas - whatever copy is on disk, however old (see fetched), without downloading anything. None if
+            there isn't one.
+        """
+        meta = self._read_meta()
+        return self._map(meta) if meta is not None else None
+
+    def get(self, max_age: float = None, since: float = 0.0) -> Canvas:
+        """
+        Fetches the canvas, from disk if the copy there is recent enough.
+
+        :param max_age: How old (in seconds) the copy can be. Defaults to ttl. 0 always revalidates.
+        :param since: A time.time() the copy has to have been fetched after, e.g. when we last painted something.
+        :return: Canvas - read-only
+        """
+        max_age = self.ttl if max_age is None else max_age
+        meta = self._read_meta()
+        if self._fresh(meta, max_age, since):
+            return self._map(meta)
+
+        with self._locked():
+            # Whoever held the lock before us has probably just downloaded it.
+            meta = self._read_meta()
+            if self._fresh(meta, max_age, since):
+                return self._map(meta)
+            # Counted from when we asked, not when it arrived, since the canvas could have changed in the meantime.
+            fetched = time.time()
+            canvas = self.api.snapshot(etag=meta and meta.get("etag"))
+            if canvas is None:  # not modified
+                log.debug("CACHE", "Cached canvas is still current.")
+                meta = dict(meta, fetched=fetched)
+                meta.pop("painted", None)  # from before fetched, or it'd still be stale
+            else:
+                _replace(self.path, canvas.array)
+                meta = {"width": canvas.width, "height": canvas.height, "fetched": fetched, "etag": self.api.etag}
+            _replace(self._meta_path, json.dumps(meta).encode())
+            return self._map(meta)
+
+
+class TemplateCache:
+    """
+    Compiled templates on disk, so a template only has to be decoded and resized once per size.
+
+    A compiled template is the resized (height, width, 4) RGBA buffer followed by its (height, width) paint mask, in
+    one file keyed by a hash of the source image and the size it was resized to. Loading one is a single mmap.
+    Images from URLs are kept too, and only downloaded again if the server says they've changed.
+
+    Attributes:
+        directory: Path - where everything is kept
+    """
+
+    def __init__(self, directory: Path = TEMPLATE_DIR):
+        self.directory = directory
+        directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(data: bytes, *options: str) -> str:
+        """
+        :param data: The source image's bytes
+        :param options: Anything else that changes how it's compiled, e.g. a palette
+        :return: str - what its compiled templates are stored under
+        """
+        digest = sha256(data)
+        for option in options:
+            digest.update(b"\0" + option.encode())
+        return digest.hexdigest()[:32]
+
+    def _compiled_path(self, key: str, size: Tuple[int, int]) -> Path:
+        return self.directory / "{}-{}x{}.template".format(key, *size)
+
+    def download(self, url: str) -> bytes:
+        """
+        Downloads an image, unless the copy we already have is still current.
+
+        :param url: Where the image is
+        :return: bytes - the image
+        """
+        name = sha256(url.encode()).hexdigest()[:32]
+        source, meta_path = self.directory / (name + ".src"), self.directory / (name + ".json")
+        headers = {}
+        try:
+            meta = json.loads(meta_path.read_text())
+            if source.exists():
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+        except (OSError, ValueError):
+            pass
+
+        response = requests.get(url, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        if response.status_code == 304:
+            log.debug("CACHE", "Template image hasn't changed.", url=url)
+            return source.read_bytes()
+        response.raise_for_status()
+        assert response.headers["Content-Type"].startswith("image/"), "Incorrect image type."
+        _replace(source, response.content)
+        meta = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+        _replace(meta_path, json.dumps(meta).encode())
+        return response.content
+
+    def load(self, key: str, size: Tuple[int, int]) -> Optional[Template]:
+        """
+        :param key: From TemplateCache.key
+        :param size: The width, height it was resized to
+        :return: Template - read-only, or None if it hasn't been compiled yet
+        """
+        width, height = size
+        try:
+            with open(self._compiled_path(key, size), "rb") as file:
+                if os.fstat(file.fileno()).st_size != width * height * 5:
+                    return None
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # ValueError: mmap doesn't like empty files
+            return None
+        array = numpy.frombuffer(data, numpy.uint8, width * height * 4).reshape(height, width, 4)
+        mask = numpy.frombuffer(data, numpy.bool_, width * height, width * height * 4).reshape(height, width)
+        return Template(array, mask=mask)
+
+    def store(self, key: str, array: numpy.ndarray) -> Template:
+        """
+        Compiles a resized template, and saves it.
+
+        :param key: From TemplateCache.key
+        :param array: The resized (height, width, 4) RGBA buffer
+        :return: Template
+        """
+        mask = array[..., 3] > TRANSPARENCY_THRESHOLD
+        size = (array.shape[1], array.shape[0])
+        _replace(self._compiled_path(key, size), numpy.ascontiguousarray(array).tobytes() + mask.tobytes())
+        return Template(array, mask=mask)
@@ -0,0 +1,343 @@
+from typing import Iterator, List, Mapping, Tuple, Union
+
+import numpy
+from PIL import Image
+
+TRANSPARENCY_THRESHOLD = 0x55  # alpha values at or below this are treated as transparent and never painted
+
+
+def parse_colour(colour: str) -> Tuple[int, int, int]:
+    """
+    Turns a hex colour into an (r, g, b) tuple. Any alpha channel is ignored.
+
+    :param colour: rrggbb, optionally with a leading # or trailing aa
+    :return: Tuple[int, int, int]
+    """
+    colour = colour.lstrip("#")
+    return int(colour[0:2], 16), int(colour[2:4], 16), int(colour[4:6], 16)
+
+
+def colour_distance(a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+    """
+    Roughly how different two sets of colours look, using the "redmean" weighting of RGB distance.
+
+    :param a: (..., 3+) of RGB values
+    :param b: (..., 3+) of RGB values, the same shape as a
+    :return: numpy.ndarray - (...) of distances, from 0 (identical) to about 765 (black vs white)
+    """
+    a = a[..., :3].astype(numpy.float32)
+    b = b[..., :3].astype(numpy.float32)
+    redmean = (a[..., 0] + b[..., 0]) / 2
+    dr, dg, db = (a - b).transpose(-1, *range(a.ndim - 1))
+    return numpy.sqrt((2 + redmean / 256) * dr * dr + 4 * dg * dg + (2 + (255 - redmean) / 256) * db * db)
+
+
+def close_enough(a: str, b: str, tolerance: float = 0.0) -> bool:
+    """
+    :param a: A hex colour. Any alpha channel is ignored.
+    :param b: Another
+    :param tolerance: How different (see colour_distance) they can look and still count as the same
+    :return: bool - whether they count as the same colour
+    """
+    if not tolerance:
+        return a[:6].lower() == b[:6].lower()
+    return float(colour_distance(numpy.array(parse_colour(a)), numpy.array(parse_colour(b)))) <= tolerance
+
+
+class PixelView:
+    """
+    A single pixel of a Canvas or Template. It holds no colour data itself, it just points into the owner's buffer.
+
+    Attributes:
+        x: int - the X (horizontal) co-ordinate, relative to the owner
+        y: int - the Y (vertical) co-ordinate, relative to the owner
+    """
+
+    __slots__ = ("_array", "x", "y")
+
+    def __init__(self, array: numpy.ndarray, x: int, y: int):
+        self._array = array
+        self.x = x
+        self.y = y
+
+    def __repr__(self):
+        return "<PixelView x={0.x} y={0.y} rgb={0.rgb!r}>".format(self)
+
+    @property
+    def colour(self) -> Tuple[int, int, int]:
+        return tuple(self._array[self.y, self.x, :3].tolist())
+
+    @property
+    def alpha(self) -> int:
+        if self._array.shape[2] == 4:
+            return int(self._array[self.y, self.x, 3])
+        return 255
+
+    @property
+    def rgb(self) -> str:
+        return "%02x%02x%02x" % self.colour
+
+    @rgb.setter
+    def rgb(self, value: str):
+        self._array[self.y, self.x, :3] = parse_colour(value)
+
+    hex = rgb
+
+
+class Canvas:
+    """
+    An RGB image held in one contiguous (height, width, 3) buffer, like the one /get_pixels sends.
+
+    Crops are views into the same buffer, so they're free to make, and writing to one writes to the other.
+
+    Attributes:
+        array: numpy.ndarray - the (height, width, 3) uint8 buffer
+        x: int - where the left edge of this canvas sits on the full canvas (non-zero for crops)
+        y: int - where the top edge of this canvas sits on the full canvas (non-zero for crops)
+    """
+
+    __slots__ = ("array", "x", "y")
+
+    def __init__(self, array: numpy.ndarray, x: int = 0, y: int = 0):
+        self.array = array
+        self.x = x
+        self.y = y
+
+    def __repr__(self):
+        return "<Canvas x={0.x} y={0.y} width={0.width} height={0.height}>".format(self)
+
+    @classmethod
+    def blank(cls, width: int, height: int, colour: str = "ffffff") -> "Canvas":
+        array = numpy.empty((height, width, 3), numpy.uint8)
+        array[...] = parse_colour(colour)
+        return cls(array)
+
+    @classmethod
+    def from_bytes(cls, data: Union[bytes, bytearray, memoryview], size: Tuple[int, int]) -> "Canvas":
+        """
+        Wraps raw RGB bytes (e.g. from /get_pixels) without copying them.
+        The canvas will be read-only if the data is (e.g. bytes).
+
+        :param data: The raw bytes
+        :param size: The width, height of the canvas
+        :return: Canvas
+        """
+        width, height = size
+        return cls(numpy.frombuffer(data, numpy.uint8, width * height * 3).reshape(height, width, 3))
+
+    @classmethod
+    def from_image(cls, image: Image) -> "Canvas":
+        return cls(numpy.array(image.convert("RGB")))
+
+    @property
+    def width(self) -> int:
+        return self.array.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.array.shape[0]
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.width, self.height
+
+    def __getitem__(self, key: Tuple[int, int]) -> PixelView:
+        x, y = key
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError(key)
+        return PixelView(self.array, x, y)
+
+    def crop(self, x0: int, y0: int, x1: int, y1: int) -> "Canvas":
+        """
+        Cuts out a rectangle of the canvas without copying anything. The rectangle is clipped to the canvas' bounds.
+
+        :param x0: The left edge, in full-canvas co-ordinates
+        :param y0: The top edge, in full-canvas co-ordinates
+        :param x1: The right edge (exclusive)
+        :param y1: The bottom edge (exclusive)
+        :return: Canvas - a view into this canvas
+        """
+        x0, x1 = (min(max(v - self.x, 0), self.width) for v in (x0, x1))
+        y0, y1 = (min(max(v - self.y, 0), self.height) for v in (y0, y1))
+        return Canvas(self.array[y0:y1, x0:x1], self.x + x0, self.y + y0)
+
+    def update(self, x: int, y: int, pixels: Union["Canvas", numpy.ndarray]):
+        """
+        Overwrites a rectangle of the canvas in place.
+
+        :param x: Where the left edge of pixels goes, in full-canvas co-ordinates
+        :param y: Where the top edge of pixels goes, in full-canvas co-ordinates
+        :param pixels: The (height, width, 3) pixels to write, or another canvas
+        """
+        if isinstance(pixels, Canvas):
+            pixels = pixels.array
+        height, width = pixels.shape[:2]
+        self.array[y - self.y:y - self.y + height, x - self.x:x - self.x + width] = pixels[..., :3]
+
+    def set(self, x: int, y: int, colour: str):
+        """
+        Sets a single pixel in place, e.g. after painting it.
+
+        :param x: The X co-ordinate, in full-canvas co-ordinates
+        :param y: The Y co-ordinate, in full-canvas co-ordinates
+        :param colour: The hex colour
+        """
+        self.array[y - self.y, x - self.x] = parse_colour(colour)
+
+    def copy(self) -> "Canvas":
+        return Canvas(self.array.copy(), self.x, self.y)
+
+    def to_image(self) -> Image:
+        # PIL keeps RGB images padded out to 4 bytes a pixel, so this is always a copy. Use array for a view.
+        return Image.fromarray(numpy.ascontiguousarray(self.array), "RGB")
+
+
+class Template(Mapping):
+    """
+    An image to paint, held as one (height, width, 4) RGBA buffer, along with where it goes on the canvas.
+
+    It can still be used as a read-only mapping of (x, y): hex (rrggbbaa, or rrggbb with rgba=False) in template
+    co-ordinates, like the dict map_pixels used to build. Hex strings are only made for the pixels that are looked up.
+
+    Attributes:
+        array: numpy.ndarray - the (height, width, 4) uint8 buffer
+        x: int - where the left edge of the template goes on the canvas
+        y: int - where the top edge of the template goes on the canvas
+        rgba: bool - whether looked up hex strings include the alpha channel
+        tolerance: float - how different (see colour_distance) a pixel can look and still count as right
+    """
+
+    __slots__ = ("array", "x", "y", "rgba", "tolerance", "_mask")
+
+    def __init__(
+            self,
+            array: numpy.ndarray,
+            x: int = 0,
+            y: int = 0,
+            *,
+            rgba: bool = True,
+            mask: numpy.ndarray = None,
+            tolerance: float = 0.0
+    ):
+        self.array = array
+        self.x = x
+        self.y = y
+        self.rgba = rgba
+        self.tolerance = tolerance
+        self._mask = mask  # precomputed (e.g. by a compiled template), otherwise worked out from the alpha channel
+
+    def __repr__(self):
+        return "<Template x={0.x} y={0.y} width={0.width} height={0.height}>".format(self)
+
+    @classmethod
+    def from_image(cls, image: Image, x: int = 0, y: int = 0) -> "Template":
+        return cls(numpy.asarray(image.convert("RGBA")), x, y)
+
+    @property
+    def width(self) -> int:
+        return self.array.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.array.shape[0]
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.width, self.height
+
+    @property
+    def mask(self) -> numpy.ndarray:
+        """(height, width) of booleans - which pixels are opaque enough to be painted."""
+        if self._mask is not None:
+            return self._mask
+        return self.array[..., 3] > TRANSPARENCY_THRESHOLD
+
+    def __getitem__(self, key: Tuple[int, int]) -> str:
+        x, y = key
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise KeyError(key)
+        if self.rgba:
+            return "%02x%02x%02x%02x" % tuple(self.array[y, x].tolist())
+        return "%02x%02x%02x" % tuple(self.array[y, x, :3].tolist())
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        # Row-major, same as the old dict.
+        for y in range(self.height):
+            for x in range(self.width):
+                yield x, y
+
+    def __len__(self) -> int:
+        return self.width * self.height
+
+    def coords(self) -> numpy.ndarray:
+        """
+        :return: numpy.ndarray - (N, 2) of every x, y in the template, in row-major order
+        """
+        ys, xs = numpy.indices((self.height, self.width))
+        return numpy.stack((xs.ravel(), ys.ravel()), axis=1)
+
+    def pixel(self, x: int, y: int) -> PixelView:
+        """
+        :param x: The X co-ordinate, in template co-ordinates
+        :param y: The Y co-ordinate, in template co-ordinates
+        :return: PixelView
+        """
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError((x, y))
+        return PixelView(self.array, x, y)
+
+    def crop(self, x0: int, y0: int, x1: int, y1: int) -> "Template":
+        """
+        Cuts out a rectangle of the template without copying anything. The rectangle is clipped to the template.
+
+        :param x0: The left edge, in canvas co-ordinates
+        :param y0: The top edge, in canvas co-ordinates
+        :param x1: The right edge (exclusive)
+        :param y1: The bottom edge (exclusive)
+        :return: Template - a view into this template
+        """
+        x0, x1 = (min(max(v - self.x, 0), self.width) for v in (x0, x1))
+        y0, y1 = (min(max(v - self.y, 0), self.height) for v in (y0, y1))
+        mask = self._mask[y0:y1, x0:x1] if self._mask is not None else None
+        return Template(
+            self.array[y0:y1, x0:x1], self.x + x0, self.y + y0, rgba=self.rgba, mask=mask, tolerance=self.tolerance
+        )
+
+    def mismatches(self, pixels: numpy.ndarray) -> numpy.ndarray:
+        """
+        Finds the paintable pixels that something else (e.g. the canvas under the template) gets wrong.
+
+        :param pixels: (height, width, 3+) of RGB values, the same size as this template
+        :return: numpy.ndarray - (height, width) of booleans, True where a pixel needs painting
+        """
+        if self.tolerance:
+            differs = colour_distance(self.array, pixels) > self.tolerance
+        else:
+            differs = (self.array[..., :3] != pixels[..., :3]).any(axis=2)
+        return self.mask & differs
+
+    def diff(self, canvas: Canvas) -> numpy.ndarray:
+        """
+        Finds the paintable pixels of this template that don't match the canvas (within tolerance).
+        Pixels that fall outside of the canvas (or the crop of it) are never included.
+
+        :param canvas: The canvas, or a crop of it
+        :return: numpy.ndarray - (N, 2) of x, y in template co-ordinates, in row-major order
+        """
+        region = canvas.crop(self.x, self.y, self.x + self.width, self.y + self.height)
+        template = self.crop(region.x, region.y, region.x + region.width, region.y + region.height)
+        ys, xs = numpy.nonzero(template.mismatches(region.array))
+        return numpy.stack((xs + (region.x - self.x), ys + (region.y - self.y)), axis=1)
+
+    def targets(self, coords: numpy.ndarray) -> List[Tuple[int, int, str]]:
+        """
+        Turns template co-ordinates (e.g. from diff) into what needs sending to set_pixel.
+
+        :param coords: (N, 2) of x, y in template co-ordinates
+        :return: List[Tuple[int, int, str]] - (x, y, rrggbb) in canvas co-ordinates
+        """
+        xs, ys = coords[:, 0], coords[:, 1]
+        return [
+            (x + self.x, y + self.y, "%02x%02x%02x" % tuple(rgb))
+            for x, y, rgb in zip(xs.tolist(), ys.tolist(), self.array[ys, xs, :3].tolist())
+        ]
@@ -0,0 +1,121 @@
+import threading
+import time
+from hashlib import sha256
+from pathlib import Path
+
+import numpy
+
+from . import log
+from .cache import CACHE_DIR, _replace
+from .canvas import Template
+
+# One file per template, position and canvas: a bit per template pixel, set once it's done.
+CHECKPOINT_DIR = CACHE_DIR / "checkpoints"
+
+
+class Checkpoint:
+    """
+    Remembers which pixels of a template are done (painted, or checked and already the right colour), on disk, so a
+    paint that's restarted or crashes carries on where it stopped, instead of checking every pixel again.
+
+    Pixels are marked in memory, and written out every batch pixels or interval seconds, whichever comes first, so a
+    crash costs at most that many pixels being checked again. Files are only ever replaced whole, and synced to disk
+    first (see lib.cache._replace), so a crash or power cut while writing one leaves the last one intact.
+
+    Attributes:
+        template: Template - what's being painted
+        path: Path - where the checkpoint is kept
+        done: numpy.ndarray - (height, width) of booleans, True where the pixel is done
+        batch: int - how many pixels to mark between writes, at most
+        interval: float - how long to leave it between writes, at most, in seconds
+    """
+
+    def __init__(
+            self,
+            template: Template,
+            base: str,
+            directory: Path = CHECKPOINT_DIR,
+            batch: int = 64,
+            interval: float = 5.0
+    ):
+        self.template = template
+        self.batch = batch
+        self.interval = interval
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory / (self.key(template, base) + ".done")
+        self.done = numpy.zeros((template.height, template.width), bool)
+        self._dirty = 0
+        self._written = time.monotonic()
+        self._lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def key(template: Template, base: str) -> str:
+        """
+        :param template: What's being painted
+        :param base: The API base URL, since each server has its own canvas
+        :return: str - what identifies the template's checkpoint. Changes if the template changes in any way.
+        """
+        digest = sha256(base.encode())
+        digest.update(("%d,%d,%d,%d" % (template.x, template.y, template.width, template.height)).encode())
+        digest.update(numpy.ascontiguousarray(template.array).tobytes())
+        digest.update(numpy.packbits(template.mask).tobytes())
+        return digest.hexdigest()[:16]
+
+    def __len__(self) -> int:
+        return int(self.done.sum())
+
+    def load(self) -> int:
+        """
+        Reads the checkpoint back from disk, if there is one.
+
+        :return: int - how many pixels it says are done
+        """
+        try:
+            data = self.path.read_bytes()
+        except FileNotFoundError:
+            return 0
+        size = self.done.size
+        if len(data) != (size + 7) // 8:
+            log.warning("CHECKPOINT", "Ignoring %s, which isn't the right size for this template.", self.path)
+            return 0
+        bits = numpy.unpackbits(numpy.frombuffer(data, numpy.uint8), count=size)
+        self.done = bits.astype(bool).reshape(self.done.shape)
+        return len(self)
+
+    def remaining(self, coords: numpy.ndarray) -> numpy.ndarray:
+        """
+        :param coords: (N, 2) of x, y in template co-ordinates, e.g. from Template.coords
+        :return: numpy.ndarray - just the ones that aren't done yet
+        """
+        return coords[~self.done[coords[:, 1], coords[:, 0]]]
+
+    def mark(self, x: int, y: int):
+        """
+        Records a pixel as done, and writes the checkpoint out if it's due.
+
+        :param x: The X co-ordinate, in canvas co-ordinates
+        :param y: The Y co-ordinate, in canvas co-ordinates
+        """
+        with self._lock:
+            self.done[y - self.template.y, x - self.template.x] = True
+            self._dirty += 1
+            due = self._dirty >= self.batch or time.monotonic() - self._written >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Writes out anything marked since the last write."""
+        with self._lock:
+            if not self._dirty:
+                return
+            _replace(self.path, numpy.packbits(self.done).tobytes())
+            self._dirty = 0
+            self._written = time.monotonic()
+
+    def clear(self):
+        """Forgets every pixel, e.g. once they're all done, so the next paint checks everything again."""
+        with self._lock:
+            self.done[:] = False
+            self._dirty = 0
+            self.path.unlink(missing_ok=True)
@@ -1,8 +1,9 @@
 import sys
 import os
 from subprocess import run, DEVNULL, PIPE
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 from pathlib import Path
+from typing import List
 from .kool import Fore
 
 
@@ -57,7 +58,7 @@ parser.add_argument(
     "-Q",
     action="store_true",
     default=False,
-    help="If enabled, will only show pixels that've been painted (minus warnings and errors)",
+    help="If enabled, will only show warnings and errors.",
 )
 parser.add_argument(
     "--image",
@@ -107,9 +108,11 @@ parser.add_argument(
     "--auth",
     "--token",
     "-A",
-    action="store",
+    action="append",
     default=None,
-    help="Your API token from https://pixels.pythondiscord.com/show_token",
+    help="Your API token from https://pixels.pythondiscord.com/show_token. "
+         "Pass it more than once to paint with several tokens at once.",
+    dest="tokens",
 )
 parser.add_argument(
     "--base", "--api-url", action="store", default="https://pixels.dragdev.xyz", help="The base API url."
@@ -128,7 +131,7 @@ parser.add_argument(
     "-F",
     action="store_true",
     default=False,
-    help="If not enabled, this will force the program to lock it's PID.",
+    help="If not enabled, this will stop other instances from using the same token(s) at the same time.",
     dest="force"
 )
 parser.add_argument(
@@ -137,6 +140,170 @@ parser.add_argument(
     default=False,
     help="Shows the version and exits."
 )
+parser.add_argument(
+    "--diff",
+    "-d",
+    action="store_true",
+    default=False,
+    help="Downloads the canvas once per run and only paints the pixels that differ, instead of checking each pixel.",
+)
+parser.add_argument(
+    "--protect",
+    "-P",
+    action="store_true",
+    default=False,
+    help="Runs forever, repairing any damage to the image as soon as it's seen on the canvas.",
+)
+parser.add_argument(
+    "--refresh-interval",
+    action="store",
+    default=10.0,
+    type=float,
+    help="How often (in seconds) --protect should check the canvas for damage.",
+    dest="interval",
+)
+parser.add_argument(
+    "--adaptive-refresh",
+    action="store_true",
+    default=False,
+    help="Makes --protect check the canvas as often as the ratelimit allows while it's being damaged, and less and "
+         "less often (up to --max-refresh-interval) while it isn't, instead of every --refresh-interval seconds.",
+    dest="adaptive_refresh",
+)
+parser.add_argument(
+    "--max-refresh-interval",
+    action="store",
+    default=60.0,
+    type=float,
+    help="The longest (in seconds) --adaptive-refresh leaves it between checks.",
+    dest="max_interval",
+)
+parser.add_argument(
+    "--strategy",
+    action="store",
+    default=None,
+    help="What order to paint pixels in: row-major, most-visible, outline-first, oldest-first or random. "
+         "Defaults to row-major when painting, and oldest-first when protecting.",
+)
+parser.add_argument(
+    "--workspace",
+    "-W",
+    action="store",
+    default=None,
+    type=path_like,
+    help="A JSON file of several templates (with positions, priorities and masks) to paint or protect together, "
+         "instead of one image. See README.md.",
+)
+parser.add_argument(
+    "--palette",
+    action="store",
+    default=None,
+    help="Redraws the image in just these colours before painting: pico-8, greyscale, web-safe, comma-separated hex "
+         "colours, or the path to an image to take the colours from.",
+)
+parser.add_argument(
+    "--dither",
+    action="store",
+    default="none",
+    choices=("none", "ordered", "floyd-steinberg"),
+    help="How to spread out the difference between the image and the --palette colours, so gradients stay smooth.",
+)
+parser.add_argument(
+    "--tolerance",
+    action="store",
+    default=0.0,
+    type=float,
+    help="How different a pixel can look from the image (0 to about 765) and still count as painted. "
+         "Around 20 is hard to tell apart.",
+)
+parser.add_argument(
+    "--no-resume",
+    action="store_false",
+    default=True,
+    help="Starts painting from the first pixel again, instead of carrying on from where the last run stopped.",
+    dest="resume",
+)
+parser.add_argument(
+    "--pipeline",
+    action="store",
+    default=0,
+    type=int,
+    help="Keeps up to this many requests per endpoint in flight at once, so slow round trips don't hold painting up. "
+         "Only used with a single token.",
+    metavar="DEPTH",
+)
+parser.add_argument(
+    "--cache-ttl",
+    action="store",
+    default=5.0,
+    type=float,
+    help="How old (in seconds) the on-disk copy of the canvas can get before it's downloaded again. "
+         "It's shared by every painter on this machine.",
+    dest="cache_ttl",
+)
+parser.add_argument(
+    "--log-format",
+    action="store",
+    default="text",
+    choices=("text", "json"),
+    help="How to show what's going on: coloured text, or one JSON object per line for other programs to read.",
+    dest="log_format",
+)
+parser.add_argument(
+    "--progress-interval",
+    action="store",
+    default=5.0,
+    type=float,
+    help="How often (in seconds) to summarise painting progress. Every pixel is only shown with --verbose.",
+    dest="progress_interval",
+)
+parser.add_argument(
+    "--metrics-port",
+    action="store",
+    default=None,
+    type=int,
+    help="Serves metrics (request latencies, ratelimit waits, pixels painted...) for Prometheus on this local port.",
+    dest="metrics_port",
+)
+parser.add_argument(
+    "--metrics-json",
+    action="store",
+    default=None,
+    help='Writes metrics as one line of JSON every --metrics-interval seconds, to this file ("-" for stdout).',
+    dest="metrics_json",
+)
+parser.add_argument(
+    "--metrics-interval",
+    action="store",
+    default=10.0,
+    type=float,
+    help="How often (in seconds) --metrics-json writes a line.",
+    dest="metrics_interval",
+)
+parser.add_argument(
+    "--control",
+    action="store",
+    default=None,
+    type=Path,
+    help="Serves status, a preview and pause/resume/prioritize commands over HTTP on a Unix socket at this path.",
+    metavar="SOCKET",
+)
+parser.add_argument(
+    "--journal",
+    action="store",
+    default=None,
+    type=Path,
+    help="Keeps a history of the canvas in this directory, so it can be looked back at later (see misc/journal.py).",
+    metavar="DIR",
+)
+parser.add_argument(
+    "--journal-interval",
+    action="store",
+    default=10.0,
+    type=float,
+    help="How often (in seconds) --journal saves the canvas. Unchanged canvases aren't saved again.",
+    dest="journal_interval",
+)
 parser.add_argument(
     "--download-canvas",
     "-D",
@@ -146,23 +313,45 @@ parser.add_argument(
     dest="download"
 )
 
-arguments = parser.parse_args()
+# Just the defaults until parse() is called, so importing lib never touches sys.argv.
+arguments = parser.parse_args([])
+arguments.auth = None
+
+
+def parse(argv: List[str] = None) -> Namespace:
+    """
+    Parses the command line into arguments, and works out which tokens to use.
+
+    arguments is updated in place, so anything that imported it before this was called sees the parsed values too.
+
+    :param argv: The arguments to parse. Defaults to sys.argv.
+    :return: Namespace - arguments
+    """
+    parsed = parser.parse_args(argv)
+
+    if parsed.version:
+        res = run(["git", "rev-parse", "--short", "HEAD"], stderr=DEVNULL, stdout=PIPE)
+        out = res.stdout.decode().strip()
+        assert len(out) <= 8, f"Version '{out!r}' too long."
+        print(f"Pixels Revision '{out}'")
+        sys.exit(0)
+
+    if not parsed.tokens:
+        if not os.path.exists("./auth.txt"):
+            print(Fore.RED + "You have not provided an authentication token. Please read the README.")
+            sys.exit(4)
+
+        with open("./auth.txt") as auth:
+            # One token per line
+            parsed.tokens = [line.strip() for line in auth if line.strip()]
+        if not parsed.tokens:
+            print(Fore.RED + "auth.txt is empty. Please read the README.")
+            sys.exit(4)
+    parsed.auth = parsed.tokens[0]
 
-if not arguments.auth:
-    if not os.path.exists("./auth.txt"):
-        print(Fore.RED + "You have not provided an authentication token. Please read the README.")
-        sys.exit(4)
+    vars(arguments).update(vars(parsed))
+    return arguments
 
-    with open("./auth.txt") as auth:
-        token = auth.read().strip()
-    arguments.auth = token
 
 if __name__ == "__main__":
-    print(arguments)
-
-if arguments.version:
-    res = run(["git", "rev-parse", "--short", "HEAD"], stderr=DEVNULL, stdout=PIPE)
-    out = res.stdout.decode().strip()
-    assert len(out) <= 8, f"Version '{out!r}' too long."
-    print(f"Pixels Revision '{out}'")
-    sys.exit(0)
+    print(parse())
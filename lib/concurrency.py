@@ -1,26 +1,104 @@
+import atexit
+import fcntl
+import json
 import os
+from argparse import Namespace
+from contextlib import contextmanager
+from hashlib import sha256
 from tempfile import gettempdir
 from pathlib import Path
-from .cli import arguments
+from typing import Dict, Iterable, Iterator
 
-if arguments.force:
-    print("YOU ARE IGNORING THE PROGRAM CONCURRENCY CHECKER! RATELIMITS MAY BE HIT UNEXPECTEDLY.")
-else:
-    tmp = Path(gettempdir())
-    lockfile = tmp / "pixels.lock"
+from . import log
 
-    if os.path.exists(lockfile):
-        with open(lockfile) as old_lockfile:
-            old_pid = int(old_lockfile.read())
+# Shared between every painter on this machine. It maps a fingerprint of each token in use to the PID using it,
+# and is only ever read or written while holding an exclusive flock on it.
+LOCKFILE = Path(gettempdir()) / "pixels.lock"
 
+
+def fingerprint(token: str) -> str:
+    """
+    Identifies a token without writing the token itself to disk.
+
+    :param token: The API token
+    :return: str
+    """
+    return sha256(token.encode()).hexdigest()[:16]
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except OSError:  # Dead process
+        return False
+    return True
+
+
+@contextmanager
+def _leases() -> Iterator[Dict[str, int]]:
+    with open(LOCKFILE, "a+") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
         try:
-            os.kill(old_pid, 0)
-        except OSError:  # Dead process
-            os.remove(lockfile)
-        else:
-            # process is still active
-            raise RuntimeError(f"Pixels painter is already running elsewhere. It is running under PID {old_pid}.")
-
-    lockfile.touch()
-    with open(lockfile, "w") as opened_lockfile:
-        opened_lockfile.write(str(os.getpid()))
+            lockfile.seek(0)
+            try:
+                leases = json.loads(lockfile.read() or "{}")
+            except ValueError:
+                leases = {}
+            if not isinstance(leases, dict):  # e.g. a lockfile from an older version, which just held a PID
+                leases = {}
+            yield leases
+            lockfile.seek(0)
+            lockfile.truncate()
+            json.dump(leases, lockfile)
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def lease(tokens: Iterable[str]):
+    """
+    Claims tokens for this process, so no other painter on this machine can use them at the same time (and blow
+    through their ratelimits). They're released automatically when the process exits.
+
+    :param tokens: The API tokens to claim
+    :raises: RuntimeError - one of the tokens is already in use by another running painter
+    """
+    tokens = list(tokens)
+    pid = os.getpid()
+    with _leases() as leases:
+        for token in tokens:
+            holder = leases.get(fingerprint(token))
+            if holder is not None and holder != pid and _alive(holder):
+                raise RuntimeError(
+                    f"Token {fingerprint(token)} is already in use by a painter running under PID {holder}."
+                )
+        for token in tokens:
+            leases[fingerprint(token)] = pid
+    atexit.register(release, tokens)
+
+
+def release(tokens: Iterable[str]):
+    """
+    Gives up this process' claim on some tokens.
+
+    :param tokens: The API tokens to release
+    """
+    pid = os.getpid()
+    with _leases() as leases:
+        for token in tokens:
+            if leases.get(fingerprint(token)) == pid:
+                del leases[fingerprint(token)]
+
+
+def check(arguments: Namespace):
+    """
+    Runs the concurrency check for the parsed command line: claims its tokens, unless --force was passed.
+
+    :param arguments: The parsed command line, from lib.cli.parse
+    :raises: RuntimeError - one of the tokens is already in use by another running painter
+    """
+    if arguments.force:
+        log.warning(
+            "CONCURRENCY", "YOU ARE IGNORING THE PROGRAM CONCURRENCY CHECKER! RATELIMITS MAY BE HIT UNEXPECTEDLY."
+        )
+    else:
+        lease(arguments.tokens)
@@ -0,0 +1,318 @@
+import asyncio
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy
+from PIL import Image
+
+from . import log, metrics
+from .cache import CanvasCache
+from .canvas import Canvas, Template
+from .scheduler import Focused, Scheduler, get_scheduler
+
+CURSOR_COLOUR = numpy.array([255, 0, 0], numpy.uint8)
+DAMAGE_COLOUR = numpy.array([255, 0, 255], numpy.uint8)
+MAX_PREVIEW_SCALE = 16  # any bigger and one request could have the preview take up gigabytes
+
+
+class Controller:
+    """
+    Lets other programs see how painting is going, and steer it, without getting in its way.
+
+    Painting reports in by setting a few attributes (see start and advance), and checks in with wait() between pixels,
+    which is where pausing takes effect. Status requests only read those attributes, and previews are drawn from the
+    canvas cache's copy (never a new download) on the server's own thread, so neither holds painting up or costs any
+    ratelimit budget.
+
+    Attributes:
+        template: Template - what's being painted
+        cache: CanvasCache - where previews come from
+        scheduler: Scheduler - the order to paint in. Read at the start of every paint, and every protect refresh.
+        protector: Protector - if protecting, what's doing it (for its repair queue)
+        phase: str - what's going on, e.g. painting or protecting
+        total: int - how many pixels this paint has to do
+        painted: int - how many of them are done
+        cursor: Tuple[int, int] - the last pixel painted, in canvas co-ordinates
+        focus: Tuple[int, int, int, int] - the rectangle (left, top, right, bottom) being painted first, if any
+    """
+
+    def __init__(self, template: Template, cache: CanvasCache, scheduler: Scheduler):
+        self.template = template
+        self.cache = cache
+        self.scheduler = scheduler
+        self.protector = None
+        self.phase = "starting"
+        self.total = 0
+        self.painted = 0
+        self.cursor: Optional[Tuple[int, int]] = None
+        self.focus: Optional[Tuple[int, int, int, int]] = None
+        self.started = time.monotonic()
+        self._phase_started = self.started
+        self._running = threading.Event()
+        self._running.set()
+        self._preview_key = None
+        self._preview: Optional[bytes] = None
+        self._preview_lock = threading.Lock()
+        self._server: Optional[socketserver.BaseServer] = None
+
+    @property
+    def paused(self) -> bool:
+        return not self._running.is_set()
+
+    def start(self, phase: str, total: int = 0):
+        """
+        :param phase: What's starting, e.g. painting
+        :param total: How many pixels it has to do, if known
+        """
+        self.phase = phase
+        self.total = total
+        self.painted = 0
+        self._phase_started = time.monotonic()
+
+    def advance(self, x: int, y: int):
+        """Records a pixel having been painted."""
+        self.painted += 1
+        self.cursor = (x, y)
+
+    def wait(self):
+        """Blocks for as long as painting is paused."""
+        self._running.wait()
+
+    async def wait_async(self):
+        """Same as wait, but only suspends the calling task."""
+        while not self._running.is_set():
+            await asyncio.sleep(0.25)
+
+    def pause(self):
+        if not self.paused:
+            self._running.clear()
+            log.info("CONTROL", "Paused. Pixels already being painted will finish.")
+
+    def resume(self):
+        if self.paused:
+            self._running.set()
+            log.info("CONTROL", "Resumed.")
+
+    def reprioritize(self, strategy: str = None, focus: Tuple[int, int, int, int] = None):
+        """
+        Changes the order pixels are painted in, from the next protect refresh (or paint loop) on.
+
+        :param strategy: A strategy name (see lib.scheduler.STRATEGIES). Defaults to the current one.
+        :param focus: left, top, right, bottom (exclusive) of a rectangle of the canvas to paint first, or None for no
+            rectangle
+        :raises: ValueError - strategy isn't one
+        """
+        scheduler = self.scheduler.inner if isinstance(self.scheduler, Focused) else self.scheduler
+        if strategy is not None:
+            scheduler = get_scheduler(strategy)
+        self.focus = focus
+        self.scheduler = Focused(scheduler, focus) if focus is not None else scheduler
+        if self.protector is not None:
+            self.protector.scheduler = self.scheduler
+        if focus is not None:
+            log.info(
+                "CONTROL", "Now painting %s to %s first, in %s order.", focus[:2], focus[2:], scheduler.name,
+                strategy=scheduler.name, focus=focus,
+            )
+        else:
+            log.info("CONTROL", "Now painting in %s order.", scheduler.name, strategy=scheduler.name)
+
+    def status(self) -> dict:
+        """
+        :return: dict - how painting is going, ready to be sent as JSON
+        """
+        now = time.monotonic()
+        painted, total = self.painted, self.total
+        self.cache.peek()  # just to see how old it is
+        status = {
+            "phase": self.phase,
+            "paused": self.paused,
+            "uptime": round(now - self.started, 1),
+            "painted": painted,
+            "total": total,
+            "percent": round(painted / total * 100, 2) if total else None,
+            "rate": round(painted / max(now - self._phase_started, 1e-9), 3),
+            "cursor": self.cursor,
+            "strategy": self.scheduler.name,
+            "focus": self.focus,
+            "template": {
+                "x": self.template.x, "y": self.template.y,
+                "width": self.template.width, "height": self.template.height,
+            },
+            "queue": self.queue(0),
+            "canvas_age": round(time.time() - self.cache.fetched, 1) if self.cache.fetched else None,
+            "circuit_open": bool(metrics.CIRCUIT_OPEN.value()),
+        }
+        if self.protector is not None:
+            status["repaired"] = self.protector.repaired
+            status["refresh_interval"] = round(self.protector.interval, 2)
+        return status
+
+    def queue(self, limit: int = 20) -> dict:
+        """
+        :param limit: How many of the next pixels to list
+        :return: dict - how many pixels are waiting, and (when protecting) which ones are next, and for how long
+            they've been waiting
+        """
+        if self.protector is None:
+            return {"depth": max(self.total - self.painted, 0)}
+        # Copied in one go (which the GIL keeps atomic), since the painting thread keeps changing it.
+        seen = list(self.protector.queue.values())
+        now = time.monotonic()
+        return {
+            "depth": len(seen),
+            "oldest": round(now - min(seen), 1) if seen else None,
+            "next": [list(xy) for xy in self.protector.pending()[:limit]],
+        }
+
+    def preview(self, scale: int = None) -> bytes:
+        """
+        Draws the canvas as last downloaded, with pixels that don't match the template yet in magenta, and the cursor
+        as a red crosshair. Only drawn again once any of those change.
+
+        :param scale: How many times bigger to draw it, from 1 to MAX_PREVIEW_SCALE. Defaults to whatever makes it about
+            1920 wide (within those).
+        :return: bytes - a PNG
+        :raises: ValueError - scale is out of range
+        """
+        if scale is not None and not 1 <= scale <= MAX_PREVIEW_SCALE:
+            raise ValueError(f"scale should be from 1 to {MAX_PREVIEW_SCALE}.")
+        canvas = self.cache.peek()
+        if canvas is None and self.protector is not None and self.protector.canvas is not None:
+            canvas = self.protector.canvas  # --cache-ttl 0: just the template's part of it
+        if canvas is None:
+            canvas = Canvas(numpy.zeros((self.template.height, self.template.width, 3), numpy.uint8),
+                            self.template.x, self.template.y)
+        scale = scale or min(max(1920 // canvas.width, 1), MAX_PREVIEW_SCALE)
+        key = (id(canvas.array), self.cache.fetched, self.cursor, self.painted, scale)
+        with self._preview_lock:
+            if key == self._preview_key:
+                return self._preview
+
+            array = canvas.array.copy()
+            t = self.template
+            x0, y0 = max(t.x, canvas.x), max(t.y, canvas.y)
+            x1, y1 = min(t.x + t.width, canvas.x + canvas.width), min(t.y + t.height, canvas.y + canvas.height)
+            if x0 < x1 and y0 < y1:
+                area = numpy.s_[y0 - canvas.y:y1 - canvas.y, x0 - canvas.x:x1 - canvas.x]
+                wrong = t.crop(x0, y0, x1, y1).mismatches(array[area])
+                array[area][wrong] = DAMAGE_COLOUR
+            if self.cursor is not None:
+                x, y = self.cursor[0] - canvas.x, self.cursor[1] - canvas.y
+                # Blended rather than painted over, so what's under the crosshair can still be made out.
+                if 0 <= x < canvas.width:
+                    array[:, x] = array[:, x] // 2 + CURSOR_COLOUR // 2
+                if 0 <= y < canvas.height:
+                    array[y, :] = array[y, :] // 2 + CURSOR_COLOUR // 2
+            array = array.repeat(scale, axis=0).repeat(scale, axis=1)
+            output = io.BytesIO()
+            Image.fromarray(array, "RGB").save(output, "PNG")
+            self._preview_key, self._preview = key, output.getvalue()
+            return self._preview
+
+    def serve(self, path: Path) -> socketserver.BaseServer:
+        """
+        Serves the control API over HTTP on a Unix socket, on a background thread:
+            GET /status - see status()
+            GET /queue?limit=N - see queue()
+            GET /preview.png?scale=N - see preview()
+            POST /pause, POST /resume
+            POST /prioritize?strategy=NAME&focus=LEFT,TOP,RIGHT,BOTTOM - see reprioritize(). No focus clears it.
+
+        :param path: Where to make the socket. Anyone who can write to it can control painting, so mind where it goes.
+        :return: socketserver.BaseServer - already running. Call shutdown() on it to stop.
+        """
+        path = Path(path)
+        if path.exists():
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(str(path))
+            except OSError:
+                path.unlink()  # left behind by a painter that didn't get to clean up
+            else:
+                raise RuntimeError(f"{path} is already being used by another painter.")
+            finally:
+                probe.close()
+
+        self._server = _UnixHTTPServer(str(path), _handler(self))
+        threading.Thread(target=self._server.serve_forever, daemon=True, name="control-server").start()
+        log.info("CONTROL", "Listening on %s. Try: curl --unix-socket %s http://pixels/status", path, path)
+        return self._server
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            try:
+                os.unlink(self._server.server_address)
+            except OSError:
+                pass
+            self._server = None
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _handler(control: Controller):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _json(self, data, status: int = 200):
+            self._send(status, json.dumps(data).encode() + b"\n")
+
+        def _route(self, method: str):
+            url = urlsplit(self.path)
+            query = dict(parse_qsl(url.query))
+            try:
+                if method == "GET" and url.path == "/status":
+                    self._json(control.status())
+                elif method == "GET" and url.path == "/queue":
+                    self._json(control.queue(int(query.get("limit", 20))))
+                elif method == "GET" and url.path == "/preview.png":
+                    scale = int(query["scale"]) if "scale" in query else None
+                    self._send(200, control.preview(scale), "image/png")
+                elif method == "POST" and url.path == "/pause":
+                    control.pause()
+                    self._json(control.status())
+                elif method == "POST" and url.path == "/resume":
+                    control.resume()
+                    self._json(control.status())
+                elif method == "POST" and url.path == "/prioritize":
+                    focus = tuple(map(int, query["focus"].split(","))) if query.get("focus") else None
+                    if focus is not None and len(focus) != 4:
+                        raise ValueError("focus should be left,top,right,bottom.")
+                    control.reprioritize(query.get("strategy"), focus)
+                    self._json(control.status())
+                else:
+                    self._json({"error": f"No such thing as {method} {url.path}."}, 404)
+            except ValueError as e:
+                self._json({"error": str(e)}, 400)
+            except Exception as e:
+                log.exception("CONTROL", "Exception while handling %s %s:", method, url.path)
+                self._json({"error": str(e)}, 500)
+
+        def do_GET(self):
+            self._route("GET")
+
+        def do_POST(self):
+            self._route("POST")
+
+        def log_message(self, *args):
+            pass  # status checks aren't worth a line each, and Unix sockets have no client address to log anyway
+
+    return Handler
@@ -25,6 +25,29 @@ class APIOffline(APIException):
     """Raised whenever a 5xx is encountered"""
 
 
+class Ratelimited(APIException):
+    """
+    Raised on a 429. The ratelimiter has already learned the cooldown from it.
+
+    Attributes:
+        cooldown: float - how long the 429 said to cool down for, in seconds, which is already being waited out (by
+            the ratelimiter, or whoever raised it). 0 if it didn't say.
+    """
+    def __init__(self, status: int, detail: str = "No Detail", *, message: str = None, cooldown: float = 0.0):
+        self.cooldown = cooldown
+        super().__init__(status, detail, message=message)
+
+
+class CircuitOpen(BasePixelsException):
+    """The server looks to be down, so the request wasn't sent. Try again in retry_after seconds."""
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(retry_after)
+
+    def __str__(self):
+        return f"The pixels server looks to be down. Try again in {self.retry_after:.1f} seconds."
+
+
 class Unauthorized(APIException):
     """You forgot to provide a token, or it was invalid."""
 
@@ -1,56 +1,134 @@
 import copy
 
 from .cli import arguments as args
-from .kool import Fore
+from . import log
 from PIL import Image
-import requests
+import numpy
 from io import BytesIO
 import sys
-from .api import get_pixels
-from typing import Dict, Tuple
-
-
-def map_pixels(array: list, rgba: bool = False):
-    pixels_map = {}
-    for e in array:
-        r, g, b, a = e[2]
-        if args.verbose:
-            print(Fore.RED + "[DEBUG] " + Fore.LIGHTBLACK_EX + "R: {} G: {} B: {} A: {}".format(r, g, b, a))
-        _hex = ""
-        _hex += hex(r).replace("0x", "").zfill(2)
-        _hex += hex(g).replace("0x", "").zfill(2)
-        _hex += hex(b).replace("0x", "").zfill(2)
-        if rgba:
-            _hex += hex(a).replace("0x", "").zfill(2)
-            pixels_map[(e[0], e[1])] = _hex
-        else:
-            pixels_map[(e[0], e[1])] = _hex
-        if args.verbose:
-            print(Fore.RED + "[DEBUG] X: {} Y: {} HEX: {}".format(e[0], e[1], _hex))
+from .cache import TemplateCache
+from .canvas import Canvas, Template
+from .palette import load_palette, quantize
+from typing import List, Mapping, Tuple, Union
+
+
+def to_array(img: Image) -> numpy.ndarray:
+    """
+    Converts an image into an (height, width, 4) array of RGBA bytes, in one go.
+
+    :param img: the PIL.Image
+    :return: numpy.ndarray
+    """
+    return numpy.asarray(img.convert("RGBA"))
+
+
+def pack_rgb(array: numpy.ndarray) -> numpy.ndarray:
+    """
+    Packs the RGB channels of an (..., 3+) array into 0xRRGGBB integers.
+
+    :param array: The array to pack, e.g. from to_array
+    :return: numpy.ndarray - of uint32, with the channel axis removed
+    """
+    array = array.astype(numpy.uint32, copy=False)
+    return (array[..., 0] << 16) | (array[..., 1] << 8) | array[..., 2]
+
+
+def map_pixels(array: Union[numpy.ndarray, list], rgba: bool = False) -> Mapping[Tuple[int, int], str]:
+    """
+    Maps pixel co-ordinates to their hex colour.
+
+    :param array: An (height, width, 4) array from to_array, or a list from lib.api.get_pixels
+    :param rgba: Whether to include the alpha channel in the hex
+    :return: Mapping[Tuple[int, int], str] - (x, y): hex
+    """
+    if isinstance(array, numpy.ndarray):
+        return Template(array, rgba=rgba)
+    fmt = "%02x%02x%02x%02x" if rgba else "%02x%02x%02x"
+    pixels_map = {(e[0], e[1]): fmt % tuple(e[2][:4 if rgba else 3]) for e in array}
+    log.debug("DEBUG", "Mapped %d pixels.", len(pixels_map))
     return pixels_map
 
 
+def read_image(source: str, cache: TemplateCache = None) -> bytes:
+    """
+    :param source: A path, or an HTTP[S] URL to download
+    :param cache: Where downloads are kept
+    :return: bytes - the image file
+    """
+    if source.startswith("http"):  # this is an image to download. send a web request.
+        return (cache or TemplateCache()).download(source)
+    with open(source, "rb") as file:
+        return file.read()
+
+
+def compile_template(
+        image_bytes: bytes,
+        size: Tuple[int, int] = None,
+        palette: str = None,
+        dither: str = "none",
+        cache: TemplateCache = None
+) -> Template:
+    """
+    Turns an image into a Template, resized and quantized, from the compiled template cache if it's been done before.
+
+    :param image_bytes: The image file, e.g. from read_image
+    :param size: The width, height to resize it to. Defaults to its own size.
+    :param palette: A palette to quantize it to (see lib.palette.load_palette), if any
+    :param dither: How to quantize it, if there's a palette (see lib.palette.DITHERS)
+    :param cache: Where compiled templates are kept
+    :return: Template - at 0, 0
+    """
+    cache = cache or TemplateCache()
+    if size is None:
+        size = Image.open(BytesIO(image_bytes)).size  # only reads the header
+    # Quantized templates are compiled separately for every palette and dither.
+    key = cache.key(image_bytes, *((palette, dither) if palette else ()))
+    template = cache.load(key, size)
+    if template is not None:
+        log.debug("DEBUG", "Loaded compiled template %s.", key)
+        return template
+    pilImage: Image = Image.open(BytesIO(image_bytes))  # open the image into an Image object
+    pilImage: Image = pilImage.convert("RGBA")
+    pilImage: Image = pilImage.resize(size, Image.NEAREST)  # Resize it to the cursor border
+    array = to_array(pilImage)
+    if palette:
+        array = quantize(array, load_palette(palette), dither)
+    return cache.store(key, array)
+
+
 def render(image_width: int, image_height: int):
     if args.image is None:
         image_path = input("Image path (provide URL for download): ")
     else:
         image_path = str(args.image)  # convert to string for the below startswith
-    if image_path.startswith("http"):  # this is an image to download. send a web request.
-        image_response = requests.get(image_path)
-        assert image_response.headers["Content-Type"].startswith("image/"), "Incorrect image type."
-        image_bytes: bytes = image_response.content
-    else:
-        with open(image_path, "rb") as file:
-            image_bytes: bytes = file.read()
-
-    pilImage: Image = Image.open(BytesIO(image_bytes))  # open the image into an Image object
-    pilImage: Image = pilImage.convert("RGBA")
-    pilImage: Image = pilImage.resize((image_width, image_height), Image.NEAREST)  # Resize it to the cursor border
+    cache = TemplateCache()
+    image_bytes = read_image(image_path, cache)
+    template = compile_template(image_bytes, (image_width, image_height), args.palette, args.dither, cache)
+    pilImage: Image = Image.fromarray(template.array, "RGBA")
     if args.preview_paint:
         pilImage.save("./preview.png")
-        print("Preview saved. See: preview.png")
+        log.info("PREVIEW", "Preview saved. See: preview.png", path="preview.png")
         sys.exit(0)
 
-    pixels_array = get_pixels(pilImage)  # Gets the raw pixel data for the mapping
-    pixels_map: Dict[Tuple[int, int], str] = map_pixels(pixels_array, True)  # a mapping of (x, y): hex
+    pixels_array = template.array  # (height, width, 4) of the raw pixel data, for the mapping
+    pixels_map = template  # a mapping of (x, y): hex
     return pilImage, pixels_map, pixels_array
+
+
+def diff_pixels(
+        image: Image, canvas: Union[Image.Image, Canvas], start_x: int, start_y: int, tolerance: float = 0.0
+) -> List[Tuple[int, int, str]]:
+    """
+    Compares a rendered template against a snapshot of the canvas, and returns only the pixels that need painting.
+
+    :param image: The template, as returned by render
+    :param canvas: The canvas snapshot, as returned by Api.get_pixels
+    :param start_x: Where the left edge of the template sits on the canvas
+    :param start_y: Where the top edge of the template sits on the canvas
+    :param tolerance: How different (see lib.canvas.colour_distance) a pixel can look and still count as the same
+    :return: List[Tuple[int, int, str]] - (x, y, hex) for every differing pixel, in canvas co-ordinates.
+    """
+    template = Template(to_array(image), start_x, start_y, tolerance=tolerance)
+    if not isinstance(canvas, Canvas):
+        canvas = Canvas(numpy.asarray(canvas.convert("RGB")))
+    return template.targets(template.diff(canvas))  # row-major, same order as pixels_map
@@ -0,0 +1,223 @@
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy
+
+from . import log
+from .cache import CanvasCache
+from .canvas import Canvas
+
+KEYFRAME = 0
+DELTA = 1
+
+# Every record in the data file starts with this: kind, width, height, then its zlib'd payload's length.
+RECORD = struct.Struct("<BHHI")
+# The index is one of these per record, so it can be memory-mapped and searched without reading the data file.
+INDEX = numpy.dtype([
+    ("time", "<f8"),  # time.time() the snapshot was taken
+    ("offset", "<u8"),  # where its record starts in the data file
+    ("length", "<u4"),  # how long its record is, header included
+    ("keyframe", "<u4"),  # the index of the keyframe it's a delta from (its own, if it's a keyframe)
+    ("kind", "u1"),
+    ("padding", "V7"),
+])
+
+
+class Journal:
+    """
+    An append-only history of the canvas, at a fraction of the size of keeping every snapshot.
+
+    Every keyframe_interval-th snapshot is kept whole (a keyframe). The ones in between only keep what changed since the
+    snapshot before (a delta): they're XORed with it, which leaves zeros everywhere nothing changed, so they compress
+    down to almost nothing. Snapshots identical to the one before aren't kept at all.
+    An index of when each snapshot was taken and where it is lets any moment be rebuilt from the keyframe before it and
+    at most keyframe_interval deltas, without reading the rest.
+
+    Files:
+        journal.bin - the records, one after another: RECORD, then the zlib'd frame (or XOR with the frame before)
+        journal.idx - one INDEX entry per record
+
+    Attributes:
+        directory: Path - where the journal files are
+        keyframe_interval: int - how many records there are per keyframe, at most
+    """
+
+    def __init__(self, directory: Path, keyframe_interval: int = 60):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.keyframe_interval = keyframe_interval
+        self._data_path = self.directory / "journal.bin"
+        self._index_path = self.directory / "journal.idx"
+        self._last: Optional[numpy.ndarray] = None  # the last frame appended, for the next delta
+        self._last_count = 0  # how many records there were once it was appended
+        self._lock = threading.Lock()
+
+    def index(self) -> numpy.ndarray:
+        """
+        :return: numpy.ndarray - every complete INDEX entry, oldest first. Read-only, and memory-mapped if possible.
+        """
+        try:
+            with open(self._index_path, "rb") as file:
+                size = os.fstat(file.fileno()).st_size // INDEX.itemsize * INDEX.itemsize
+                if not size:
+                    return numpy.empty(0, INDEX)
+                data = mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return numpy.empty(0, INDEX)
+        return numpy.frombuffer(data, INDEX)
+
+    def __len__(self) -> int:
+        return len(self.index())
+
+    def times(self) -> numpy.ndarray:
+        """
+        :return: numpy.ndarray - when every kept snapshot was taken (time.time()), oldest first
+        """
+        return self.index()["time"]
+
+    def _read(self, data: mmap.mmap, entry) -> Tuple[int, int, int, bytes]:
+        kind, width, height, length = RECORD.unpack_from(data, int(entry["offset"]))
+        start = int(entry["offset"]) + RECORD.size
+        return kind, width, height, zlib.decompress(data[start:start + length])
+
+    def _rebuild(self, index: numpy.ndarray, position: int) -> Canvas:
+        # The keyframe, then every delta after it up to and including position.
+        entries = index[int(index[position]["keyframe"]):position + 1]
+        with open(self._data_path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        with data:
+            frame = None
+            for entry in entries:
+                kind, width, height, payload = self._read(data, entry)
+                pixels = numpy.frombuffer(payload, numpy.uint8).reshape(height, width, 3)
+                if kind == KEYFRAME:
+                    frame = pixels.copy()
+                else:
+                    frame ^= pixels
+        return Canvas(frame)
+
+    def at(self, when: float) -> Optional[Tuple[float, Canvas]]:
+        """
+        Rebuilds the canvas as it was at a given moment.
+
+        :param when: A time.time()
+        :return: Tuple[float, Canvas] - when the snapshot it's from was taken, and the canvas. None if the journal
+            doesn't go back that far.
+        """
+        index = self.index()
+        position = bisect.bisect_right(index["time"], when) - 1
+        if position < 0:
+            return None
+        return float(index[position]["time"]), self._rebuild(index, position)
+
+    def _recover(self, data, index_file) -> Tuple[numpy.ndarray, int]:
+        """
+        Drops anything left half-written by a crash: index entries past the end of the data file, and data past the
+        end of the last index entry.
+
+        :return: Tuple[numpy.ndarray, int] - the index, and where the next record goes
+        """
+        index = self.index()
+        data_size = os.fstat(data.fileno()).st_size
+        while len(index) and int(index[-1]["offset"]) + int(index[-1]["length"]) > data_size:
+            index = index[:-1]
+        if os.fstat(index_file.fileno()).st_size != len(index) * INDEX.itemsize:
+            index_file.truncate(len(index) * INDEX.itemsize)
+        end = int(index[-1]["offset"]) + int(index[-1]["length"]) if len(index) else 0
+        if data_size != end:
+            data.truncate(end)
+        return index, end
+
+    def append(self, canvas: Canvas, when: float = None) -> bool:
+        """
+        Adds a snapshot to the end of the journal.
+
+        :param canvas: The whole canvas
+        :param when: When it was taken (time.time()). Defaults to now.
+        :return: bool - whether it was kept. Snapshots identical to the one before, or older than it, aren't.
+        """
+        when = time.time() if when is None else when
+        frame = numpy.ascontiguousarray(canvas.array)
+        with self._lock, open(self._data_path, "ab") as data, open(self._index_path, "ab") as index_file:
+            # Only one process appends at a time, so records and index entries always line up.
+            fcntl.flock(data, fcntl.LOCK_EX)
+            try:
+                index, offset = self._recover(data, index_file)
+                if len(index) and when <= index[-1]["time"]:
+                    return False  # e.g. the same cached canvas as last time
+                if len(index) and (self._last is None or self._last_count != len(index)):
+                    # Someone else has appended since we last did (or we've only just opened it).
+                    self._last = self._rebuild(index, len(index) - 1).array
+                position = len(index)
+                keyframe = int(index[-1]["keyframe"]) if position else 0
+                if self._last is not None and self._last.shape == frame.shape:
+                    if numpy.array_equal(self._last, frame):
+                        return False
+                    if position - keyframe < self.keyframe_interval:
+                        kind, payload = DELTA, numpy.bitwise_xor(self._last, frame).tobytes()
+                    else:
+                        kind, payload, keyframe = KEYFRAME, frame.tobytes(), position
+                else:  # the first snapshot, or the canvas has changed size
+                    kind, payload, keyframe = KEYFRAME, frame.tobytes(), position
+
+                payload = zlib.compress(payload)
+                data.write(RECORD.pack(kind, canvas.width, canvas.height, len(payload)) + payload)
+                data.flush()
+                entry = numpy.zeros(1, INDEX)
+                entry[0] = (when, offset, RECORD.size + len(payload), keyframe, kind, b"")
+                index_file.write(entry.tobytes())
+                index_file.flush()
+                self._last = frame.copy()
+                self._last_count = position + 1
+                return True
+            finally:
+                fcntl.flock(data, fcntl.LOCK_UN)
+
+
+class Recorder(threading.Thread):
+    """
+    Appends the canvas to a journal every interval seconds, on a background thread.
+
+    Snapshots come from a CanvasCache, so any painter on this machine that's downloaded the canvas recently enough
+    saves the recorder a request.
+
+    Attributes:
+        journal: Journal - where snapshots go
+        cache: CanvasCache - where they come from
+        interval: float - seconds between snapshots
+    """
+
+    def __init__(self, journal: Journal, cache: CanvasCache, interval: float = 10.0):
+        super().__init__(daemon=True, name="journal-recorder")
+        self.journal = journal
+        self.cache = cache
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def record(self) -> bool:
+        """
+        :return: bool - whether the canvas had changed since the last snapshot, and so was kept
+        """
+        canvas = self.cache.get(self.interval)
+        return self.journal.append(canvas, self.cache.fetched)
+
+    def run(self):
+        while True:
+            try:
+                kept = self.record()
+                log.debug("JOURNAL", "Canvas %s.", "recorded" if kept else "unchanged")
+            except Exception:
+                log.exception("JOURNAL", "Couldn't record the canvas:")
+            if self._stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self._stopped.set()
@@ -17,12 +17,15 @@ except ImportError:
 __all__ = ("Fore",)
 
 
+VERBOSE_TAGS = ("[VERBOSE]", "[DEV]", "[DEBUG]")
+
+
 def _print(*args, verbose: bool = ..., **kwargs):
     from .cli import arguments
-    if verbose is ...:
-        verbose = any(
-            (x in kwargs.get("sep", " ").join(map(str, args)) for x in ("[VERBOSE]", "[DEV]", "[DEBUG]"))
-        )
-    if verbose and not arguments.verbose:
-        return
+    if not arguments.verbose:
+        if verbose is ...:
+            # Tags always come first, so there's no need to build the whole message just to look for one.
+            verbose = bool(args) and any(tag in str(args[0]) for tag in VERBOSE_TAGS)
+        if verbose:
+            return
     print(*args, **kwargs)
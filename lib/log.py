@@ -0,0 +1,130 @@
+import json
+import logging
+import sys
+import time
+from datetime import timedelta
+from typing import TextIO
+
+from .kool import Fore
+
+logger = logging.getLogger("pixels")
+
+LEVEL_COLOURS = {
+    logging.DEBUG: Fore.LIGHTBLACK_EX,
+    logging.INFO: Fore.WHITE,
+    logging.WARNING: Fore.LIGHTYELLOW_EX,
+    logging.ERROR: Fore.LIGHTRED_EX,
+    logging.CRITICAL: Fore.RED,
+}
+
+
+class TextFormatter(logging.Formatter):
+    """Formats records the way the rest of the program prints: a coloured [TAG], then the message."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        tag = getattr(record, "tag", None)
+        prefix = f"{Fore.YELLOW}[{tag}] " if tag else ""
+        message = prefix + LEVEL_COLOURS.get(record.levelno, "") + record.getMessage()
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        return message
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, with any fields they were logged with."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "tag": getattr(record, "tag", None),
+            "message": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def setup(level: int = logging.INFO, fmt: str = "text", stream: TextIO = sys.stdout):
+    """
+    Sends the program's log records to a stream.
+
+    :param level: The lowest level to show. Anything below it is dropped before it's formatted.
+    :param fmt: "text" for coloured lines, or "json" for one JSON object per line
+    :param stream: Where to write them
+    """
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    logger.handlers[:] = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def log(level: int, tag: str, message: str, *args, **fields):
+    """
+    Logs a message, unless its level is disabled, in which case it isn't even formatted.
+
+    :param level: e.g. logging.INFO
+    :param tag: What it's about, e.g. CURSOR. Shown as [CURSOR].
+    :param message: A %-style format string, filled in with args only if the message is shown
+    :param fields: Extra values, kept as separate keys in JSON output
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, message, *args, extra={"tag": tag, "fields": fields})
+
+
+def debug(tag: str, message: str, *args, **fields):
+    log(logging.DEBUG, tag, message, *args, **fields)
+
+
+def info(tag: str, message: str, *args, **fields):
+    log(logging.INFO, tag, message, *args, **fields)
+
+
+def warning(tag: str, message: str, *args, **fields):
+    log(logging.WARNING, tag, message, *args, **fields)
+
+
+def exception(tag: str, message: str, *args, level: int = logging.ERROR, **fields):
+    """Logs a message along with the exception currently being handled, as an error unless told otherwise."""
+    if logger.isEnabledFor(level):
+        logger.log(level, message, *args, exc_info=True, extra={"tag": tag, "fields": fields})
+
+
+class Progress:
+    """
+    Summarises progress through a batch of pixels at most once every interval seconds, instead of a line per pixel.
+
+    Attributes:
+        total: int - how many pixels there are
+        done: int - how many have been handled so far
+        tag: str - what the summaries are tagged with
+        interval: float - the least time between summaries, in seconds
+    """
+
+    def __init__(self, total: int, tag: str = "CURSOR", interval: float = 5.0):
+        self.total = total
+        self.done = 0
+        self.tag = tag
+        self.interval = interval
+        self.started = time.monotonic()
+        self._next = self.started + interval
+
+    def advance(self, count: int = 1):
+        self.done += count
+        now = time.monotonic()
+        if now >= self._next:
+            self._next = now + self.interval
+            self.report(now)
+
+    def report(self, now: float = None):
+        now = time.monotonic() if now is None else now
+        rate = self.done / max(now - self.started, 1e-9)
+        left = timedelta(seconds=round((self.total - self.done) / rate)) if rate else "?"
+        info(
+            self.tag,
+            "%d/%d done (%.2f%%), %.2f pixels/s, about %s left.",
+            self.done, self.total, self.done / max(self.total, 1) * 100, rate, left,
+            done=self.done, total=self.total, rate=round(rate, 3),
+        )
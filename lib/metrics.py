@@ -0,0 +1,249 @@
+import json
+import math
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Sequence, TextIO, Tuple
+
+from . import log
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+
+class Metric:
+    """
+    A named value (or one per combination of label values), safe to update from any thread.
+
+    Attributes:
+        name: str - the Prometheus name
+        help: str - what it measures
+        labelnames: Tuple[str, ...] - the labels every update has to give a value for
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        """
+        :return: List[Tuple[str, Dict[str, str], float]] - (name, labels, value) of everything to export
+        """
+        with self._lock:
+            return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    """A value that only ever goes up, e.g. how many requests have been sent."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. how many pixels are queued."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Counts observations (e.g. request latencies) into cumulative buckets, along with their sum and count.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+            self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        samples = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                labels = dict(zip(self.labelnames, key))
+                total = 0
+                for bound, count in zip(self.buckets, counts):
+                    total += count
+                    samples.append((self.name + "_bucket", dict(labels, le=_format(bound)), total))
+                samples.append((self.name + "_sum", labels, self._values[key]))
+                samples.append((self.name + "_count", labels, total))
+        return samples
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Registry:
+    """
+    Every metric this process keeps, and the formats they can be exported in.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def prometheus(self) -> str:
+        """
+        :return: str - every metric, in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += "{" + ",".join('{}="{}"'.format(k, v.replace('"', '\\"')) for k, v in labels.items()) + "}"
+                lines.append(f"{name} {_format(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, List[dict]]:
+        """
+        :return: Dict[str, List[dict]] - name: [{"labels": {...}, "value": ...}] of every sample, for JSON
+        """
+        snapshot = {}
+        for metric in self.metrics.values():
+            for name, labels, value in metric.samples():
+                if value == math.inf:
+                    value = None
+                snapshot.setdefault(name, []).append({"labels": labels, "value": value})
+        return snapshot
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "pixels_request_seconds", "How long requests took to be answered, by endpoint.", ("endpoint",)
+))
+REQUESTS = REGISTRY.register(Counter(
+    "pixels_requests_total", "Responses received, by endpoint and status code.", ("endpoint", "status")
+))
+RATELIMITED = REGISTRY.register(Counter(
+    "pixels_ratelimited_total", "How many requests were answered with a 429, by endpoint.", ("endpoint",)
+))
+RATELIMIT_SLEEP_SECONDS = REGISTRY.register(Counter(
+    "pixels_ratelimit_sleep_seconds_total", "Time spent waiting for ratelimits to allow a request, by endpoint.",
+    ("endpoint",)
+))
+PIXELS = REGISTRY.register(Counter(
+    "pixels_pixels_total", "Pixels handled by the paint loops, by result (painted, skipped or repaired).", ("result",)
+))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "pixels_queue_depth", "How many pixels are waiting to be painted or repaired."
+))
+RETRIES = REGISTRY.register(Counter(
+    "pixels_retries_total",
+    "Requests sent again after failing, by endpoint and reason (offline, network or ratelimited).",
+    ("endpoint", "reason")
+))
+CIRCUIT_OPEN = REGISTRY.register(Gauge(
+    "pixels_circuit_open", "1 while the server looks to be down and requests are paused, otherwise 0."
+))
+
+
+def observe_response(endpoint: str, status: int, seconds: float):
+    """
+    Records a response to one of our requests.
+
+    :param endpoint: The endpoint name, e.g. set_pixel
+    :param status: The response's status code
+    :param seconds: How long it took to be answered
+    """
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, status=status)
+    if status == 429:
+        RATELIMITED.inc(endpoint=endpoint)
+
+
+def serve(port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """
+    Serves the metrics for Prometheus to scrape, on a background thread.
+
+    :param port: The port to listen on
+    :param host: The address to listen on. Only this machine, by default.
+    :param registry: What to serve
+    :return: ThreadingHTTPServer - already running. Call shutdown() on it to stop.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # scrapes aren't worth a line each
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+    log.info("METRICS", "Serving metrics on http://%s:%d/metrics", host, port, host=host, port=port)
+    return server
+
+
+class JsonReporter(threading.Thread):
+    """
+    Writes every metric as one line of JSON, every interval seconds, on a background thread.
+
+    Attributes:
+        output: TextIO - where lines go
+        interval: float - seconds between lines
+    """
+
+    def __init__(self, output: TextIO = sys.stdout, interval: float = 10.0, registry: Registry = REGISTRY):
+        super().__init__(daemon=True, name="metrics-reporter")
+        self.output = output
+        self.interval = interval
+        self.registry = registry
+        self._stopped = threading.Event()
+
+    def report(self):
+        self.output.write(json.dumps({"time": time.time(), "metrics": self.registry.snapshot()}) + "\n")
+        self.output.flush()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self._stopped.set()
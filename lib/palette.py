@@ -0,0 +1,123 @@
+from pathlib import Path
+from typing import Dict
+
+import numpy
+from PIL import Image
+
+from .canvas import TRANSPARENCY_THRESHOLD, colour_distance, parse_colour
+
+DITHERS = ("none", "ordered", "floyd-steinberg")
+
+PALETTES: Dict[str, str] = {
+    "pico-8": "000000,1d2b53,7e2553,008751,ab5236,5f574f,c2c3c7,fff1e8,"
+              "ff004d,ffa300,ffec27,00e436,29adff,83769c,ff77a8,ffccaa",
+    "greyscale": ",".join("%02x%02x%02x" % ((v,) * 3) for v in range(0, 256, 17)),
+    "web-safe": ",".join("%02x%02x%02x" % (r, g, b) for r in range(0, 256, 51) for g in range(0, 256, 51)
+                         for b in range(0, 256, 51)),
+}
+
+# Thresholds for ordered dithering, from 0 to 1, in the order that spreads them out the most.
+_BAYER = numpy.zeros((1, 1))
+for _ in range(3):
+    _BAYER = numpy.block([[4 * _BAYER, 4 * _BAYER + 2], [4 * _BAYER + 3, 4 * _BAYER + 1]])
+BAYER_8X8 = (_BAYER + 0.5) / _BAYER.size
+del _BAYER
+
+
+def load_palette(spec: str) -> numpy.ndarray:
+    """
+    Works out which colours a palette has.
+
+    :param spec: The name of a built-in palette (see PALETTES), comma-separated hex colours, or the path to an image
+        whose (opaque) colours are the palette
+    :return: numpy.ndarray - (N, 3) of the palette's distinct RGB colours
+    """
+    spec = PALETTES.get(spec.lower(), spec)
+    if "," not in spec and Path(spec).is_file():
+        array = numpy.asarray(Image.open(spec).convert("RGBA")).reshape(-1, 4)
+        colours = array[array[:, 3] > TRANSPARENCY_THRESHOLD, :3]
+    else:
+        colours = numpy.array([parse_colour(colour.strip()) for colour in spec.split(",") if colour.strip()])
+    colours = numpy.unique(colours.astype(numpy.uint8).reshape(-1, 3), axis=0)
+    if not len(colours):
+        raise ValueError(f"Palette {spec!r} has no colours in it.")
+    return colours
+
+
+def nearest(pixels: numpy.ndarray, palette: numpy.ndarray) -> numpy.ndarray:
+    """
+    Finds the palette colour that looks closest to each pixel.
+
+    :param pixels: (..., 3+) of RGB values. Doesn't have to be whole numbers, or within 0-255.
+    :param palette: (N, 3) from load_palette
+    :return: numpy.ndarray - (...) of indexes into palette
+    """
+    flat = pixels[..., :3].reshape(-1, 3)
+    found = numpy.empty(len(flat), numpy.intp)
+    step = max(1, (1 << 20) // len(palette))  # keeps the (pixels, palette) distance table to a few megabytes
+    for start in range(0, len(flat), step):
+        chunk = flat[start:start + step, None, :]
+        found[start:start + step] = colour_distance(chunk, palette[None, :, :]).argmin(axis=1)
+    return found.reshape(pixels.shape[:-1])
+
+
+def quantize(array: numpy.ndarray, palette: numpy.ndarray, dither: str = "none") -> numpy.ndarray:
+    """
+    Redraws an image in just the colours of a palette.
+
+    Without dithering, every pixel becomes its nearest palette colour, which flattens gradients into bands. "ordered"
+    nudges each pixel by a fixed 8x8 pattern first, and "floyd-steinberg" passes each pixel's error on to the pixels
+    after it, which both keep gradients looking smooth from a distance.
+
+    :param array: (height, width, 4) of RGBA, e.g. from image_process.to_array
+    :param palette: (N, 3) from load_palette
+    :param dither: One of DITHERS
+    :return: numpy.ndarray - (height, width, 4) of RGBA, with the alpha channel untouched
+    """
+    rgb = array[..., :3].astype(numpy.float32)
+    if dither == "ordered":
+        height, width = array.shape[:2]
+        # Roughly the gap between neighbouring palette colours, if they were spread evenly over the RGB cube.
+        spread = 255 / max(round(len(palette) ** (1 / 3)), 1)
+        pattern = numpy.tile(BAYER_8X8, ((height + 7) // 8, (width + 7) // 8))[:height, :width]
+        indexes = nearest(rgb + (spread * (pattern - 0.5))[..., None], palette)
+    elif dither == "floyd-steinberg":
+        indexes = _floyd_steinberg(rgb, array[..., 3] > TRANSPARENCY_THRESHOLD, palette)
+    elif dither == "none":
+        indexes = nearest(rgb, palette)
+    else:
+        raise ValueError(f"{dither!r} isn't a dither. Choose from: {', '.join(DITHERS)}")
+
+    result = numpy.empty_like(array)
+    result[..., :3] = palette[indexes]
+    result[..., 3] = array[..., 3]
+    return result
+
+
+def _floyd_steinberg(rgb: numpy.ndarray, opaque: numpy.ndarray, palette: numpy.ndarray) -> numpy.ndarray:
+    """
+    Floyd-Steinberg error diffusion, a diagonal at a time instead of a pixel at a time.
+
+    A pixel's error goes right and to the three pixels below it, so a pixel only depends on its left, top-left, top and
+    top-right neighbours. All of those have a smaller x + 2y, so every pixel on the same x + 2y line can be done at
+    once, in width + 2 * height steps instead of width * height.
+
+    :return: numpy.ndarray - (height, width) of indexes into palette
+    """
+    height, width = rgb.shape[:2]
+    error = numpy.zeros((height + 1, width + 2, 3), numpy.float32)  # padded, so edge pixels can spill into it
+    indexes = numpy.empty((height, width), numpy.intp)
+    palette_f = palette.astype(numpy.float32)
+    for line in range(width + 2 * (height - 1)):
+        ys = numpy.arange(max(0, (line - width + 2) // 2), min(height - 1, line // 2) + 1)
+        xs = line - 2 * ys
+        wanted = numpy.clip(rgb[ys, xs] + error[ys, xs + 1], 0, 255)
+        found = nearest(wanted, palette_f)
+        indexes[ys, xs] = found
+        # Transparent pixels aren't painted, so there's no error to pass on.
+        spill = (wanted - palette_f[found]) * opaque[ys, xs, None]
+        error[ys, xs + 2] += spill * (7 / 16)
+        error[ys + 1, xs] += spill * (3 / 16)
+        error[ys + 1, xs + 1] += spill * (5 / 16)
+        error[ys + 1, xs + 2] += spill * (1 / 16)
+    return indexes
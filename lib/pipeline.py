@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Iterable, Tuple
+
+from . import log
+from .api import AsyncApi
+from .canvas import TRANSPARENCY_THRESHOLD, close_enough
+
+
+class Pipeline:
+    """
+    Paints pixels with several requests in flight at once, instead of waiting a whole round trip for each.
+
+    Up to depth requests per endpoint are kept in flight, as far as the ratelimiter's budget allows. The get_pixel
+    check for upcoming pixels runs while earlier pixels are still being set, but never more than lookahead pixels
+    ahead, so checks don't go stale before their pixel is painted.
+
+    Attributes:
+        api: AsyncApi - what to paint with
+        depth: int - the most requests in flight to any one endpoint
+        lookahead: int - the most pixels being worked on at once
+        tolerance: float - how different (see lib.canvas.colour_distance) a checked pixel can look and not need painting
+    """
+
+    def __init__(self, api: AsyncApi, depth: int = 4, lookahead: int = None, tolerance: float = 0.0):
+        self.api = api
+        self.depth = depth
+        self.lookahead = lookahead or depth * 4
+        self.tolerance = tolerance
+
+    async def paint(
+            self,
+            targets: Iterable[Tuple[int, int, str]],
+            verify: bool = True,
+            on_done: Callable[[int, int, str, str], None] = None,
+            before: Callable[[], Awaitable[None]] = None
+    ) -> Dict[str, int]:
+        """
+        Paints pixels, roughly in the order given.
+
+        :param targets: (x, y, hex) of each pixel to paint. Hex with an alpha channel is skipped if it's transparent.
+        :param verify: Whether to check each pixel first, and skip it if it's already the right colour
+        :param on_done: Called with (x, y, hex, result) as each pixel finishes. result is painted, skipped or failed.
+        :param before: Awaited before each request is queued, e.g. to hold requests back while painting is paused.
+        :return: Dict[str, int] - result: how many pixels ended up that way
+        """
+        reads = asyncio.Semaphore(self.depth)
+        writes = asyncio.Semaphore(self.depth)
+        window = asyncio.Semaphore(self.lookahead)
+        results = {"painted": 0, "skipped": 0, "failed": 0}
+
+        async def handle(x: int, y: int, colour: str) -> str:
+            if len(colour) == 8:
+                if int(colour[6:], 16) <= TRANSPARENCY_THRESHOLD:
+                    return "skipped"
+                colour = colour[:6]
+            if verify:
+                async with reads:
+                    if before is not None:
+                        await before()
+                    pixel = await self.api.get_pixel(x, y)
+                if close_enough(pixel.rgb, colour, self.tolerance):
+                    return "skipped"
+            async with writes:
+                if before is not None:
+                    await before()  # only once it's this one's turn, or it'd be let through long before being sent
+                await self.api.blind_set_pixel(x, y, colour)
+            return "painted"
+
+        async def run(x: int, y: int, colour: str):
+            try:
+                result = await handle(x, y, colour)
+            except Exception:
+                log.exception("WARNING", "Exception while setting %s:", (x, y), level=logging.WARNING)
+                result = "failed"
+            finally:
+                window.release()
+            results[result] += 1
+            if on_done is not None:
+                on_done(x, y, colour, result)
+
+        tasks = set()
+        for x, y, colour in targets:
+            await window.acquire()
+            task = asyncio.ensure_future(run(x, y, colour))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        return results
@@ -0,0 +1,84 @@
+import time
+from typing import Optional
+
+from .ratelimit import SAFETY_MARGIN, RateLimiter
+
+
+class AdaptivePoller:
+    """
+    Decides how often to look at the canvas, from how often our part of it has been changing.
+
+    The change rate (pixels per second) is a moving average that halves every half_life seconds without any change.
+    The interval is picked so that about target pixels are expected to have changed by the next look. While the canvas
+    is quiet that drifts out to max_interval, so protecting costs almost nothing. As soon as a look finds anything
+    changed, the next one is as soon as the endpoint's ratelimit would allow in the long run, so a raid is seen as
+    quickly as possible. The interval at most doubles from one look to the next, so one quiet look in the middle of a
+    raid doesn't throw it straight back out to max_interval.
+
+    Attributes:
+        ratelimiter: RateLimiter - whose budget for endpoint sets the fastest pace
+        endpoint: str - what each look costs a request of, e.g. get_pixels
+        min_interval: float - never look more often than this, in seconds, even if the budget would allow it
+        max_interval: float - how long to leave it at most while nothing's changing, in seconds
+        target: float - how many changed pixels to expect per look
+        half_life: float - how quickly the change rate forgets old changes, in seconds
+        rate: float - the estimated change rate, in pixels per second
+        interval: float - how long to wait until the next look, in seconds
+    """
+
+    def __init__(
+            self,
+            ratelimiter: RateLimiter,
+            endpoint: str = "get_pixels",
+            min_interval: float = 0.5,
+            max_interval: float = 60.0,
+            target: float = 1.0,
+            half_life: float = 30.0
+    ):
+        self.ratelimiter = ratelimiter
+        self.endpoint = endpoint
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target = target
+        self.half_life = half_life
+        self.rate = 0.0
+        self.interval = min_interval
+        self._observed_at: Optional[float] = None  # time.monotonic() of the last look
+
+    def __repr__(self):
+        return "<AdaptivePoller rate={0.rate:.3f}/s interval={0.interval:.1f}s>".format(self)
+
+    def fastest(self) -> float:
+        """
+        :return: float - the shortest interval the endpoint's ratelimit allows without ever being made to wait, in
+            seconds. min_interval until the ratelimit has been learned.
+        """
+        bucket = self.ratelimiter.bucket(self.endpoint)
+        if not bucket.limit or not bucket.period:
+            return self.min_interval
+        return max(self.min_interval, (bucket.period + SAFETY_MARGIN) / bucket.limit)
+
+    def observe(self, changed: int, now: float = None) -> float:
+        """
+        Records what a look at the canvas found, and works out when the next one should be.
+
+        :param changed: How many of our pixels had changed since the look before
+        :param now: When the look was (time.monotonic()). Defaults to now.
+        :return: float - how long to wait until the next look, in seconds (also kept as interval)
+        """
+        now = time.monotonic() if now is None else now
+        fastest = self.fastest()
+        if self._observed_at is not None:
+            elapsed = max(now - self._observed_at, 1e-3)
+            keep = 0.5 ** (elapsed / self.half_life)
+            self.rate = self.rate * keep + (changed / elapsed) * (1 - keep)
+        self._observed_at = now
+
+        if changed:
+            interval = fastest
+        elif self.rate > 0:
+            interval = min(self.target / self.rate, self.interval * 2)
+        else:
+            interval = self.interval * 2
+        self.interval = min(max(interval, fastest), self.max_interval)
+        return self.interval
@@ -0,0 +1,112 @@
+import logging
+import threading
+import time
+from queue import Empty, Queue
+from typing import Callable, Iterable, List, Sequence, Tuple
+
+from . import log
+from .api import Api
+from .errors import APIOffline, CircuitOpen, Ratelimited
+from .retry import NETWORK_ERRORS
+
+PARK = 5.0  # how long (in seconds) a worker sits out after the server failed it, unless the error says otherwise
+
+
+class WorkerPool:
+    """
+    Paints one queue of pixels with several tokens at once.
+
+    Every token gets its own Api (so its own ratelimit buckets) and its own thread. Each pixel is handed to exactly one
+    worker, so nothing gets painted twice, and throughput grows with the number of tokens.
+
+    Attributes:
+        apis: List[Api] - one per token
+    """
+
+    def __init__(self, apis: Sequence[Api]):
+        self.apis: List[Api] = list(apis)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_tokens(cls, base: str, tokens: Iterable[str]) -> "WorkerPool":
+        return cls([Api(base, auth=token) for token in tokens])
+
+    def __len__(self):
+        return len(self.apis)
+
+    def paint(
+            self,
+            targets: Iterable[Tuple[int, int, str]],
+            until: float = None,
+            on_painted: Callable[[int, int, str], None] = None,
+            before: Callable[[], None] = None,
+            verify: bool = False,
+            tolerance: float = 0.0,
+            on_skipped: Callable[[int, int, str], None] = None
+    ) -> int:
+        """
+        Paints pixels across every worker, and waits for them to finish.
+
+        Pixels the server fails to set (it's down, or the connection dropped) go back in the queue, and the worker that
+        tried sits the outage out for a while rather than failing every other pixel too.
+
+        :param targets: (x, y, hex) of each pixel to paint, in the order they should be painted
+        :param until: A time.monotonic() after which workers stop taking new pixels. Unpainted pixels are left alone.
+        :param on_painted: Called with (x, y, hex) after each pixel is painted. Calls never overlap.
+        :param before: Called by each worker before it takes a pixel, e.g. to block while painting is paused.
+        :param verify: Whether to check each pixel first (with a get_pixel), and skip it if it's already right
+        :param tolerance: With verify, how different it can look and still count as right (see Api.set_pixel)
+        :param on_skipped: With verify, called with (x, y, hex) for each pixel that was already right
+        :return: int - how many pixels were painted
+        """
+        queue: "Queue[Tuple[int, int, str]]" = Queue()
+        for target in targets:
+            queue.put(target)
+        painted = 0
+
+        def worker(api: Api):
+            nonlocal painted
+            while True:
+                if before is not None:
+                    before()
+                if until is not None and time.monotonic() + api.ratelimiter.delay("set_pixel") >= until:
+                    return
+                try:
+                    x, y, colour = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    if verify:
+                        result = api.set_pixel(x, y, colour, tolerance)
+                    else:
+                        result = api.blind_set_pixel(x, y, colour)
+                except (APIOffline, CircuitOpen, Ratelimited, *NETWORK_ERRORS) as e:
+                    queue.put((x, y, colour))  # whichever worker is free once the server's back paints it
+                    wait = getattr(e, "retry_after", PARK)
+                    if until is not None:
+                        wait = min(wait, max(until - time.monotonic(), 0))
+                    log.warning(
+                        "POOL", "Couldn't set %s (%s). Put it back, and pausing this worker for %.0fs.",
+                        (x, y), e, wait, wait=wait,
+                    )
+                    time.sleep(wait)
+                    continue
+                except Exception:
+                    # Something wrong with this pixel itself (e.g. out of bounds), so trying it again won't help.
+                    log.exception("WARNING", "Exception while setting %s:", (x, y), level=logging.WARNING)
+                    continue
+                with self._lock:
+                    if verify and result is None:
+                        if on_skipped is not None:
+                            on_skipped(x, y, colour)
+                        continue
+                    painted += 1
+                    if on_painted is not None:
+                        on_painted(x, y, colour)
+
+        threads = [threading.Thread(target=worker, args=(api,), daemon=True) for api in self.apis]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return painted
@@ -0,0 +1,225 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy
+
+from . import log, metrics
+from .api import Api
+from .cache import CanvasCache
+from .canvas import Canvas, Template
+from .control import Controller
+from .polling import AdaptivePoller
+from .pool import WorkerPool
+from .scheduler import OldestFirst, Scheduler
+
+
+class Protector:
+    """
+    Keeps a template painted for as long as it runs.
+
+    Every refresh reads the template's region of the canvas (from the shared canvas cache, if there is one) and
+    compares it with the last one, so only the cells that actually changed inside the template are looked at. Any of
+    those that no longer match the template go into the repair queue, which is drained for as long as the set_pixel
+    budget allows before the next refresh.
+
+    Attributes:
+        api: Api - what to paint with
+        template: Template - what to protect, and where
+        interval: float - how often to refresh the canvas, in seconds. Changes after every refresh if there's a poller.
+        canvas: Canvas - our copy of the template's region of the canvas, as of the last refresh
+        queue: OrderedDict - (x, y) in canvas co-ordinates: when the damage was first seen (time.monotonic())
+        scheduler: Scheduler - decides which queued pixels get repaired first
+        pool: WorkerPool - if set, repairs are spread over all of its tokens instead of just api's
+        cache: CanvasCache - if set, refreshes come from it (and so are shared with other painters on this machine)
+        poller: AdaptivePoller - if set, it picks the interval, from how often the template's pixels are changing
+        control: Controller - if set, it can pause protecting and change the scheduler, and is told about repairs
+        repaired: int - how many pixels have been painted
+    """
+
+    def __init__(
+            self,
+            api: Api,
+            template: Template,
+            interval: float = 10.0,
+            scheduler: Scheduler = None,
+            pool: WorkerPool = None,
+            cache: CanvasCache = None,
+            poller: AdaptivePoller = None,
+            control: Controller = None
+    ):
+        self.api = api
+        self.template = template
+        self.interval = interval
+        self.scheduler = scheduler or OldestFirst()
+        self.pool = pool
+        self.cache = cache
+        self.poller = poller
+        self.control = control
+        if control is not None:
+            control.protector = self
+            control.start("protecting")
+        self.canvas: Optional[Canvas] = None
+        self.queue: "OrderedDict[Tuple[int, int], float]" = OrderedDict()
+        self._plan: List[Tuple[int, int]] = []
+        self.repaired = 0
+        self.refreshes = 0
+        self._painted_at = 0.0  # time.time() of the last repair
+
+    def refresh(self) -> int:
+        """
+        Reads the template's region again, and queues up anything in it that's been damaged since the last time.
+
+        :return: int - how many pixels were newly damaged
+        """
+        t = self.template
+        if self.cache is not None:
+            # Anything fetched before our last repair would just show us our own damage again.
+            snapshot = self.cache.get(min(self.cache.ttl, self.interval), since=self._painted_at)
+            region = snapshot.crop(t.x, t.y, t.x + t.width, t.y + t.height)
+        else:
+            region = self.api.get_region(t.x, t.y, t.x + t.width, t.y + t.height)
+        template = t.crop(region.x, region.y, region.x + region.width, region.y + region.height)
+        if self.canvas is None or self.canvas.size != region.size:
+            changed = numpy.ones(region.array.shape[:2], bool)  # first look, so everything is new to us
+            self.canvas = region.copy()
+        else:
+            changed = (region.array != self.canvas.array).any(axis=2)
+            self.canvas.update(region.x, region.y, region)
+            if self.poller is not None:
+                self.interval = self.poller.observe(int((changed & template.mask).sum()))
+        self.refreshes += 1
+
+        wrong = template.mismatches(self.canvas.array)
+        now = time.monotonic()
+        damaged = 0
+        ys, xs = numpy.nonzero(changed & wrong)
+        for x, y in zip((xs + region.x).tolist(), (ys + region.y).tolist()):
+            if (x, y) not in self.queue:
+                self.queue[(x, y)] = now
+                damaged += 1
+        # Anything that changed back to the right colour (e.g. someone else fixed it) doesn't need us any more.
+        ys, xs = numpy.nonzero(changed & ~wrong)
+        for x, y in zip((xs + region.x).tolist(), (ys + region.y).tolist()):
+            self.queue.pop((x, y), None)
+        return damaged
+
+    def colour_of(self, x: int, y: int) -> str:
+        """
+        :param x: The X co-ordinate, in canvas co-ordinates
+        :param y: The Y co-ordinate, in canvas co-ordinates
+        :return: str - the hex colour the template wants there
+        """
+        return "%02x%02x%02x" % tuple(self.template.array[y - self.template.y, x - self.template.x, :3].tolist())
+
+    def plan(self):
+        """
+        Puts the repair queue in the order the scheduler wants. Damage is only found on refresh, so this only needs
+        doing once per refresh.
+        """
+        if not self.queue:
+            self._plan = []
+            return
+        offset = (self.template.x, self.template.y)
+        coords = numpy.array(list(self.queue), dtype=numpy.intp) - offset
+        ages = numpy.fromiter(self.queue.values(), float, len(self.queue))
+        ordered = self.scheduler.order(coords, self.template, self.canvas, ages) + offset
+        self._plan = [tuple(xy) for xy in reversed(ordered.tolist())]  # reversed, so the next one pops off the end
+
+    def next_repair(self) -> Tuple[int, int]:
+        """
+        :return: Tuple[int, int] - which queued pixel to repair next, in canvas co-ordinates.
+        """
+        while self._plan:
+            xy = self._plan.pop()
+            if xy in self.queue:
+                return xy
+        return next(iter(self.queue))
+
+    def pending(self) -> List[Tuple[int, int]]:
+        """
+        Safe to call from other threads, and changes nothing.
+
+        :return: List[Tuple[int, int]] - every queued pixel, in the order they'll be repaired, in canvas co-ordinates
+        """
+        # Both copied in one go (which the GIL keeps atomic), since the painting thread keeps changing them.
+        plan, queue = list(self._plan), list(self.queue)
+        queued = set(queue)
+        order = [xy for xy in reversed(plan) if xy in queued]
+        planned = set(order)
+        order.extend(xy for xy in queue if xy not in planned)
+        return order
+
+    def drain(self, until: float):
+        """
+        Repairs queued pixels until the queue is empty, or the set_pixel budget won't allow another before until.
+
+        :param until: The time.monotonic() to stop at (i.e. the next refresh)
+        """
+        if self.pool is not None:
+            order = self.pending()
+            self._plan = []
+            before = self.control.wait if self.control is not None else None
+            self.pool.paint(((x, y, self.colour_of(x, y)) for x, y in order), until, self._repaired, before)
+            return
+        while self.queue:
+            if self.control is not None:
+                self.control.wait()
+            if time.monotonic() + self.api.ratelimiter.delay("set_pixel") >= until:
+                return
+            x, y = self.next_repair()
+            colour = self.colour_of(x, y)
+            self.api.blind_set_pixel(x, y, colour)
+            self._repaired(x, y, colour)
+
+    def _repaired(self, x: int, y: int, colour: str):
+        log.debug("PROTECT", "Repaired %s #%s.", (x, y), colour)
+        self.queue.pop((x, y), None)
+        self.canvas.set(x, y, colour)  # we know what it is now, no need to see it change on the next refresh
+        self.repaired += 1
+        self._painted_at = time.time()
+        if self.cache is not None:
+            self.cache.painted()  # so other painters sharing it don't diff against a copy from before this either
+        if self.control is not None:
+            self.control.advance(x, y)
+        metrics.PIXELS.inc(result="repaired")
+        metrics.QUEUE_DEPTH.set(len(self.queue))
+
+    def step(self):
+        """Runs a single refresh, and spends the time until the next one repairing."""
+        if self.control is not None:
+            self.control.wait()
+        started = time.monotonic()
+        damaged = self.refresh()
+        self.plan()
+        metrics.QUEUE_DEPTH.set(len(self.queue))
+        log.log(
+            logging.INFO if damaged else logging.DEBUG,
+            "PROTECT",
+            "%d newly damaged, %d queued, %d repaired so far. Next refresh in %.1fs.",
+            damaged, len(self.queue), self.repaired, self.interval,
+            damaged=damaged, queued=len(self.queue), repaired=self.repaired, interval=round(self.interval, 2),
+        )
+        until = started + self.interval
+        self.drain(until)
+        time.sleep(max(until - time.monotonic(), 0))
+
+    def run(self):
+        """Protects the template forever. Errors are reported, but the canvas and queue survive them."""
+        log.info(
+            "PROTECT",
+            "Protecting %dx%d pixels at %s, refreshing every %s.",
+            self.template.width, self.template.height, (self.template.x, self.template.y),
+            "%ss" % self.interval if self.poller is None else "%ss to %ss, depending on how busy it is" % (
+                self.poller.min_interval, self.poller.max_interval
+            ),
+        )
+        while True:
+            try:
+                self.step()
+            except KeyboardInterrupt:
+                raise
+            except Exception:
+                log.exception("ERROR", "Exception while protecting:")
+                time.sleep(self.interval)
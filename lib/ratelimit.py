@@ -0,0 +1,379 @@
+import asyncio
+import atexit
+import json
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, Optional
+
+from . import log, metrics
+
+ENDPOINTS = ("get_pixel", "get_pixels", "set_pixel", "get_size")
+PROBE_INTERVAL = 0.05  # how often to check back on a bucket that's still being learned
+SAFETY_MARGIN = 0.25  # added to every period end, reported or guessed, so we never land just before a window ends
+
+
+def endpoint_of(uri: str) -> str:
+    """
+    Works out which ratelimit bucket a request URI belongs to.
+
+    :param uri: The request path, e.g. /get_pixel
+    :return: str - the endpoint name, e.g. get_pixel
+    """
+    return uri.split("?", 1)[0].strip("/").lower()
+
+
+class Bucket:
+    """
+    The ratelimit state of a single endpoint, learned from the headers the server sends back.
+
+    All deadlines are time.monotonic() timestamps.
+
+    Attributes:
+        endpoint: str - the endpoint this bucket belongs to
+        limit: int - how many requests are allowed per period, if known
+        remaining: int - how many requests are left in the current period. None means we don't know yet.
+        period: float - how long a period lasts, in seconds, if known
+        reset_at: float - when the current period ends
+        opens_at: float - when the current period starts, if we've booked requests into a period that hasn't yet
+        cooldown_until: float - when a hard cooldown (429) ends
+        pending: int - how many reserved requests haven't had a response yet
+    """
+
+    __slots__ = (
+        "endpoint", "limit", "remaining", "period", "reset_at", "opens_at", "cooldown_until", "pending", "_lock"
+    )
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.period: Optional[float] = None
+        self.reset_at = 0.0
+        self.opens_at = 0.0
+        self.cooldown_until = 0.0
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Bucket endpoint={0.endpoint!r} remaining={0.remaining}/{0.limit} pending={0.pending}>".format(self)
+
+    def dump(self, offset: float) -> dict:
+        """
+        :param offset: What to add to a time.monotonic() to make it a time.time(), so the state means something to
+            another process
+        :return: dict - what's been learned, ready to be saved as JSON
+        """
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "remaining": self.remaining,
+                "period": self.period,
+                # 0 means "not set", whatever the clock.
+                "reset_at": self.reset_at and self.reset_at + offset,
+                "opens_at": self.opens_at and self.opens_at + offset,
+                "cooldown_until": self.cooldown_until and self.cooldown_until + offset,
+            }
+
+    def restore(self, state: dict, offset: float):
+        """
+        :param state: From dump
+        :param offset: What to add to a time.time() to make it a time.monotonic()
+        """
+        with self._lock:
+            self.limit = state["limit"]
+            self.remaining = state["remaining"]
+            self.period = state["period"]
+            self.reset_at = state["reset_at"] and state["reset_at"] + offset
+            self.opens_at = state["opens_at"] and state["opens_at"] + offset
+            self.cooldown_until = state["cooldown_until"] and state["cooldown_until"] + offset
+
+    def _refill(self, now: float):
+        if self.remaining is not None and self.reset_at and now >= self.reset_at:
+            # The period has rolled over since the server last told us anything.
+            self.remaining = self.limit
+            self.opens_at = self.reset_at
+            self.reset_at = now + self.period + SAFETY_MARGIN if self.period else 0.0
+
+    def delay(self, now: float = None, count: int = 1) -> float:
+        """
+        Works out how long until a request to this endpoint would be allowed, without booking it.
+
+        :param now: The current time.monotonic(). Defaults to now.
+        :param count: How many requests. The delay is until the last of them would be allowed.
+        :return: float - seconds to wait. 0 means right now. While nothing's been learned, this is optimistic.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._refill(now)
+            start = max(now, self.cooldown_until, self.opens_at)
+            if self.remaining is None or self.remaining >= count:
+                return start - now
+            if count > 1 and not (self.limit and self.period):
+                return math.inf
+            start = max(start, self.reset_at)
+            periods = math.ceil((count - self.remaining) / self.limit) - 1 if count > 1 else 0
+            return start + periods * self.period - now
+
+    def reserve(self, now: float = None) -> Optional[float]:
+        """
+        Books the earliest allowed slot for a request to this endpoint.
+
+        Every reservation must be followed by either update() or release().
+
+        :param now: The current time.monotonic(). Defaults to now.
+        :return: float - seconds to wait before sending the request.
+            None if nothing has been learned about this bucket yet and another request is already finding out.
+            Nothing is booked in that case; try again in a moment (see PROBE_INTERVAL).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._refill(now)
+            start = max(now, self.cooldown_until)
+            if self.remaining is None:
+                # Nothing learned yet. Let exactly one request through to find out, and hold the rest back.
+                if self.pending:
+                    return None
+                self.pending += 1
+                return start - now
+            self.pending += 1
+            if self.remaining > 0:
+                self.remaining -= 1
+                return max(start, self.opens_at) - now
+            # Out of budget, so this request gets the first slot of the next period.
+            start = max(start, self.reset_at)
+            self.remaining = max((self.limit or 1) - 1, 0)
+            self.opens_at = start
+            # The server only starts the period once the first request in it arrives, which is a little after start.
+            self.reset_at = start + self.period + SAFETY_MARGIN if self.period else 0.0
+            return start - now
+
+    def release(self, refund: bool = False):
+        """
+        Gives back a reservation whose request never got a proper response (e.g. a connection error).
+
+        :param refund: Whether the request certainly wasn't counted by the server (e.g. a 5xx from in front of it), so
+            its slot can be used again.
+        """
+        with self._lock:
+            self.pending = max(self.pending - 1, 0)
+            if refund and self.remaining is not None and self.opens_at <= time.monotonic():
+                self.remaining = min(self.remaining + 1, self.limit or self.remaining + 1)
+
+    def update(self, headers, now: float = None):
+        """
+        Learns the bucket state from a response's headers.
+
+        :param headers: The response headers. Any case-insensitive mapping will do.
+        :param now: The current time.monotonic(). Defaults to now.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.pending = max(self.pending - 1, 0)
+            if headers.get("requests-limit") is not None:
+                self.limit = int(headers["requests-limit"])
+            if headers.get("requests-period") is not None:
+                self.period = float(headers["requests-period"])
+            reset_at = self.reset_at
+            if headers.get("requests-reset") is not None:
+                reset_at = now + float(headers["requests-reset"]) + SAFETY_MARGIN
+            if self.opens_at > now:
+                # We've already booked requests into a later period than the one this response is about,
+                # so what it says about its own period is old news.
+                pass
+            else:
+                self.reset_at = reset_at
+                if headers.get("requests-remaining") is not None:
+                    # Requests we've sent that the server hasn't answered yet aren't counted in its number.
+                    self.remaining = max(int(headers["requests-remaining"]) - self.pending, 0)
+            if headers.get("cooldown-reset") is not None:
+                self.cooldown_until = now + float(headers["cooldown-reset"]) + SAFETY_MARGIN
+
+
+class RateLimiter:
+    """
+    Keeps one Bucket per endpoint, so that one endpoint's cooldown never holds up requests to another.
+
+    With a path, the buckets are saved there whenever a response uses up budget or brings a cooldown, and read back
+    when the limiter is made, so a restarted (or killed) painter carries on where the last one stopped: no probing
+    requests to relearn the limits, and no walking into a cooldown it had already been given. Only news that gives
+    budget back (a new period, a refund) waits, up to interval seconds or until exit, since a restart that doesn't
+    know about it just goes a little slower.
+
+    Attributes:
+        buckets: Dict[str, Bucket] - endpoint name: its bucket
+        path: Path - where the buckets are saved, if anywhere
+        interval: float - how long to leave it between saves, at most, in seconds
+    """
+
+    _limiters: Dict[str, "RateLimiter"] = {}
+    _limiters_lock = threading.Lock()
+
+    def __init__(self, path: Path = None, interval: float = 5.0):
+        self.buckets: Dict[str, Bucket] = {name: Bucket(name) for name in ENDPOINTS}
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._written = time.monotonic()
+        if path is not None:
+            self.load()
+            atexit.register(self.flush)
+
+    @classmethod
+    def for_token(cls, base: str, token: str) -> "RateLimiter":
+        """
+        :param base: The API base URL
+        :param token: The API token
+        :return: RateLimiter - the one shared by everything in this process using that token on that server, saved in
+            the cache directory under a hash of both (never the token itself)
+        """
+        from .cache import CACHE_DIR  # lib.cache needs lib.api, which needs this module first
+        key = sha256(f"{base}\n{token}".encode()).hexdigest()[:16]
+        with cls._limiters_lock:
+            if key not in cls._limiters:
+                directory = CACHE_DIR / "ratelimits"
+                directory.mkdir(parents=True, exist_ok=True)
+                cls._limiters[key] = cls(directory / f"{key}.json")
+            return cls._limiters[key]
+
+    def load(self):
+        """Reads the buckets back from path. Deadlines that have passed since they were saved are just ignored."""
+        try:
+            state = json.loads(self.path.read_text())
+            offset = time.monotonic() - time.time()
+            for name, bucket in state["buckets"].items():
+                self.bucket(name).restore(bucket, offset)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("RATELIMITER", "Couldn't read the saved ratelimits in %s (%s), relearning them.", self.path, e)
+            self.buckets = {name: Bucket(name) for name in ENDPOINTS}
+            return
+        log.debug("RATELIMITER", "Restored ratelimits from %s: %s", self.path, list(self.buckets.values()))
+
+    def _changed(self, urgent: bool = False):
+        """Notes that a bucket has learned something, and writes them out if it's due (or urgent)."""
+        self._dirty = True
+        if urgent or time.monotonic() - self._written >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Writes every bucket that's learned anything to path (if there is one), all at once, if anything changed."""
+        if self.path is None:
+            return
+        from .cache import _replace
+        with self._save_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            offset = time.time() - time.monotonic()
+            buckets = {
+                name: bucket.dump(offset) for name, bucket in list(self.buckets.items())
+                if bucket.remaining is not None or bucket.cooldown_until
+            }
+            _replace(self.path, json.dumps({"saved": time.time(), "buckets": buckets}).encode())
+            self._written = time.monotonic()
+
+    def bucket(self, endpoint: str) -> Bucket:
+        """
+        Fetches the bucket for an endpoint, creating it if it doesn't exist yet.
+
+        :param endpoint: The endpoint name, e.g. set_pixel
+        :return: Bucket
+        """
+        try:
+            return self.buckets[endpoint]
+        except KeyError:
+            with self._lock:
+                return self.buckets.setdefault(endpoint, Bucket(endpoint))
+
+    def delay(self, endpoint: str, count: int = 1) -> float:
+        """
+        How long until a request to this endpoint would be allowed. Does not book anything.
+
+        :param endpoint: The endpoint name
+        :param count: How many requests. The delay is until the last of them would be allowed.
+        :return: float - seconds
+        """
+        return self.bucket(endpoint).delay(count=count)
+
+    def reserve(self, endpoint: str) -> Optional[float]:
+        """
+        Books the next allowed slot for an endpoint and returns how long to wait for it.
+        Use this directly if you want to do your own waiting (e.g. asyncio.sleep); otherwise use acquire.
+
+        :param endpoint: The endpoint name
+        :return: float - seconds to wait, or None if the bucket is still being learned (see Bucket.reserve)
+        """
+        bucket = self.bucket(endpoint)
+        wait = bucket.reserve()
+        if wait is not None and wait > 0:
+            self._announce(bucket, wait)
+        return wait
+
+    def acquire(self, endpoint: str):
+        """
+        Blocks the calling thread until a request to this endpoint is allowed.
+        Other threads can keep using other endpoints in the meantime.
+
+        :param endpoint: The endpoint name
+        """
+        started = time.monotonic()
+        wait = self.reserve(endpoint)
+        while wait is None:
+            time.sleep(PROBE_INTERVAL)
+            wait = self.reserve(endpoint)
+        while wait > 0:
+            time.sleep(wait)
+            # Another request may have run into a hard cooldown while we were waiting.
+            wait = self.bucket(endpoint).cooldown_until - time.monotonic()
+        metrics.RATELIMIT_SLEEP_SECONDS.inc(time.monotonic() - started, endpoint=endpoint)
+
+    async def acquire_async(self, endpoint: str):
+        """
+        Same as acquire, but only suspends the calling task rather than the whole thread.
+
+        :param endpoint: The endpoint name
+        """
+        started = time.monotonic()
+        wait = self.reserve(endpoint)
+        while wait is None:
+            await asyncio.sleep(PROBE_INTERVAL)
+            wait = self.reserve(endpoint)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.bucket(endpoint).cooldown_until - time.monotonic()
+        metrics.RATELIMIT_SLEEP_SECONDS.inc(time.monotonic() - started, endpoint=endpoint)
+
+    def release(self, endpoint: str, refund: bool = False):
+        self.bucket(endpoint).release(refund)
+        if refund:
+            self._changed()
+
+    def update(self, endpoint: str, headers):
+        bucket = self.bucket(endpoint)
+        remaining, cooldown = bucket.remaining, bucket.cooldown_until
+        bucket.update(headers)
+        # A restart that forgets budget was spent sends requests it doesn't have, and gets a cooldown (or a longer one)
+        # for it, so that's written straight away.
+        spent = remaining is None or (bucket.remaining is not None and bucket.remaining < remaining)
+        self._changed(urgent=spent or bucket.cooldown_until > cooldown)
+
+    @staticmethod
+    def _announce(bucket: Bucket, wait: float):
+        expire = datetime.now() + timedelta(seconds=wait)
+        kind = "hard cooldown" if bucket.cooldown_until > time.monotonic() else "soft cooldown"
+        # Waiting for the next period is routine (every pixel does it once the budget's spent), so only --verbose shows
+        # it. A hard cooldown means something sent more than it should have.
+        log.log(
+            logging.INFO if kind == "hard cooldown" else logging.DEBUG,
+            "RATELIMITER",
+            "%s is on %s for %.2f seconds (until %s).", bucket.endpoint, kind, wait, expire.strftime("%X"),
+            endpoint=bucket.endpoint, cooldown=kind, wait=round(wait, 3),
+        )
@@ -0,0 +1,240 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import requests
+from aiohttp import ClientError
+
+from . import log, metrics
+from .errors import APIOffline, CircuitOpen, Ratelimited
+
+T = TypeVar("T")
+
+# Failures that say nothing about our request itself, just that the server (or the way to it) isn't answering.
+NETWORK_ERRORS = (requests.RequestException, ClientError, asyncio.TimeoutError)
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a server that looks to be down, instead of letting every caller keep hammering it.
+
+    After threshold failures in a row, the circuit opens: nothing is sent for cooldown seconds. Then exactly one
+    request is let through to see if the server's back. If it is, the circuit closes again. If not, it stays open for
+    twice as long as last time (up to max_cooldown).
+    Shared between every Api talking to the same server (see for_base), since an outage affects all of them.
+
+    Attributes:
+        threshold: int - how many failures in a row open the circuit
+        cooldown: float - how long it first stays open, in seconds
+        max_cooldown: float - the longest it stays open, in seconds
+        opened_until: float - the time.monotonic() it can next be probed at. 0 while it's closed.
+    """
+
+    _breakers: Dict[str, "CircuitBreaker"] = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, threshold: int = 5, cooldown: float = 5.0, max_cooldown: float = 120.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.opened_until = 0.0
+        self.failures = 0
+        self._next_cooldown = cooldown
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_base(cls, base: str) -> "CircuitBreaker":
+        """
+        :param base: The API base URL
+        :return: CircuitBreaker - the one shared by everything talking to that server
+        """
+        with cls._breakers_lock:
+            return cls._breakers.setdefault(base, cls())
+
+    @property
+    def open(self) -> bool:
+        return self.opened_until > 0
+
+    def before(self):
+        """
+        Call before sending a request. Every call that doesn't raise must be followed by success() or failure().
+
+        :raises: CircuitOpen - the server is down, so don't send it. Its retry_after says when to ask again.
+        """
+        with self._lock:
+            if not self.opened_until:
+                return
+            now = time.monotonic()
+            if now < self.opened_until:
+                raise CircuitOpen(self.opened_until - now)
+            if self._probing:  # someone else is already finding out if it's back
+                raise CircuitOpen(self.cooldown / 10)
+            self._probing = True
+
+    def success(self):
+        """The server answered, whatever it said."""
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.opened_until:
+                self.opened_until = 0.0
+                self._next_cooldown = self.cooldown
+                metrics.CIRCUIT_OPEN.set(0)
+                log.info("API", "The server is back. Resuming requests.")
+
+    def failure(self):
+        """The server didn't answer, or answered with a 5xx."""
+        with self._lock:
+            self.failures += 1
+            probe_failed, self._probing = self._probing, False
+            if probe_failed or (not self.opened_until and self.failures >= self.threshold):
+                wait = self._next_cooldown
+                self._next_cooldown = min(wait * 2, self.max_cooldown)
+                self.opened_until = time.monotonic() + wait
+                metrics.CIRCUIT_OPEN.set(1)
+                log.warning(
+                    "API", "The server looks to be down (%d failures in a row). Pausing requests for %.0f seconds.",
+                    self.failures, wait, failures=self.failures, wait=wait,
+                )
+
+
+class RetryPolicy:
+    """
+    Retries requests that failed for reasons that might go away: 5xx, connection errors and 429s.
+
+    Server and connection failures are retried after an exponential backoff with full jitter (a random wait between 0
+    and base * 2^attempt, up to cap), so that a crowd of failed requests doesn't come back all at once. 429s are retried
+    straight away, since the ratelimiter has already learned the cooldown and waits it out before sending again.
+    Anything else (e.g. a 422) is the request's own fault, and is raised immediately.
+    While the breaker is open, requests wait for it to close rather than using up their attempts, so an outage pauses
+    whatever's painting instead of crashing it.
+
+    Attributes:
+        attempts: int - the most times a request is sent while the server's up. The last failure is raised.
+        base: float - the backoff after the first failure, in seconds (before jitter)
+        cap: float - the longest backoff, in seconds
+        breaker: CircuitBreaker - if given, requests wait while it's open, and failures count towards opening it
+        wait_open: bool - whether to wait for an open circuit, rather than raising CircuitOpen
+    """
+
+    def __init__(
+            self,
+            attempts: int = 5,
+            base: float = 0.5,
+            cap: float = 30.0,
+            breaker: CircuitBreaker = None,
+            wait_open: bool = True
+    ):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.breaker = breaker
+        self.wait_open = wait_open
+
+    def backoff(self, attempt: int) -> float:
+        """
+        :param attempt: How many times the request has failed so far
+        :return: float - seconds to wait before sending it again
+        """
+        return random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+    def _failed(self, error: Exception, endpoint: str, attempt: int) -> Optional[float]:
+        """
+        Decides what to do about a failed attempt.
+
+        :return: float - seconds to wait before trying again, or None to give up and raise error
+        """
+        if isinstance(error, Ratelimited):
+            # Straight away if there's a cooldown, since that holds it back already. A 429 that didn't say how long
+            # for would just get another 429 straight away though, so that backs off like anything else.
+            reason, wait = "ratelimited", 0.0 if error.cooldown > 0 else self.backoff(attempt)
+        elif isinstance(error, (APIOffline, *NETWORK_ERRORS)):
+            reason, wait = "offline" if isinstance(error, APIOffline) else "network", self.backoff(attempt)
+        else:
+            return None
+        if self.wait_open and self.breaker is not None and self.breaker.open:
+            wait = 0.0  # the circuit holds it back until the server's answering again, and says so itself
+        elif attempt >= self.attempts:
+            return None
+        else:
+            log.warning(
+                "API", "%s failed (%s), retrying in %.1f seconds (attempt %d/%d).",
+                endpoint, error, wait, attempt + 1, self.attempts, endpoint=endpoint, reason=reason,
+            )
+        metrics.RETRIES.inc(endpoint=endpoint, reason=reason)
+        return wait
+
+    def _before(self) -> Optional[float]:
+        """:return: float - seconds to wait for the circuit, or None if the request can go ahead"""
+        if self.breaker is None:
+            return None
+        try:
+            self.breaker.before()
+        except CircuitOpen as e:
+            if not self.wait_open:
+                raise
+            return e.retry_after
+        return None
+
+    def _after(self, error: Optional[Exception]):
+        if self.breaker is None:
+            return
+        if isinstance(error, (APIOffline, *NETWORK_ERRORS)):
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+
+    def call(self, endpoint: str, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Calls func until it succeeds, it fails for good, or it runs out of attempts.
+
+        :param endpoint: What's being requested, e.g. set_pixel. Only used for logs and metrics.
+        :param func: Sends the request. Called with args and kwargs.
+        :return: Whatever func returns
+        """
+        attempt = 0
+        while True:
+            wait = self._before()
+            if wait is not None:
+                time.sleep(wait)
+                attempt = 0  # held back through an outage, so it gets a fresh set of attempts once it's over
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self._after(e)
+                attempt += 1
+                wait = self._failed(e, endpoint, attempt)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+                continue
+            self._after(None)
+            return result
+
+    async def call_async(self, endpoint: str, func: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """
+        Same as call, but for coroutine functions, and waits with asyncio.sleep.
+        """
+        attempt = 0
+        while True:
+            wait = self._before()
+            if wait is not None:
+                await asyncio.sleep(wait)
+                attempt = 0  # held back through an outage, so it gets a fresh set of attempts once it's over
+                continue
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                self._after(e)
+                attempt += 1
+                wait = self._failed(e, endpoint, attempt)
+                if wait is None:
+                    raise
+                await asyncio.sleep(wait)
+                continue
+            self._after(None)
+            return result
@@ -0,0 +1,140 @@
+from typing import Dict, Optional, Tuple, Type
+
+import numpy
+
+from .canvas import Canvas, Template, TRANSPARENCY_THRESHOLD, colour_distance
+
+
+class Scheduler:
+    """
+    Decides what order pixels get painted in. When we're behind the ratelimit, this decides which parts of the image
+    look broken for the longest.
+
+    The base scheduler keeps whatever order it's given (row-major, for everything in this repo).
+    Subclasses override order(), and get registered in STRATEGIES under their name.
+    """
+
+    name = "row-major"
+
+    def order(
+            self,
+            coords: numpy.ndarray,
+            template: Template,
+            canvas: Optional[Canvas] = None,
+            ages: Optional[numpy.ndarray] = None
+    ) -> numpy.ndarray:
+        """
+        Sorts pixels into the order they should be painted in.
+
+        :param coords: (N, 2) of x, y to sort, in template co-ordinates
+        :param template: The template being painted
+        :param canvas: What the canvas currently looks like (or a crop of it), if known
+        :param ages: (N,) of when each pixel was first seen damaged (time.monotonic()), if known
+        :return: numpy.ndarray - coords, re-ordered
+        """
+        return coords
+
+
+class MostVisible(Scheduler):
+    """Paints whatever looks the most wrong first, i.e. the biggest colour difference from what's there now."""
+
+    name = "most-visible"
+
+    def order(self, coords, template, canvas=None, ages=None):
+        if canvas is None or not len(coords):
+            return coords
+        xs, ys = coords[:, 0], coords[:, 1]
+        current = canvas.array[ys + (template.y - canvas.y), xs + (template.x - canvas.x)]
+        distance = colour_distance(template.array[ys, xs], current)
+        return coords[numpy.argsort(-distance, kind="stable")]
+
+
+class OutlineFirst(Scheduler):
+    """Paints the edges of shapes in the template first, so the image is recognisable as early as possible."""
+
+    name = "outline-first"
+
+    @staticmethod
+    def edges(template: Template) -> numpy.ndarray:
+        """
+        :return: numpy.ndarray - (height, width) of booleans, True where a pixel differs from any of its 4 neighbours
+        """
+        pixels = template.array.astype(numpy.int32)
+        packed = (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+        packed[template.array[..., 3] <= TRANSPARENCY_THRESHOLD] = -1  # transparency is its own "colour"
+        padded = numpy.pad(packed, 1, mode="edge")
+        return (
+            (padded[1:-1, 1:-1] != padded[:-2, 1:-1]) | (padded[1:-1, 1:-1] != padded[2:, 1:-1])
+            | (padded[1:-1, 1:-1] != padded[1:-1, :-2]) | (padded[1:-1, 1:-1] != padded[1:-1, 2:])
+        )
+
+    def order(self, coords, template, canvas=None, ages=None):
+        if not len(coords):
+            return coords
+        on_edge = self.edges(template)[coords[:, 1], coords[:, 0]]
+        return coords[numpy.argsort(~on_edge, kind="stable")]
+
+
+class OldestFirst(Scheduler):
+    """Repairs whatever has been damaged the longest first."""
+
+    name = "oldest-first"
+
+    def order(self, coords, template, canvas=None, ages=None):
+        if ages is None:
+            return coords
+        return coords[numpy.argsort(ages, kind="stable")]
+
+
+class RandomSpread(Scheduler):
+    """Paints in a random order, so progress is spread evenly over the whole image instead of filling in from the top."""
+
+    name = "random"
+
+    def __init__(self, seed: int = None):
+        self.random = numpy.random.default_rng(seed)
+
+    def order(self, coords, template, canvas=None, ages=None):
+        return coords[self.random.permutation(len(coords))]
+
+
+class Focused(Scheduler):
+    """
+    Paints everything inside a rectangle of the canvas first, in another scheduler's order, then the rest.
+
+    Not a strategy of its own (so not in STRATEGIES), since it needs the rectangle: see lib.control.
+
+    Attributes:
+        inner: Scheduler - the order within and outside the rectangle
+        box: Tuple[int, int, int, int] - left, top, right, bottom (exclusive), in canvas co-ordinates
+    """
+
+    def __init__(self, inner: Scheduler, box: Tuple[int, int, int, int]):
+        self.inner = inner
+        self.box = box
+        self.name = inner.name
+
+    def order(self, coords, template, canvas=None, ages=None):
+        ordered = self.inner.order(coords, template, canvas, ages)
+        if not len(ordered):
+            return ordered
+        x0, y0, x1, y1 = self.box
+        xs, ys = ordered[:, 0] + template.x, ordered[:, 1] + template.y
+        inside = (xs >= x0) & (xs < x1) & (ys >= y0) & (ys < y1)
+        return ordered[numpy.argsort(~inside, kind="stable")]
+
+
+STRATEGIES: Dict[str, Type[Scheduler]] = {
+    cls.name: cls for cls in (Scheduler, MostVisible, OutlineFirst, OldestFirst, RandomSpread)
+}
+
+
+def get_scheduler(name: str) -> Scheduler:
+    """
+    :param name: The strategy's name, e.g. most-visible. See STRATEGIES.
+    :return: Scheduler
+    """
+    try:
+        return STRATEGIES[name]()
+    except KeyError:
+        raise ValueError(f"{name!r} is not a recognised strategy. Try one of: {', '.join(STRATEGIES)}.") from None
@@ -0,0 +1,186 @@
+import json
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+from PIL import Image
+
+from . import log
+from .cache import TemplateCache
+from .canvas import TRANSPARENCY_THRESHOLD, Template
+from .image_process import compile_template, read_image
+from .palette import DITHERS
+
+
+class WorkspaceEntry:
+    """
+    One template in a workspace.
+
+    Attributes:
+        name: str - what it's called in logs. Defaults to its image's file name.
+        image: str - a path (relative to the workspace file) or URL
+        x: int - where its left edge goes on the canvas
+        y: int - where its top edge goes on the canvas
+        size: Tuple[int, int] - the width, height to resize it to, or None to keep its own size
+        priority: int - which template wins where they overlap. Higher wins; ties go to whichever is listed later.
+        mask: str - a path or URL to a black and white image the same shape as this one. Only pixels that are white
+            in it are painted. None paints every opaque pixel.
+        palette: str - a palette to quantize it to (see lib.palette.load_palette), if any
+        dither: str - how to quantize it (see lib.palette.DITHERS)
+    """
+
+    __slots__ = ("name", "image", "x", "y", "size", "priority", "mask", "palette", "dither")
+
+    def __init__(
+            self,
+            image: str,
+            x: int,
+            y: int,
+            *,
+            name: str = None,
+            size: Tuple[int, int] = None,
+            priority: int = 0,
+            mask: str = None,
+            palette: str = None,
+            dither: str = "none"
+    ):
+        if dither not in DITHERS:
+            raise ValueError(f"{dither!r} isn't a dither. Choose from: {', '.join(DITHERS)}")
+        self.name = name or image.rstrip("/").rsplit("/", 1)[-1]
+        self.image = image
+        self.x = x
+        self.y = y
+        self.size = size
+        self.priority = priority
+        self.mask = mask
+        self.palette = palette
+        self.dither = dither
+
+    def __repr__(self):
+        return "<WorkspaceEntry name={0.name!r} x={0.x} y={0.y} priority={0.priority}>".format(self)
+
+    @classmethod
+    def from_json(cls, data: dict, root: Path) -> "WorkspaceEntry":
+        """
+        :param data: One item of the workspace file's "templates" list
+        :param root: The directory relative paths are relative to
+        :return: WorkspaceEntry
+        """
+        def locate(source: Optional[str]) -> Optional[str]:
+            if source is None or source.startswith("http"):
+                return source
+            return str(root / Path(source).expanduser())
+
+        try:
+            size = (int(data["width"]), int(data["height"])) if "width" in data or "height" in data else None
+            return cls(
+                locate(data["image"]),
+                int(data["x"]),
+                int(data["y"]),
+                name=data.get("name"),
+                size=size,
+                priority=int(data.get("priority", 0)),
+                mask=locate(data.get("mask")),
+                palette=data.get("palette"),
+                dither=data.get("dither", "none"),
+            )
+        except KeyError as e:
+            raise ValueError(f"Workspace template {data!r} is missing {e.args[0]!r}.") from None
+
+    def load(self, cache: TemplateCache = None) -> Template:
+        """
+        :param cache: Where downloads and compiled templates are kept
+        :return: Template - in place on the canvas, with the mask (if any) applied
+        """
+        cache = cache or TemplateCache()
+        template = compile_template(read_image(self.image, cache), self.size, self.palette, self.dither, cache)
+        mask = template.mask
+        if self.mask is not None:
+            image = Image.open(BytesIO(read_image(self.mask, cache))).convert("LA")
+            image = numpy.asarray(image.resize(template.size, Image.NEAREST))
+            mask = mask & (image[..., 0] > 127) & (image[..., 1] > TRANSPARENCY_THRESHOLD)
+        return Template(template.array, self.x, self.y, mask=mask)
+
+
+class Workspace:
+    """
+    Several templates, painted (or protected) as one.
+
+    compose merges them into a single template, so they're all driven from the same canvas snapshot and share one
+    ratelimit budget, rather than needing a painter (and token) each. Where they overlap, the higher priority wins.
+
+    A workspace file is JSON, like:
+        {"templates": [
+            {"image": "logo.png", "x": 10, "y": 20, "priority": 1},
+            {"image": "https://example.com/banner.png", "x": 0, "y": 0, "width": 64, "height": 16,
+             "mask": "banner-mask.png", "palette": "pico-8", "dither": "ordered"}
+        ]}
+
+    Attributes:
+        entries: List[WorkspaceEntry] - in the order they were listed
+        owner: numpy.ndarray - (height, width) of which entry each pixel of the composed template came from (an
+            index into entries), or -1 where there's nothing to paint. Only set once compose has been called.
+    """
+
+    def __init__(self, entries: List[WorkspaceEntry]):
+        if not entries:
+            raise ValueError("A workspace needs at least one template.")
+        self.entries = entries
+        self.owner: Optional[numpy.ndarray] = None
+
+    @classmethod
+    def load(cls, path: Path) -> "Workspace":
+        """
+        :param path: The workspace file
+        :return: Workspace
+        """
+        data = json.loads(Path(path).read_text())
+        return cls([WorkspaceEntry.from_json(entry, Path(path).parent) for entry in data.get("templates", [])])
+
+    def compose(self, tolerance: float = 0.0, cache: TemplateCache = None) -> Template:
+        """
+        Merges every template into one, just big enough to cover them all.
+
+        :param tolerance: See Template.tolerance
+        :param cache: Where downloads and compiled templates are kept
+        :return: Template - where nothing is to be painted, it's transparent and masked out
+        """
+        templates = [entry.load(cache) for entry in self.entries]
+        x0 = min(t.x for t in templates)
+        y0 = min(t.y for t in templates)
+        x1 = max(t.x + t.width for t in templates)
+        y1 = max(t.y + t.height for t in templates)
+
+        array = numpy.zeros((y1 - y0, x1 - x0, 4), numpy.uint8)
+        mask = numpy.zeros((y1 - y0, x1 - x0), bool)
+        owner = numpy.full((y1 - y0, x1 - x0), -1, numpy.intp)
+        # Lowest priority first, so anything above it is drawn over it. sorted is stable, so ties keep file order.
+        for index in sorted(range(len(templates)), key=lambda i: self.entries[i].priority):
+            template = templates[index]
+            top, left = template.y - y0, template.x - x0
+            area = numpy.s_[top:top + template.height, left:left + template.width]
+            wanted = template.mask
+            array[area][wanted] = template.array[wanted]
+            mask[area] |= wanted
+            owner[area][wanted] = index
+        self.owner = owner
+
+        pixels = numpy.bincount(owner[owner >= 0], minlength=len(self.entries)).tolist()
+        for entry, count in zip(self.entries, pixels):
+            log.info(
+                "WORKSPACE", "%s: %d pixels at %d, %d (priority %d).", entry.name, count, entry.x, entry.y,
+                entry.priority, template=entry.name, pixels=count,
+            )
+        return Template(array, x0, y0, mask=mask, tolerance=tolerance)
+
+    def count(self, coords: numpy.ndarray) -> Dict[str, int]:
+        """
+        Works out which templates some pixels belong to, e.g. to say which ones need the most painting.
+
+        :param coords: (N, 2) of x, y in the composed template's co-ordinates, e.g. from Template.diff
+        :return: Dict[str, int] - template name: how many of the pixels are in it
+        """
+        owners = self.owner[coords[:, 1], coords[:, 0]]
+        counts = numpy.bincount(owners[owners >= 0], minlength=len(self.entries))
+        return {entry.name: int(count) for entry, count in zip(self.entries, counts.tolist())}
@@ -1,40 +1,88 @@
 #!/usr/bin/env python3
+import asyncio
+import atexit
 import datetime
 import sys
-import traceback
-from copy import copy
-from signal import SIGUSR1, signal, SIGUSR2
+import time
 
-import requests
+from PIL import Image
 
-from lib import Fore, arguments as args, render, api
+import lib
+from lib import (
+    AdaptivePoller, Api, AsyncApi, CanvasCache, Checkpoint, Controller, Pipeline, Progress, Protector, Template,
+    WorkerPool, Workspace, render, get_scheduler, log, metrics
+)
 
+args = lib.setup()
+api = lib.api
 base = args.base
-# Handling the ratelimit here will sync our cooldown to zero.
+cache = CanvasCache(api, args.cache_ttl)
+painted_at = 0.0  # time.time() of the last pixel we painted, so we never diff against a canvas from before it
 
-canvas_size_response = requests.get(base + "/get_size").json()
-canvas_width = int(canvas_size_response["width"])
-canvas_height = int(canvas_size_response["height"])
+canvas_width, canvas_height = api.max_width, api.max_height
 
-print(f"{Fore.MAGENTA}[CANVAS] {Fore.WHITE}(W:H) {canvas_width}:{canvas_height}")
+log.info("CANVAS", "(W:H) %d:%d", canvas_width, canvas_height, width=canvas_width, height=canvas_height)
 
-if args.start_x is None or args.start_y is None:
-    start_x, start_y = map(int, input("Cursor will start at: ").split(","))
+workspace = None
+if args.workspace is not None:
+    # Every template in it is merged into one, so they share this process' canvas reads and ratelimits.
+    workspace = Workspace.load(args.workspace)
+    template = pixels_map = workspace.compose(args.tolerance)
+    start_x, start_y = template.x, template.y
+    if args.preview_paint:
+        Image.fromarray(template.array, "RGBA").save("./preview.png")
+        log.info("PREVIEW", "Preview saved. See: preview.png", path="preview.png")
+        sys.exit(0)
 else:
-    start_x = args.start_x
-    start_y = args.start_y
-if args.end_x is None or args.end_y is None:
-    end_x, end_y = map(int, input("Cursor will end at: ").split(","))
-else:
-    end_x = args.end_x
-    end_y = args.end_y
+    if args.start_x is None or args.start_y is None:
+        start_x, start_y = map(int, input("Cursor will start at: ").split(","))
+    else:
+        start_x = args.start_x
+        start_y = args.start_y
+    if args.end_x is None or args.end_y is None:
+        end_x, end_y = map(int, input("Cursor will end at: ").split(","))
+    else:
+        end_x = args.end_x
+        end_y = args.end_y
+
+    assert end_x > start_x, "end x is smaller than start x."
+    assert end_y >= start_y, "end y is smaller than start y"
+    image_width = (end_x - start_x) - 1  # zero-indexing.
+    image_height = (end_y - start_y) - 1
+
+    pilImage, pixels_map, pixels_array = render(image_width, image_height)
+    template = Template(pixels_array, start_x, start_y, mask=pixels_map.mask, tolerance=args.tolerance)
+
 
-assert end_x > start_x, "end x is smaller than start x."
-assert end_y >= start_y, "end y is smaller than start y"
-image_width = (end_x - start_x) - 1  # zero-indexing.
-image_height = (end_y - start_y) - 1
+scheduler = get_scheduler(args.strategy or ("oldest-first" if args.protect else "row-major"))
+# Its own cache object (same copy on disk), since previews are drawn on the control server's thread.
+control = Controller(template, CanvasCache(api, args.cache_ttl), scheduler)
+if args.control is not None:
+    control.serve(args.control)
+    atexit.register(control.close)
+# Which pixels are done, kept on disk so that a restart doesn't start checking them all again from the top.
+checkpoint = Checkpoint(template, base)
+if not args.resume:
+    checkpoint.clear()
+atexit.register(checkpoint.flush)
+pool = None
+if len(args.tokens) > 1:
+    # Every extra token gets its own worker (and ratelimits). The first one is already in use by api.
+    pool = WorkerPool([api] + [Api(base, auth=token) for token in args.tokens[1:]])
+    log.info("POOL", "Painting with %d tokens.", len(pool))
+
+
+def pipelined(targets, verify, on_done):
+    """
+    Paints through a Pipeline, on its own event loop, sharing api's ratelimits.
+    """
+    async def run():
+        connections = args.pipeline * 2  # reads and writes
+        async with AsyncApi(base, auth=args.auth, ratelimiter=api.ratelimiter, connections=connections) as async_api:
+            pipeline = Pipeline(async_api, args.pipeline, tolerance=args.tolerance)
+            return await pipeline.paint(targets, verify, on_done, control.wait_async)
 
-pilImage, pixels_map, pixels_array = render(image_width, image_height)
+    return asyncio.run(run())
 
 
 def paint():
@@ -44,79 +92,166 @@ def paint():
     This is the main runtime, only in a function to allow for easier looping.
     """
     painted = 0
+    total = len(pixels_map)
     cursor = (0, 0)
+    scheduler = control.scheduler  # so a reprioritize takes effect from the next loop
+    if args.diff:
+        # One canvas download replaces a get_pixel preflight for every single pixel.
+        canvas = cache.get(since=painted_at)
+        differ = template.diff(canvas)
+        targets = template.targets(scheduler.order(differ, template, canvas))
+        total = len(targets)
+        control.start("painting", total)
+        log.info(
+            "CURSOR",
+            "%d pixels differ from the canvas (%d already painted or transparent).", total, len(pixels_map) - total,
+            differ=total,
+        )
+        if workspace is not None:
+            for name, count in workspace.count(differ).items():
+                log.info("WORKSPACE", "%s: %d pixels differ.", name, count, template=name, differ=count)
+        progress = Progress(total, interval=args.progress_interval)
 
-    def signal_handler(num, frame):
-        if num == SIGUSR1:
-            pct = round((painted / len(pixels_array)) * 100, 2)
-            print(f"{Fore.MAGENTA}[SIGUSR1]{Fore.WHITE} {painted}/{len(pixels_array)}, {pct}% complete.")
-        elif num == SIGUSR2:
-            nonlocal cursor
-            local_cursor = copy(cursor)
-            image = api.get_pixels()
-            image = image.convert("RGBA")
-            # _draw = Draw(image)
-            # _draw.line((cursor[0], 0, cursor[0], end_y), fill="blue")
-            # _draw.line((0, cursor[1], 0, end_x), fill="orange")
-            for _x in range(image.width):
-                for _y in range(image.height):
-                    if _x == local_cursor[0]:
-                        image.putpixel((_x, _y), (255, 0, 0, 10))
-                    if _y == local_cursor[1]:
-                        image.putpixel((_x, _y), (255, 0, 0, 10))
-            image = image.resize((1920, 1080))
-            image.save("./cursor.png")
-
-    print(
-        Fore.YELLOW + "[CURSOR] ",
-        Fore.CYAN + "Beginning paint. It will likely finish at",
-        (datetime.datetime.now() + datetime.timedelta(seconds=len(pixels_array))).strftime("%X"),
+        def painted_one(x, y, colour):
+            global painted_at
+            nonlocal painted, cursor
+            cursor = (x, y)
+            painted += 1
+            painted_at = time.time()
+            cache.painted()  # the same, for any other painter (or the next run of this one) sharing the cached canvas
+            control.advance(x, y)
+            metrics.PIXELS.inc(result="painted")
+            metrics.QUEUE_DEPTH.set(total - painted)
+            log.debug("CURSOR", "Painted %s #%s.", cursor, colour)
+            progress.advance()
+
+        if pool is not None:
+            pool.paint(targets, on_painted=painted_one, before=control.wait)
+        elif args.pipeline:
+            def done_one(x, y, colour, result):
+                if result == "painted":
+                    painted_one(x, y, colour)
+
+            pipelined(targets, False, done_one)
+        else:
+            for x, y, colour in targets:
+                control.wait()
+                api.blind_set_pixel(x, y, colour)
+                painted_one(x, y, colour)
+        log.info("CURSOR", "Done!")
+        return
+
+    everything = template.coords()
+    coords = checkpoint.remaining(everything)
+    if len(coords) < len(everything):
+        done = len(everything) - len(coords)
+        log.info(
+            "CHECKPOINT", "Resuming: %d of %d pixels were already done.", done, len(everything),
+            done=done, total=len(everything),
+        )
+    total = len(coords)
+    log.info(
+        "CURSOR",
+        "Beginning paint. It will likely finish at %s",
+        (datetime.datetime.now() + datetime.timedelta(seconds=total)).strftime("%X"),
     )
-    signal(SIGUSR1, signal_handler)
-    signal(SIGUSR2, signal_handler)
-    for x, y in pixels_map.keys():
+    progress = Progress(total, interval=args.progress_interval)
+    control.start("painting", total)
+    if args.pipeline and pool is None:  # like --diff, several tokens beat one pipelined token
+        def done_one(x, y, colour, result):
+            nonlocal painted, cursor
+            cursor = (x, y)
+            painted += 1
+            control.advance(x, y)
+            if result != "failed":
+                checkpoint.mark(x, y)
+            if result == "painted":
+                cache.painted()
+            metrics.PIXELS.inc(result=result)
+            metrics.QUEUE_DEPTH.set(total - painted)
+            log.debug("CURSOR", "%s %s #%s.", result.capitalize(), cursor, colour)
+            progress.advance()
+
+        order = scheduler.order(coords, template).tolist()
+        results = pipelined([(x + start_x, y + start_y, pixels_map[(x, y)]) for x, y in order], True, done_one)
+        if not results["failed"]:
+            checkpoint.clear()  # all done, so the next loop checks everything again
+        log.info("CURSOR", "Done!")
+        return
+    if pool is not None:
+        def checked_one(result):
+            def callback(x, y, colour):
+                nonlocal painted, cursor
+                cursor = (x, y)
+                painted += 1
+                control.advance(x, y)
+                checkpoint.mark(x, y)
+                if result == "painted":
+                    cache.painted()
+                metrics.PIXELS.inc(result=result)
+                metrics.QUEUE_DEPTH.set(total - painted)
+                log.debug("CURSOR", "%s %s #%s.", result.capitalize(), cursor, colour)
+                progress.advance()
+            return callback
+
+        order = scheduler.order(coords, template).tolist()
+        pool.paint(
+            [(x + start_x, y + start_y, pixels_map[(x, y)]) for x, y in order], before=control.wait,
+            verify=True, tolerance=args.tolerance, on_painted=checked_one("painted"), on_skipped=checked_one("skipped"),
+        )
+        if painted == total:  # some were dropped otherwise, so keep the checkpoint for them to be tried again
+            checkpoint.clear()
+        log.info("CURSOR", "Done!")
+        return
+    for x, y in scheduler.order(coords, template).tolist():
+        control.wait()
         cursor = (x + start_x, y+start_y)
         # noinspection PyTypeChecker
         try:
             colour = pixels_map[(x, y)]
         except KeyError:
             if args.verbose:
-                print(Fore.RED + "[DEBUG] {} is not in colour map? Going to continue.".format(cursor))
+                log.debug("DEBUG", "%s is not in colour map? Going to continue.", cursor)
                 continue
             else:
                 raise
-        if not args.quiet:
-            print(Fore.YELLOW + "[CURSOR] " + Fore.LIGHTYELLOW_EX + "Painting {} #{}.".format(cursor, colour))
-        status = api.set_pixel(*cursor, colour=colour)
+        status = api.set_pixel(*cursor, colour=colour, tolerance=args.tolerance)
         painted += 1
-        pct = round((painted / len(pixels_array)) * 100, 2)
-        if status is True and args.quiet is False:
-            print(Fore.YELLOW + "[CURSOR] " + Fore.LIGHTGREEN_EX + "Painted {} #{}. {}% done.".format(cursor,
-                                                                                                      colour, pct))
-        if status is None and args.quiet is False:
-            print(Fore.YELLOW + "[CURSOR] " + Fore.LIGHTCYAN_EX + "{} Already painted. {}% done.".format(
-                cursor, pct
-            ))
-    print(Fore.YELLOW + "[CURSOR] ", Fore.LIGHTGREEN_EX + "Done!")
-
-
-if args.loop is not None:
+        control.advance(*cursor)
+        checkpoint.mark(*cursor)
+        metrics.PIXELS.inc(result="painted" if status else "skipped")
+        metrics.QUEUE_DEPTH.set(total - painted)
+        if status is True:
+            cache.painted()
+            log.debug("CURSOR", "Painted %s #%s.", cursor, colour)
+        if status is None:
+            log.debug("CURSOR", "%s Already painted.", cursor)
+        progress.advance()
+    checkpoint.clear()  # all done, so the next loop checks everything again
+    log.info("CURSOR", "Done!")
+
+
+if args.protect:
+    poller = AdaptivePoller(api.ratelimiter, max_interval=args.max_interval) if args.adaptive_refresh else None
+    protector = Protector(
+        api, template, args.interval, control.scheduler, pool, cache if args.cache_ttl else None, poller, control
+    )
+    protector.run()
+elif args.loop is not None:
     if isinstance(args.loop, bool):
-        print("Running \N{infinity} times.")
+        log.info("LOOP", "Running \N{infinity} times.")
         while True:
             try:
                 paint()
             except Exception:
-                print("Exception in iteration ...:", file=sys.stderr)
-                traceback.print_exc()
+                log.exception("ERROR", "Exception in iteration ...:")
     if isinstance(args.loop, int):
-        print("Running", args.loop, "times.")
+        log.info("LOOP", "Running %d times.", args.loop)
         for i in range(args.loop):
             try:
                 paint()
             except Exception:
-                print(f"Exception in iteration {i}:", file=sys.stderr)
-                traceback.print_exc()
+                log.exception("ERROR", "Exception in iteration %d:", i)
 else:
-    print("Running once.")
+    log.info("LOOP", "Running once.")
     paint()
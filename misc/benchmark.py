@@ -0,0 +1,206 @@
+"""
+Benchmarks the painters against a local mock server (see misc/mock_server.py), so performance can be checked without
+touching the real event server.
+
+    python3 -m misc.benchmark --workload paint-diff --workload protect --size 24x16 --correct 0.9
+
+For every workload, this reports pixels painted per second, requests spent per pixel that actually needed painting,
+how many 429s were hit, and (for protect workloads) how long griefed pixels took to be repaired.
+"""
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy
+from aiohttp import web
+from PIL import Image
+
+from . import mock_server
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# name: (script and its arguments, kind)
+# paint workloads run until they finish, protect workloads get griefed until --duration is up,
+# and chaos workloads just run for --duration.
+WORKLOADS = {
+    "paint": (["main.py"], "paint"),
+    "paint-diff": (["main.py", "--diff"], "paint"),
+    "paint-pipeline": (["main.py", "--pipeline", "4"], "paint"),
+    "paint-diff-pipeline": (["main.py", "--diff", "--pipeline", "4"], "paint"),
+    "protect": (["main.py", "--protect", "--refresh-interval", "2"], "protect"),
+    "protect-adaptive": (["main.py", "--protect", "--adaptive-refresh"], "protect"),
+    "experiment-protect": (["misc/experiment-protect.py"], "paint"),
+    "chaos": (["chaos.py"], "chaos"),
+}
+# How much bigger than the template each script needs its cursor to be. main.py paints an image (end - start - 1)
+# pixels across, while the scripts built on lib.query_params paint (end - start).
+CURSOR_PADDING = {"main.py": 1}
+
+
+class ServerThread(threading.Thread):
+    """Runs the mock server on its own event loop, in the background."""
+
+    def __init__(self, mock: mock_server.MockPixels):
+        super().__init__(daemon=True)
+        self.mock = mock
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.ready = threading.Event()
+
+    @property
+    def base(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(self.mock.app())
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", self.port).start())
+        self.ready.set()
+        loop.run_forever()
+
+
+def make_template(width: int, height: int, path: Path) -> numpy.ndarray:
+    """
+    Draws a blocky test image with some transparency, and saves it.
+
+    :return: numpy.ndarray - (height, width, 4) of what was saved
+    """
+    rng = numpy.random.default_rng(0)
+    blocks = rng.integers(0, 256, ((height + 3) // 4, (width + 3) // 4, 4), dtype=numpy.uint8)
+    blocks[..., 3] = numpy.where(rng.random(blocks.shape[:2]) < 0.1, 0, 255)
+    array = numpy.ascontiguousarray(blocks.repeat(4, 0).repeat(4, 1)[:height, :width])
+    Image.fromarray(array, "RGBA").save(path)
+    return array
+
+
+def correct(mock: mock_server.MockPixels, template: numpy.ndarray, x: int, y: int) -> bool:
+    height, width = template.shape[:2]
+    opaque = template[..., 3] > 0x55
+    return bool((mock.canvas[y:y + height, x:x + width][opaque] == template[..., :3][opaque]).all())
+
+
+def run_workload(name: str, server: ServerThread, template: numpy.ndarray, args, workdir: Path) -> dict:
+    script, kind = WORKLOADS[name]
+    mock = server.mock
+    mock.reset_state()
+    height, width = template.shape[:2]
+    x, y = args.x, args.y
+    mock.prepaint(template, x, y, args.correct)
+    needed = int(((mock.canvas[y:y + height, x:x + width] != template[..., :3]).any(axis=2)
+                  & (template[..., 3] > 0x55)).sum())
+
+    command = [sys.executable, str(ROOT / script[0]), *script[1:], "--base", server.base, "-A", "benchmark-" + name]
+    if kind == "chaos":
+        command += ["-H", str(mock.width - 2), "-V", str(mock.height - 2)]
+    else:
+        padding = CURSOR_PADDING.get(script[0], 0)
+        command += ["-X", str(x), "-Y", str(y), "-H", str(x + width + padding), "-V", str(y + height + padding)]
+        command += ["-I", str(workdir / "template.png"), "--quiet"]
+    # A temp dir of its own, so the canvas cache and lockfile from earlier workloads don't carry over.
+    tempdir = workdir / (name + ".tmp")
+    tempdir.mkdir(exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=str(ROOT), TMPDIR=str(tempdir))
+
+    started = time.monotonic()
+    with open(workdir / f"{name}.log", "w") as log:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            if kind == "paint":
+                process.wait(args.timeout)
+            elif kind == "chaos":
+                time.sleep(args.duration)
+            else:
+                deadline = started + args.timeout
+                while not correct(mock, template, x, y) and time.monotonic() < deadline:
+                    time.sleep(0.2)
+                mock.stats["repair_times"].clear()
+                stop = time.monotonic() + args.duration
+                while time.monotonic() < stop:
+                    mock.grief(x, y, x + width, y + height, args.grief, template[..., 3] > 0x55)
+                    time.sleep(args.grief_interval)
+        except subprocess.TimeoutExpired:
+            pass
+        finally:
+            timed_out = process.poll() is None
+            process.terminate()
+            process.wait()
+    elapsed = time.monotonic() - started
+
+    stats = mock.stats
+    requests = sum(stats["requests"].values())
+    result = {
+        "workload": name,
+        "seconds": round(elapsed, 2),
+        "finished": not timed_out if kind == "paint" else None,
+        "needed": needed if kind != "chaos" else None,
+        "painted": stats["painted"],
+        "changed": stats["changed"],
+        "requests": stats["requests"],
+        "ratelimited": stats["ratelimited"],
+        "errors": stats["errors"],
+        "pixels_per_second": round(stats["changed"] / elapsed, 3),
+        "requests_per_pixel": round(requests / stats["changed"], 2) if stats["changed"] else None,
+    }
+    if kind == "protect":
+        repairs = numpy.array(stats["repair_times"] or [numpy.nan])
+        result.update({
+            "repaired": len(stats["repair_times"]),
+            "unrepaired": len(mock.griefed),
+            "repair_mean": round(float(numpy.mean(repairs)), 2),
+            "repair_p95": round(float(numpy.percentile(repairs, 95)), 2),
+            "repair_max": round(float(numpy.max(repairs)), 2),
+        })
+    return result
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--workload",
+        action="append",
+        choices=list(WORKLOADS),
+        help="Which workloads to run. Can be passed more than once. Defaults to all of them.",
+    )
+    parser.add_argument("--size", default="24x16", help="Size of the template, as WIDTHxHEIGHT.")
+    parser.add_argument("-X", type=int, default=10, dest="x", help="Where the template goes.")
+    parser.add_argument("-Y", type=int, default=10, dest="y", help="Where the template goes.")
+    parser.add_argument("--correct", type=float, default=0.0, help="How much of the template starts already painted.")
+    parser.add_argument("--timeout", type=float, default=600, help="How long a paint workload can take, in seconds.")
+    parser.add_argument("--duration", type=float, default=60, help="How long protect/chaos workloads run for.")
+    parser.add_argument("--grief", type=int, default=5, help="How many pixels get griefed at a time.")
+    parser.add_argument("--grief-interval", type=float, default=10, help="Seconds between griefs.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines instead of a table.")
+    mock_server.add_arguments(parser)
+    args = parser.parse_args()
+
+    server = ServerThread(mock_server.from_arguments(args))
+    server.start()
+    server.ready.wait()
+    width, height = map(int, args.size.lower().split("x"))
+
+    with tempfile.TemporaryDirectory(prefix="pixels-benchmark-") as workdir:
+        workdir = Path(workdir)
+        template = make_template(width, height, workdir / "template.png")
+        for name in args.workload or list(WORKLOADS):
+            result = run_workload(name, server, template, args, workdir)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{name}:")
+                for key, value in result.items():
+                    if key != "workload" and value is not None:
+                        print(f"    {key:<20} {value}")
+
+
+if __name__ == "__main__":
+    main()
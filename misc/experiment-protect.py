@@ -1,12 +1,17 @@
 import asyncio
-import traceback
 from asyncio import Queue, get_event_loop, iscoroutine
-from lib import api, query_params, render, Pixel, arguments, Fore
+from lib import AsyncApi, query_params, render, get_scheduler, Pixel, arguments, log, setup
+from lib.canvas import TRANSPARENCY_THRESHOLD
 
+WATCHERS = 8  # how many pixels are checked at once. The ratelimiter paces them all.
+
+setup()
 start_x, start_y, end_x, end_y, image_width, image_height = query_params()
 pilImage, pixels_map, pixels_array = render(image_width, image_height)
 loop = get_event_loop()
 queue = Queue((image_width+image_height)//2)
+api = AsyncApi(arguments.base, auth=arguments.auth, connections=WATCHERS + 1)
+scheduler = get_scheduler(arguments.strategy or "row-major")
 
 
 async def queue_worker():
@@ -18,38 +23,51 @@ async def queue_worker():
             else:
                 work()
         except Exception:
-            traceback.print_exc()
+            log.exception("WORKER", "Exception while working through the queue:")
         finally:
             queue.task_done()
 worker = loop.create_task(queue_worker())
 
 
 async def paint(x, y, colour):
-    print(Fore.LIGHTBLUE_EX + "[WORKER] " + Fore.LIGHTYELLOW_EX + "Painting ({},{}) #{}.".format(x, y, colour))
-    await loop.run_in_executor(
-        None,
-        api.blind_set_pixel, x, y, colour
-    )
-    print(Fore.LIGHTBLACK_EX + "[WORKER]" + Fore.LIGHTGREEN_EX + " Painted ({},{}).".format(x, y))
+    log.debug("WORKER", "Painting %s #%s.", (x, y), colour, x=x, y=y, colour=colour)
+    await api.blind_set_pixel(x, y, colour)
+    log.info("WORKER", "Painted %s.", (x, y), x=x, y=y, colour=colour)
+
+
+async def check(x, y):
+    cursor = (x + start_x, y + start_y)
+    colour = pixels_map[(x, y)]
+    if int(colour[6:], 16) <= TRANSPARENCY_THRESHOLD:
+        return
+    colour = colour[:6]
+    pixel: Pixel = await api.get_pixel(*cursor)
+
+    if pixel.hex != colour:
+        log.info(
+            "CURSOR", "%s is %s (not %s). Adding to queue.", cursor, pixel.hex, colour,
+            x=cursor[0], y=cursor[1], actual=pixel.hex, colour=colour,
+        )
+        if queue.qsize() > queue.maxsize - (queue.maxsize // 4):
+            log.warning(
+                "WORKER", "Queue is getting a bit full (%d/%d).", queue.qsize(), queue.maxsize,
+                queued=queue.qsize(), size=queue.maxsize,
+            )
+        await queue.put(paint(*cursor, colour))
+    else:
+        log.debug("CURSOR", "%s is painted correctly.", cursor, x=cursor[0], y=cursor[1])
+
+
+async def watcher(targets):
+    for x, y in targets:
+        await check(x, y)
 
 
 async def main_async():
-    # Slow and steady method
-    for x, y in pixels_map.keys():
-        cursor = (x + start_x, y + start_y)
-        pixel: Pixel = await loop.run_in_executor(None, api.get_pixel, x, y)
-
-        if pixel.hex != pixels_map[(x, y)]:
-            print(Fore.YELLOW + "[CURSOR] " + Fore.LIGHTRED_EX + f"{cursor} is {pixel.hex} (not {pixels_map[(x,y)]})."
-                                                                 f" Adding to queue.")
-            if queue.qsize() > queue.maxsize - (queue.maxsize // 4):
-                print(Fore.LIGHTBLUE_EX + "[WORKER] " + Fore.YELLOW + f"Queue is getting a bit full "
-                                                                      f"({queue.qsize()}/{queue.maxsize}).")
-            await queue.put(paint(*cursor, pixels_map[(x, y)]))
-            # We run_in_executor because otherwise the time.sleep() in the ratelimit handler would block the loop.
-            # Blocking the loop = slower.
-        else:
-            print(Fore.YELLOW + "[CURSOR] " + Fore.LIGHTGREEN_EX + f"{cursor} is painted correctly.")
+    # Slow and steady method, but with several pixels in flight at once.
+    # Everything runs on this one thread; cooldowns are asyncio.sleep()s, so nothing blocks the loop.
+    targets = [tuple(xy) for xy in scheduler.order(pixels_map.coords(), pixels_map).tolist()]
+    await asyncio.gather(*(watcher(targets[i::WATCHERS]) for i in range(WATCHERS)))
     await queue.join()
     return
 
@@ -79,3 +97,4 @@ except Exception:
     raise
 finally:
     worker.cancel()
+    loop.run_until_complete(api.close())
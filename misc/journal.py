@@ -0,0 +1,65 @@
+"""
+Looks back through a canvas history kept with `main.py --journal DIR`.
+
+    python3 -m misc.journal DIR                                # what's in it
+    python3 -m misc.journal DIR --at "2021-05-28 18:30" -o then.png
+    python3 -m misc.journal DIR --at -600 -o ten-minutes-ago.png
+
+--at takes a date and time (in local time), a time.time(), or a negative number of seconds before now.
+"""
+import datetime
+import os
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from PIL import Image
+
+from lib.journal import KEYFRAME, Journal
+
+
+def parse_when(value: str) -> float:
+    """
+    :param value: An ISO date and time, a time.time(), or a negative number of seconds ago
+    :return: float - a time.time()
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    return time.time() + number if number < 0 else number
+
+
+def describe(journal: Journal):
+    index = journal.index()
+    if not len(index):
+        print("The journal is empty.")
+        return
+    keyframes = int((index["kind"] == KEYFRAME).sum())
+    size = sum(os.path.getsize(journal.directory / name) for name in ("journal.bin", "journal.idx"))
+    start, end = (datetime.datetime.fromtimestamp(t).isoformat(" ", "seconds") for t in index["time"][[0, -1]])
+    print(f"{len(index)} snapshots ({keyframes} keyframes), {size / 1024:.1f} KiB, from {start} to {end}.")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Shows what's in a canvas journal, or exports the canvas from a moment in it.")
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--at", type=parse_when, default=None, help="The moment to export the canvas from.")
+    parser.add_argument("--output", "-o", type=Path, default=Path("canvas.png"))
+    parser.add_argument("--scale", type=int, default=8, help="How many times bigger to make the exported image.")
+    arguments = parser.parse_args()
+
+    journal = Journal(arguments.directory)
+    if arguments.at is None:
+        describe(journal)
+    else:
+        found = journal.at(arguments.at)
+        if found is None:
+            raise SystemExit("The journal doesn't go back that far.")
+        taken, canvas = found
+        image = canvas.to_image()
+        image.resize((canvas.width * arguments.scale, canvas.height * arguments.scale), Image.NEAREST).save(
+            arguments.output
+        )
+        taken = datetime.datetime.fromtimestamp(taken).isoformat(" ", "seconds")
+        print(f"Canvas from {taken} saved to {arguments.output}.")
@@ -0,0 +1,237 @@
+"""
+A local stand-in for the pixels API, for benchmarking and testing without touching the real event server.
+
+    python3 -m misc.mock_server --port 8080 --latency 0.15
+    python3 main.py --base http://127.0.0.1:8080 ...
+
+Ratelimits are tracked per token and endpoint, with the same headers the real server sends. On top of the real
+endpoints, there's POST /_grief (scribble over a region, to measure repair times), POST /_reset and GET /_stats.
+"""
+import asyncio
+import hashlib
+import random
+import time
+from argparse import ArgumentParser
+
+import numpy
+from aiohttp import web
+
+# endpoint: (requests per period, period in seconds, cooldown after a 429)
+DEFAULT_LIMITS = {
+    "get_size": (5, 10, 60),
+    "get_pixel": (8, 10, 60),
+    "get_pixels": (5, 10, 60),
+    "set_pixel": (2, 2, 60),
+}
+
+
+class Window:
+    __slots__ = ("started", "used", "cooldown_until")
+
+    def __init__(self):
+        self.started = 0.0
+        self.used = 0
+        self.cooldown_until = 0.0
+
+
+class MockPixels:
+    """
+    The mock server's state: the canvas, everyone's ratelimit windows, and what's happened so far.
+
+    Attributes:
+        canvas: numpy.ndarray - (height, width, 3)
+        limits: dict - endpoint: (requests per period, period, cooldown after a 429)
+        latency: float - how long every request takes, in seconds
+        jitter: float - up to how much extra time (at random) every request takes
+        error_rate: float - the fraction of requests (at random) answered with a bare 502, as if by a proxy
+        stats: dict - request counts, 429s, pixels painted and repair times
+    """
+
+    def __init__(self, width=160, height=90, limits=None, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.width = width
+        self.height = height
+        self.canvas = numpy.full((height, width, 3), 255, dtype=numpy.uint8)
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.windows = {}
+        self.griefed = {}
+        self.stats = {}
+        self.reset_state()
+
+    def reset_state(self):
+        self.canvas[:] = 255
+        self.windows.clear()
+        self.griefed.clear()
+        self.stats = {"requests": {}, "ratelimited": 0, "errors": 0, "painted": 0, "changed": 0, "repair_times": []}
+
+    def ratelimit(self, request: web.Request, endpoint: str):
+        token = request.headers.get("Authorization", "")
+        if endpoint != "get_size" and (not token.startswith("Bearer ") or len(token) <= 7):
+            raise web.HTTPUnauthorized()
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            raise web.HTTPBadGateway()  # never reaches the real server, so it doesn't count against the ratelimit
+        limit, period, cooldown = self.limits[endpoint]
+        window = self.windows.setdefault((token, endpoint), Window())
+        now = time.monotonic()
+        self.stats["requests"][endpoint] = self.stats["requests"].get(endpoint, 0) + 1
+        if window.cooldown_until > now:
+            self.stats["ratelimited"] += 1
+            raise web.HTTPTooManyRequests(headers={"cooldown-reset": "%.3f" % (window.cooldown_until - now)})
+        if now - window.started >= period:
+            window.started = now
+            window.used = 0
+        window.used += 1
+        if window.used > limit:
+            window.cooldown_until = now + cooldown
+            self.stats["ratelimited"] += 1
+            raise web.HTTPTooManyRequests(headers={"cooldown-reset": "%.3f" % cooldown})
+        return {
+            "requests-limit": str(limit),
+            "requests-period": str(period),
+            "requests-remaining": str(limit - window.used),
+            "requests-reset": "%.3f" % (window.started + period - now),
+        }
+
+    async def delay(self):
+        wait = self.latency + random.uniform(0, self.jitter)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def check(self, x, y):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise web.HTTPUnprocessableEntity(text='{"detail": "out of range"}', content_type="application/json")
+
+    async def get_size(self, request):
+        headers = self.ratelimit(request, "get_size")
+        await self.delay()
+        return web.json_response({"width": self.width, "height": self.height}, headers=headers)
+
+    async def get_pixel(self, request):
+        headers = self.ratelimit(request, "get_pixel")
+        await self.delay()
+        if request.method == "HEAD":
+            return web.Response(headers=headers)
+        x, y = int(request.query["x"]), int(request.query["y"])
+        self.check(x, y)
+        rgb = "%02x%02x%02x" % tuple(self.canvas[y, x].tolist())
+        return web.json_response({"x": x, "y": y, "rgb": rgb}, headers=headers)
+
+    async def get_pixels(self, request):
+        headers = self.ratelimit(request, "get_pixels")
+        await self.delay()
+        if request.method == "HEAD":
+            return web.Response(headers=headers)
+        body = self.canvas.tobytes()
+        headers["ETag"] = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, headers=headers, content_type="application/octet-stream")
+
+    async def set_pixel(self, request):
+        headers = self.ratelimit(request, "set_pixel")
+        await self.delay()
+        if request.method == "HEAD":
+            return web.Response(headers=headers)
+        data = await request.json()
+        x, y = int(data["x"]), int(data["y"])
+        self.check(x, y)
+        rgb = int(data["rgb"], 16)
+        colour = [(rgb >> 16) & 0xFF, (rgb >> 8) & 0xFF, rgb & 0xFF]
+        self.stats["painted"] += 1
+        if self.canvas[y, x].tolist() != colour:
+            self.stats["changed"] += 1
+        self.canvas[y, x] = colour
+        griefed_at = self.griefed.pop((x, y), None)
+        if griefed_at is not None:
+            self.stats["repair_times"].append(time.monotonic() - griefed_at)
+        return web.json_response({"message": "added pixel to %d,%d" % (x, y)}, headers=headers)
+
+    async def stats_handler(self, request):
+        return web.json_response({**self.stats, "unrepaired": len(self.griefed)})
+
+    def prepaint(self, template: numpy.ndarray, x: int, y: int, fraction: float = 1.0):
+        """
+        Paints a random fraction of a template straight onto the canvas, e.g. to simulate a mostly finished drawing.
+
+        :param template: (height, width, 3+) of the colours to paint
+        :param x: Where the left edge of the template goes
+        :param y: Where the top edge of the template goes
+        :param fraction: How much of it to paint, from 0 to 1
+        """
+        height, width = template.shape[:2]
+        chosen = numpy.random.random((height, width)) < fraction
+        region = self.canvas[y:y + height, x:x + width]
+        region[chosen] = template[..., :3][chosen]
+
+    def grief(self, x0: int, y0: int, x1: int, y1: int, count: int = 1, mask: numpy.ndarray = None):
+        """
+        Scribbles random colours over random pixels of a region. Repairs to them get timed.
+
+        :param mask: (y1 - y0, x1 - x0) of which pixels can be griefed, e.g. to leave transparent ones alone
+        """
+        now = time.monotonic()
+        ys, xs = numpy.nonzero(numpy.ones((y1 - y0, x1 - x0), bool) if mask is None else mask)
+        for _ in range(count):
+            i = random.randrange(len(xs))
+            x, y = int(xs[i]) + x0, int(ys[i]) + y0
+            self.canvas[y, x] = [random.randrange(256) for _ in range(3)]
+            self.griefed.setdefault((x, y), now)
+
+    async def grief_handler(self, request):
+        data = await request.json()
+        self.grief(data["x0"], data["y0"], data["x1"], data["y1"], data.get("count", 1))
+        return web.json_response({"griefed": data.get("count", 1)})
+
+    async def reset_handler(self, request):
+        self.reset_state()
+        return web.json_response({})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/get_size", self.get_size)
+        app.router.add_route("*", "/get_pixel", self.get_pixel)
+        app.router.add_route("*", "/get_pixels", self.get_pixels)
+        app.router.add_route("*", "/set_pixel", self.set_pixel)
+        app.router.add_get("/_stats", self.stats_handler)
+        app.router.add_post("/_grief", self.grief_handler)
+        app.router.add_post("/_reset", self.reset_handler)
+        return app
+
+
+def limit(value: str):
+    """Parses endpoint=requests/period[/cooldown], e.g. set_pixel=2/120"""
+    endpoint, _, rule = value.partition("=")
+    count, period, *cooldown = rule.split("/")
+    if endpoint not in DEFAULT_LIMITS:
+        raise ValueError(f"{endpoint!r} is not an endpoint.")
+    return endpoint, (int(count), float(period), float(cooldown[0]) if cooldown else DEFAULT_LIMITS[endpoint][2])
+
+
+def add_arguments(parser: ArgumentParser):
+    parser.add_argument("--width", type=int, default=160, help="Width of the mock canvas.")
+    parser.add_argument("--height", type=int, default=90, help="Height of the mock canvas.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every request takes.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to how many extra seconds a request takes.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 502.")
+    parser.add_argument(
+        "--limit",
+        action="append",
+        type=limit,
+        default=[],
+        help="Overrides an endpoint's ratelimit, as endpoint=requests/period[/cooldown]. Can be passed more than once.",
+    )
+
+
+def from_arguments(args) -> MockPixels:
+    return MockPixels(args.width, args.height, dict(args.limit), args.latency, args.jitter, args.error_rate)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Runs a mock pixels API server.")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    arguments = parser.parse_args()
+    web.run_app(from_arguments(arguments).app(), host="127.0.0.1", port=arguments.port)